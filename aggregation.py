@@ -0,0 +1,170 @@
+"""グラフ用の集計エンジン
+
+ヒストグラム・棒グラフ・円グラフ・ヒートマップの集計を行う。
+SqlAggregationEngine は集計をSQLにしてウェアハウス側で実行し、集計済みの行だけを受け取る。
+PandasAggregationEngine は手元のDataFrameで同じ結果を返す（フォールバック、比較検証用）。
+
+どちらのエンジンも次の形のDataFrameを返す（NULLは集計対象外、キーの昇順）。
+    histogram (数値): bin_start, bin_end, count
+    histogram (数値以外): name, count
+    bar: category, value（数値カラムは合計、それ以外は件数）。limitを指定すると、
+        値の大きい上位limit件（値がNULLのものは除き、同じ値はキーの昇順）を値の降順で返す
+    pie: name, count
+    heatmap: x, y, count
+cardinality はカラム名 -> 値の種類数（NULLを除く）の辞書を返す。
+"""
+import numpy as np
+import pandas as pd
+
+from columns import NUMERIC_COLUMNS, column_mapping
+
+# ヒストグラムの既定のビン数
+DEFAULT_BINS = 30
+
+
+def _check_columns(*columns):
+    # SQLに埋め込むため、ORDERSのカラム名以外は受け付けない
+    for col in columns:
+        if col not in column_mapping:
+            raise ValueError(f'ORDERSに存在しないカラムです: {col}')
+
+
+def _bin_edges(lo, hi, bins):
+    if lo == hi:
+        return np.array([lo]), np.array([hi])
+    width = (hi - lo) / bins
+    starts = lo + np.arange(bins) * width
+    return starts, starts + width
+
+
+class PandasAggregationEngine:
+    """手元のDataFrameで集計する"""
+
+    def __init__(self, df):
+        self.df = df
+
+    def histogram(self, col, bins=DEFAULT_BINS):
+        values = self.df[col].dropna()
+        if col not in NUMERIC_COLUMNS:
+            return self.pie(col)
+        if values.empty:
+            return pd.DataFrame({'bin_start': [], 'bin_end': [], 'count': []})
+        # 幅の狭い整数型でのオーバーフローを避けるためfloat64で計算する
+        arr = values.to_numpy(dtype=np.float64)
+        lo, hi = arr.min().item(), arr.max().item()
+        if lo == hi:
+            index = np.zeros(len(arr), dtype=np.int64)
+            bins = 1
+        else:
+            # SqlAggregationEngineと同じ式でビン番号を求める（最大値は最後のビンに含める）
+            index = np.minimum(np.floor((arr - lo) * bins / (hi - lo)).astype(np.int64), bins - 1)
+        counts = np.bincount(index, minlength=bins)
+        starts, ends = _bin_edges(lo, hi, bins)
+        return pd.DataFrame({'bin_start': starts, 'bin_end': ends, 'count': counts})
+
+    def bar(self, category, value, limit=None):
+        keys = self.df[category].rename('category')
+        values = self.df[value].rename('value')
+        # category型のキーでは、データに現れないカテゴリを結果に含めない
+        grouped = values.groupby(keys, observed=True)
+        result = grouped.sum(min_count=1) if value in NUMERIC_COLUMNS else grouped.count()
+        result = result.sort_index()
+        if limit is not None:
+            # キーの昇順に並べてから取り出すため、同じ値はキーの小さい方が残る
+            result = result.nlargest(limit)
+        return result.reset_index()
+
+    def pie(self, col):
+        counts = self.df[col].dropna().value_counts().sort_index()
+        counts = counts[counts > 0]
+        return pd.DataFrame({'name': counts.index, 'count': counts.to_numpy()})
+
+    def heatmap(self, x, y):
+        keys = [self.df[x].rename('x'), self.df[y].rename('y')]
+        counts = self.df.groupby(keys, observed=True).size()
+        return counts.rename('count').sort_index().reset_index()
+
+    def cardinality(self, columns):
+        return {col: int(self.df[col].nunique()) for col in columns}
+
+
+class SqlAggregationEngine:
+    """集計をSQLにしてウェアハウスで実行する
+
+    run_query: SQLを受け取りDataFrameを返す関数
+    dialect: 'snowflake' または 'sqlite'（ヒストグラムのビン分けの書き方が異なる）
+    """
+
+    def __init__(self, run_query, dialect='snowflake', table='orders'):
+        self._run_query = run_query
+        self.dialect = dialect
+        self.table = table
+
+    def _bucket_expr(self, col, lo, hi, bins):
+        if lo == hi:
+            return '0'
+        if self.dialect == 'snowflake':
+            # WIDTH_BUCKETは1始まりで、最大値はbins+1になるため最後のビンに寄せる
+            return f'LEAST(WIDTH_BUCKET({col}, {lo!r}, {hi!r}, {bins}), {bins}) - 1'
+        # WIDTH_BUCKETの無いDB向け。(値 - 最小値) * ビン数 / 幅 の切り捨て
+        return f'MIN(CAST(({col} - {lo!r}) * {bins} * 1.0 / ({hi!r} - {lo!r}) AS INTEGER), {bins - 1})'
+
+    def histogram(self, col, bins=DEFAULT_BINS):
+        _check_columns(col)
+        if col not in NUMERIC_COLUMNS:
+            return self.pie(col)
+        bounds = self._run_query(f'SELECT MIN({col}) AS LO, MAX({col}) AS HI FROM {self.table}')
+        lo, hi = bounds.iloc[0].tolist()
+        if pd.isna(lo):
+            return pd.DataFrame({'bin_start': [], 'bin_end': [], 'count': []})
+        if lo == hi:
+            bins = 1
+        result = self._run_query(
+            f'SELECT {self._bucket_expr(col, lo, hi, bins)} AS BIN, COUNT(*) AS N FROM {self.table} '
+            f'WHERE {col} IS NOT NULL GROUP BY 1'
+        )
+        counts = np.zeros(bins, dtype=np.int64)
+        counts[result.iloc[:, 0].astype(np.int64).to_numpy()] = result.iloc[:, 1].to_numpy()
+        starts, ends = _bin_edges(lo, hi, bins)
+        return pd.DataFrame({'bin_start': starts, 'bin_end': ends, 'count': counts})
+
+    def bar(self, category, value, limit=None):
+        _check_columns(category, value)
+        agg = f'SUM({value})' if value in NUMERIC_COLUMNS else f'COUNT({value})'
+        sql_query = f'SELECT {category} AS G0, {agg} AS V FROM {self.table} WHERE {category} IS NOT NULL GROUP BY {category} '
+        if limit is None:
+            sql_query += f'ORDER BY {category}'
+        else:
+            # 上位だけをウェアハウスで絞り込み、全グループを受け取らない
+            sql_query += f'HAVING {agg} IS NOT NULL ORDER BY {agg} DESC, {category} LIMIT {int(limit)}'
+        result = self._run_query(sql_query)
+        result.columns = ['category', 'value']
+        return result
+
+    def pie(self, col):
+        _check_columns(col)
+        result = self._run_query(
+            f'SELECT {col} AS G0, COUNT(*) AS N FROM {self.table} '
+            f'WHERE {col} IS NOT NULL GROUP BY {col} ORDER BY {col}'
+        )
+        result.columns = ['name', 'count']
+        return result
+
+    def heatmap(self, x, y):
+        _check_columns(x, y)
+        result = self._run_query(
+            f'SELECT {x} AS G0, {y} AS G1, COUNT(*) AS N FROM {self.table} '
+            f'WHERE {x} IS NOT NULL AND {y} IS NOT NULL GROUP BY {x}, {y} ORDER BY {x}, {y}'
+        )
+        result.columns = ['x', 'y', 'count']
+        return result
+
+    def cardinality(self, columns):
+        _check_columns(*columns)
+        if self.dialect == 'snowflake':
+            # 選択肢の絞り込みには近似値で十分なため、重複除去より軽いAPPROX_COUNT_DISTINCTを使う
+            exprs = [f'APPROX_COUNT_DISTINCT({col}) AS {col}' for col in columns]
+        else:
+            exprs = [f'COUNT(DISTINCT {col}) AS {col}' for col in columns]
+        result = self._run_query(f"SELECT {', '.join(exprs)} FROM {self.table}")
+        return {col: int(n) for col, n in zip(columns, result.iloc[0].tolist())}
@@ -1,23 +1,34 @@
-import snowflake.connector
 import streamlit as st
+import functools
 import os
+import threading
 from dotenv import load_dotenv
-import pandas as pd
-import numpy as np
-import plotly.express as px
-import openai
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-load_dotenv()
+import tracing
+
+# ページの枠（タイトル・目次）を先に表示するため、pandas・plotly等を使うモジュールは枠を表示してから読み込む。
+# データの取得・集計は data_access / sections、グラフは charts、ChatGPTは chat* のモジュールにある
+# （openaiはChatGPTに問い合わせるときに初めて読み込む）。
 
-# 環境変数ファイルの読み込み
-user = os.getenv('SNOWFLAKE_USER')
-password = os.getenv('SNOWFLAKE_PASSWORD')
-account = os.getenv('SNOWFLAKE_ACCOUNT')
-warehouse = os.getenv('SNOWFLAKE_WAREHOUSE')
-database = os.getenv('SNOWFLAKE_DATABASE')
-schema = os.getenv('SNOWFLAKE_SCHEMA')
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# 環境変数ファイルの読み込み（Snowflakeの接続情報はdata_access側、OpenAIのAPIキーはchat側で読み込む）
+load_dotenv()
 
+# 最初から開いておくグラフのセクション（カンマ区切り）。閉じているセクションはグラフを作らない
+CHART_SECTIONS_OPEN = os.getenv('CHART_SECTIONS_OPEN', 'scatter').split(',')
+# セクションごとのグラフをキャッシュする容量（MB、全セッションで共有）
+FIGURE_CACHE_MB = float(os.getenv('FIGURE_CACHE_MB', '64'))
+# グラフの作成（クエリ）を同時に実行する数と、1つのグラフを待つ上限（秒）
+# 同時に実行する数は、接続プールの大きさ（POOL_SIZE）以下にする
+CHART_QUERY_WORKERS = int(os.getenv('CHART_QUERY_WORKERS', '4'))
+CHART_QUERY_TIMEOUT = float(os.getenv('CHART_QUERY_TIMEOUT', '60'))
+# ORDERSをストリーミングで読み込む間、進捗と途中までの集計のグラフを描き直す間隔（秒）
+STREAM_REFRESH_SECONDS = float(os.getenv('STREAM_REFRESH_SECONDS', '1'))
+
+# この実行の処理時間の内訳を記録する（サイドバーのパネルには、実行の最後に内訳を書き込む）
+trace = tracing.start_trace()
+trace_panel = st.sidebar.container()
+show_trace = trace_panel.toggle('処理時間の内訳を表示', key='show_trace')
 
 # Streamlitアプリのタイトル
 st.title('Snowflake Data Analysis App')
@@ -65,178 +76,464 @@ st.markdown("""
 # st.subheader('My sub')
 # st.code('for i in range(8): foo()')
 
+import chat  # noqa: E402
+import data_access  # noqa: E402
+import sections  # noqa: E402
+from chat_cache import ResponseCache  # noqa: E402
+from chat_context import TOP_CUSTOMERS, build_context, build_summary_blocks, grounded_system_message  # noqa: E402
+from chat_scheduler import ChatScheduler, SchedulerError, scheduled_chat_client  # noqa: E402
+from columns import FILTER_COLUMNS, NUMERIC_COLUMNS, column_mapping, registry  # noqa: E402
+from figure_cache import FigureCache  # noqa: E402
+import filters  # noqa: E402
+from query_executor import QueryCancelled, QueryExecutor, QueryTimeout  # noqa: E402
+from summaries import BIN_RULES  # noqa: E402
+from tokens import count_tokens  # noqa: E402
+
 ###################snowflakeへ接続########################
-# Snowflakeへの接続情報
-conn_info = {
-    'user': user,
-    'password': password,
-    'account': account,
-    'warehouse': warehouse,
-    'database': database,
-    'schema': schema
+# 「データを再取得」が押されたら増えた行だけを取得し、「全件を再取得」ならキャッシュを破棄する
+if st.sidebar.button('データを再取得'):
+    st.sidebar.caption(f'追加された行: {data_access.refresh_orders():,}行')
+if st.sidebar.button('全件を再取得'):
+    data_access.reload_orders()
+
+# データバージョンが変わったら、カラムごとの値の種類数を取り直してグラフの選択肢を絞り込む
+current_version = data_access.dataset_version()
+if registry.cardinality_version != current_version:
+    registry.set_cardinality(data_access.column_cardinality(current_version), current_version)
+
+# 各グラフのセレクトボックスのキーと (選択肢の条件, 初期値のインデックスまたはカラム名)
+# 散布図と箱ひげ図は行データを使い、それ以外は集計結果を使う
+chart_selectboxes = {
+    'scatter_x': ('scatter', 0), 'scatter_y': ('scatter', 1),
+    'boxplot_select': ('box', 0),
+}
+aggregate_selectboxes = {
+    'histogram_select': ('histogram', 0),
+    # 棒グラフはカテゴリと値が同じ数値カラムにならないよう、カテゴリの初期値をカテゴリのカラムにする
+    'bar_category_select': ('bar_category', 'PRODUCTLINE'), 'bar_value_select': ('bar_value', 'SALES'),
+    'pie_chart_select': ('pie', 0),
+    'heatmap_x_select': ('heatmap', 0), 'heatmap_y_select': ('heatmap', 1),
 }
 
-# Snowflakeに接続
-conn = snowflake.connector.connect(**conn_info)
-
-    # SQLクエリの実行とDataFrameへの読み込み
-sql_query = "SELECT * FROM orders"
-df = pd.read_sql(sql_query, conn)
 
-# 接続を閉じる
-conn.close()
+def chart_options(chart):
+    """グラフの選択肢のカラム名のリスト"""
+    options = registry.eligible(chart)
+    if chart == 'scatter' and data_access.ORDERS_LOAD_MODE == 'stream':
+        # ストリーミングでは散布図を数値カラムの2次元ビンで描くため、数値カラムだけを選べる
+        options = [name for name in options if name in NUMERIC_COLUMNS]
+    return options
+
+
+def current_selection(key):
+    """セレクトボックスの現在の選択（未操作、または選択肢から外れた場合は初期値）を英語のカラム名で返す"""
+    chart, default = {**chart_selectboxes, **aggregate_selectboxes}[key]
+    options = chart_options(chart)
+    label = st.session_state.get(key)
+    if label is not None and registry.name(label) in options:
+        return registry.name(label)
+    if isinstance(default, str):
+        # 初期値のカラムが選択肢に無ければ、同じ種類の最初のカラムにする
+        same_kind = [name for name in options if registry.kind(name) == registry.kind(default)]
+        return default if default in options else (same_kind or options)[0]
+    return options[min(default, len(options) - 1)]
+
+
+def column_selectbox(text, key):
+    """グラフに適したカラムだけを選択肢にしたセレクトボックス。選択を英語のカラム名で返す"""
+    chart, _ = {**chart_selectboxes, **aggregate_selectboxes}[key]
+    options = chart_options(chart)
+    labels = [registry.label(name) for name in options]
+    selected = st.selectbox(text, labels, index=options.index(current_selection(key)), key=key)
+    return registry.name(selected)
+
+
+# 各グラフのセクション名 -> セクション内のセレクトボックスのキー
+section_selectboxes = {
+    'scatter': ['scatter_x', 'scatter_y'],
+    'histogram': ['histogram_select'],
+    'box': ['boxplot_select'],
+    'bar': ['bar_category_select', 'bar_value_select'],
+    'pie': ['pie_chart_select'],
+    'heatmap': ['heatmap_x_select', 'heatmap_y_select'],
+}
+# 行データを使うセクション（pandasで集計する場合は、集計するセクションも行データを使う）
+row_sections = {'scatter', 'histogram', 'box'}
+if data_access.AGGREGATION_ENGINE == 'pandas':
+    row_sections = set(section_selectboxes)
+
+
+def section_is_open(name):
+    """セクションが開いているか（トグルが未操作なら初期設定に従う）"""
+    return st.session_state.get(f'open_{name}', name in CHART_SECTIONS_OPEN)
+
+
+def clear_filters():
+    for col in FILTER_COLUMNS:
+        st.session_state[f'filter_{col}'] = []
+
+
+def filter_panel(data_version):
+    """サイドバーの絞り込み（クロスフィルタ）。選んだ値の絞り込みを返す（filters.normalize の形）
+
+    絞り込みは全グラフに適用する。絞り込んだ行はカラムストアが値ごとの行番号の索引から求め、
+    全グラフ（全セッション）で共有する。
+    """
+    if data_access.ORDERS_LOAD_MODE == 'stream':
+        st.sidebar.caption('ストリーミングで読み込む場合は行データを保持しないため、絞り込みは使えません')
+        return ()
+    options = data_access.filter_options(data_version)
+    selections = {
+        col: st.sidebar.multiselect(column_mapping[col], values, key=f'filter_{col}')
+        for col, values in options.items()
+    }
+    st.sidebar.button('絞り込みを解除', on_click=clear_filters)
+    return filters.normalize(selections)
+
+
+# 絞り込み（オフにすると選択も解除される）
+active_filters = ()
+if st.sidebar.toggle('絞り込み', key='use_filters'):
+    active_filters = filter_panel(current_version)
+if active_filters:
+    # 絞り込んだ場合は、集計するセクションも絞り込んだ行を使う
+    row_sections = set(section_selectboxes)
+
+stream_summary = None
+if data_access.ORDERS_LOAD_MODE == 'stream':
+    # 行データを保持せず、バックグラウンドでバッチごとに読み込みながら集計する（読み込み中も途中までの集計で描画する）
+    data_version = current_version
+    stream_summary = data_access.streaming_summary(data_version)
+    # データバージョンが変わったら、このセッションで読み込んでいた前のバージョンの読み込みを打ち切る
+    previous_summary = st.session_state.get('stream_summary')
+    if previous_summary is not None and previous_summary is not stream_summary and not previous_summary.done:
+        previous_summary.close()
+    st.session_state['stream_summary'] = stream_summary
+else:
+    # 開いているセクションのグラフに必要なカラムを、まとめて1回の問い合わせで取得しておく
+    # （取得済みのカラムはキャッシュを使い、新しく選ばれたカラムだけSnowflakeへ問い合わせる）
+    required_columns = sorted({
+        current_selection(key)
+        for name in row_sections if section_is_open(name)
+        for key in section_selectboxes[name]
+    })
+    view, data_version = data_access.load_orders(required_columns, filters=active_filters)
+    if active_filters:
+        st.sidebar.caption(f'絞り込んだ行: {len(view):,}行')
+st.sidebar.caption(f'データバージョン: {data_version}')
+with st.sidebar.expander('接続プール', expanded=False):
+    st.write(data_access.get_pool().stats())
+# メモリレポート（カラムごとの型変換前後のバイト数）
+if st.sidebar.toggle('メモリレポートを表示'):
+    report = data_access.memory_report()
+    st.sidebar.caption(f"合計: {report['before_bytes'].sum() / 1024 ** 2:.1f} MB → {report['after_bytes'].sum() / 1024 ** 2:.1f} MB")
+    st.sidebar.dataframe(report, hide_index=True)
 #########################################################
 
 
-#####################ORDERSテーブルのカラム名とその日本語のマッピング#######################
-# 英語のカラム名とそれに対応する日本語訳をマッピングしたオブジェクト
-column_mapping = {
-    "ORDERNUMBER": "注文番号",
-    "QUANTITYORDERED": "注文数量",
-    "PRICEEACH": "単価",
-    "ORDERLINENUMBER": "注文行番号",
-    "SALES": "売上",
-    "ORDERDATE": "注文日（データ空です。）",
-    "STATUS": "ステータス",
-    "QTR_ID": "四半期ID",
-    "MONTH_ID": "月ID",
-    "YEAR_ID": "年ID",
-    "PRODUCTLINE": "製品ライン",
-    "MSRP": "希望小売価格",
-    "PRODUCTCODE": "製品コード",
-    "CUSTOMERNAME": "顧客名",
-    "PHONE": "電話番号",
-    "ADDRESSLINE1": "住所1",
-    "ADDRESSLINE2": "住所2",
-    "CITY": "市区町村",
-    "STATE": "都道府県",
-    "POSTALCODE": "郵便番号",
-    "COUNTRY": "国",
-    "TERRITORY": "地域",
-    "CONTACTLASTNAME": "担当者姓",
-    "CONTACTFIRSTNAME": "担当者名",
-    "DEALSIZE": "取引規模"
-}
-############################################################################################
-
+@st.cache_resource
+def get_figure_cache():
+    """セッション間で共有するグラフのキャッシュ"""
+    return FigureCache(FIGURE_CACHE_MB * 1024 ** 2)
+
+
+@st.cache_resource
+def get_query_executor():
+    """グラフの作成（クエリ）を並行して実行するスレッドプール（全セッションで共有）"""
+    return QueryExecutor(CHART_QUERY_WORKERS, CHART_QUERY_TIMEOUT)
+
+
+@st.cache_resource
+def get_trace_log():
+    """処理時間の内訳の記録と書き出し（全セッションで共有）"""
+    return tracing.TraceLog()
+
+
+def with_script_context(func):
+    """ワーカースレッドでもst.cache_data等のキャッシュが使えるよう、この実行のコンテキストを付けて呼ぶ関数にする"""
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func()
+    return run
+
+
+# この実行で投入したグラフの (表示先, ジョブ)。セクションを描き終えてから、終わった順に表示する
+pending_figures = []
+# ORDERSの読み込み中に途中までの集計で描いたグラフの (表示先, キャッシュのキー, build)。読み込みが終わるまで描き直す
+streaming_figures = []
+
+
+def section_figure(name, data_version, columns, build, options=()):
+    """セクションのグラフの表示先を確保し、グラフを表示する（作成中ならshow_figuresで表示する）
+
+    データバージョン・グラフの種類・カラム・オプションが同じならキャッシュをすぐに表示する。
+    キャッシュに無ければbuild（(figure, キャプション) を返す）をジョブとして投入し、他のセクションの
+    作成と並行して実行する。選択が変わった場合は、前の選択で投入したジョブを手放す（取り消す）。
+    """
+    cache = get_figure_cache()
+    key = (data_version, name, tuple(columns), tuple(options), active_filters)
+    if stream_summary is not None and not stream_summary.done:
+        # 読み込み中は途中までの集計ですぐに描き、show_streaming_figuresで描き直す（途中のグラフはキャッシュしない）
+        slot = st.empty()
+        with tracing.span('figure', chart=name, status='streaming'):
+            show_figure(slot, *build())
+        streaming_figures.append((slot, key, build))
+        return
+    jobs = st.session_state.setdefault('figure_jobs', {})
+    previous = jobs.get(name)
+    if previous is not None and previous.key != key:
+        get_query_executor().release(previous)
+        del jobs[name]
+        previous = None
+    slot = st.empty()
+    with tracing.span('figure', chart=name) as span:
+        cached = cache.get(key)
+        if cached is not None:
+            span.set(status='hit', bytes=cache.entry_bytes(key))
+            show_figure(slot, *cached)
+            return
+        if previous is not None and previous.reason is None and not previous.done():
+            # 前の実行（選択の途中で打ち切られた実行等）で投入したジョブがまだ実行中なら、それを待つ
+            job = previous
+        else:
+            job = get_query_executor().submit(key, with_script_context(functools.partial(build_figure, name, key, build)))
+        jobs[name] = job
+        span.set(status='queued')
+    pending_figures.append((slot, job))
+
+
+def build_figure(name, key, build):
+    """（ワーカースレッドで）グラフを作り、キャッシュに保存する"""
+    cache = get_figure_cache()
+    with tracing.span('figure.build', chart=name) as span:
+        fig, caption = build()
+        cache.put(key, fig, caption)
+        # ブラウザへ送るグラフのJSONのバイト数（キャッシュに保存したときのサイズ）
+        span.set(bytes=cache.entry_bytes(key))
+    return fig, caption
+
+
+def cancel_figure(name):
+    """セクションを閉じたときに、作成中のグラフのジョブを手放す"""
+    job = st.session_state.get('figure_jobs', {}).pop(name, None)
+    if job is not None:
+        get_query_executor().release(job)
+
+
+def forget_job(job):
+    """手放したジョブを、このセッションのジョブから除く"""
+    jobs = st.session_state.get('figure_jobs', {})
+    for name in [name for name, j in jobs.items() if j is job]:
+        del jobs[name]
+
+
+def show_figure(slot, fig, caption=None):
+    """グラフ（とキャプション）を表示先に表示する（シリアライズして送る時間をトレースに残す）"""
+    with tracing.span('render'), slot.container():
+        if caption:
+            st.caption(caption)
+        st.plotly_chart(fig)
+
+
+def show_figures():
+    """投入したグラフを終わった順に表示する。期限切れ・エラーは表示先にメッセージを出す"""
+    slots = {id(job): slot for slot, job in pending_figures}
+    with tracing.span('figures.wait', charts=len(pending_figures)):
+        for job in get_query_executor().as_completed([job for _, job in pending_figures]):
+            slot = slots[id(job)]
+            try:
+                fig, caption = job.result()
+            except QueryTimeout:
+                # 期限切れで手放したジョブは、次の実行で相乗りし直す（手放したまま待ち直さない）
+                forget_job(job)
+                slot.warning(f'{CHART_QUERY_TIMEOUT:g}秒以内にグラフを作成できませんでした。しばらくしてから再実行してください')
+            except QueryCancelled:
+                slot.info('グラフの作成を取り消しました')
+            except Exception as e:
+                slot.error(f'グラフを作成できませんでした: {e}')
+            else:
+                show_figure(slot, fig, caption)
+    pending_figures.clear()
+
+
+def show_streaming_figures():
+    """ORDERSの読み込みが終わるまで、一定間隔で進捗と途中までの集計のグラフを描き直す
+
+    読み込みが終わったら最後の集計で描き、グラフをキャッシュに保存する（次の実行からはキャッシュを表示する）。
+    選択を変えた場合は、再実行でこの実行ごと止まる。新しいデータバージョンに置き換えられて読み込みが
+    打ち切られた場合は、途中までの集計をキャッシュせずに再実行し、新しいバージョンで描き直す。
+    """
+    if stream_summary is None:
+        return
+    with tracing.span('stream.wait', charts=len(streaming_figures)):
+        while not stream_summary.wait(STREAM_REFRESH_SECONDS):
+            if stream_summary.closed:
+                break
+            stream_progress.progress(stream_summary.progress(), text=f'ORDERSを読み込んでいます: {stream_summary.rows:,} / {stream_summary.total_rows:,}行')
+            for slot, _, build in streaming_figures:
+                show_figure(slot, *build())
+        if stream_summary.closed:
+            streaming_figures.clear()
+            st.rerun()
+        if stream_summary.error is not None:
+            stream_progress.error(f'ORDERSの読み込みに失敗しました（途中までの集計を表示しています）: {stream_summary.error}')
+            streaming_figures.clear()
+            return
+        stream_progress.empty()
+        cache = get_figure_cache()
+        for slot, key, build in streaming_figures:
+            fig, caption = build()
+            # 読み込みが終わったデータバージョンが最新のため、キャッシュのバージョンもそれに揃えて保存する
+            cache.put(key, fig, caption, current=True)
+            show_figure(slot, fig, caption)
+    streaming_figures.clear()
+
+
+def section_fragment(func):
+    """st.experimental_fragment（Streamlit 1.33以降）が使える場合は、セクション内の操作でそのセクションだけを再実行する
+
+    使えない場合もグラフはキャッシュから返すため作り直さない。
+    """
+    fragment = getattr(st, 'experimental_fragment', None)
+    if fragment is None:
+        return func
+
+    @functools.wraps(func)
+    def run():
+        func()
+        # セクションだけの再実行ではページの最後のshow_figuresが呼ばれないため、ここで表示する
+        if getattr(get_script_run_ctx(), 'fragment_ids_this_run', None):
+            show_figures()
+            show_streaming_figures()
+    return fragment(run)
+
+
+def chart_section(anchor, title, name, show_mapping=True):
+    """セクションの見出しを表示し、グラフを表示するか（セクションが開いているか）を返す"""
+    st.markdown(f'<a name="{anchor}"></a>', unsafe_allow_html=True)
+    st.header(title)
+    if show_mapping:
+        # st.expanderを使用してカラム名マッピングを閉じた状態で表示
+        with st.expander("カラム名マッピングを表示", expanded=False):
+            st.write(column_mapping)
+    # 閉じているセクションはグラフを作らない（作成中なら取り消す）
+    is_open = st.toggle('グラフを表示', value=name in CHART_SECTIONS_OPEN, key=f'open_{name}')
+    if not is_open:
+        cancel_figure(name)
+    return is_open
+
+
+# ORDERSの読み込みの進捗（ストリーミングで読み込み中の場合だけ表示する）
+stream_progress = st.empty()
+if stream_summary is not None and not stream_summary.done:
+    stream_progress.progress(stream_summary.progress(), text='ORDERSを読み込んでいます')
 
 
 ############################### 散布図 #####################################
-st.markdown('<a name="section1"></a>', unsafe_allow_html=True)
-st.header('散布図')
-
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
-
-# 日本語のカラム名のリストを選択肢として渡す
-japanese_column_names = list(column_mapping.values())
-selected_x_japanese = st.selectbox('X軸に使用するカラムを選択してください', japanese_column_names, index=0, key='scatter_x')
-selected_y_japanese = st.selectbox('Y軸に使用するカラムを選択してください', japanese_column_names, index=1, key='scatter_y')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_x_english = list(column_mapping.keys())[japanese_column_names.index(selected_x_japanese)]
-selected_y_english = list(column_mapping.keys())[japanese_column_names.index(selected_y_japanese)]
-
-
-# 散布図を表示
-fig = px.scatter(df, x=selected_x_english, y=selected_y_english, title=f'{column_mapping[selected_x_english]} vs {column_mapping[selected_y_english]}')
-st.plotly_chart(fig)
+@section_fragment
+@tracing.traced('section.scatter')
+def scatter_section():
+    if not chart_section('section1', '散布図', 'scatter'):
+        return
+    # 散布図に使えるカラムの日本語名を選択肢として渡し、選択された英語のカラム名を受け取る
+    x = column_selectbox('X軸に使用するカラムを選択してください', key='scatter_x')
+    y = column_selectbox('Y軸に使用するカラムを選択してください', key='scatter_y')
+    section_figure('scatter', data_access.dataset_version(), (x, y), lambda: sections.build_scatter(x, y, active_filters))
+
+
+scatter_section()
 ############################################################################
 
 
 #############################ヒストグラム##################################
-st.markdown('<a name="section2"></a>', unsafe_allow_html=True)
-# ヒストグラムセクション
-st.header('ヒストグラム')
-
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
-
-# ヒストグラムのカラム選択。キーを使って散布図のセレクトボックスと区別します。
-selected_histogram_japanese = st.selectbox('ヒストグラムに使用するカラムを選択してください', japanese_column_names, index=0, key='histogram_select')
-selected_histogram_english = list(column_mapping.keys())[japanese_column_names.index(selected_histogram_japanese)]
-
-# 選択されたカラムに基づいてヒストグラムを描画
-fig = px.histogram(df, x=selected_histogram_english, title=f'{column_mapping[selected_histogram_english]}のヒストグラム')
-st.plotly_chart(fig)
+@section_fragment
+@tracing.traced('section.histogram')
+def histogram_section():
+    if not chart_section('section2', 'ヒストグラム', 'histogram'):
+        return
+    # ヒストグラムのカラム選択。キーを使って散布図のセレクトボックスと区別します。
+    col = column_selectbox('ヒストグラムに使用するカラムを選択してください', key='histogram_select')
+    bins = None
+    if col in NUMERIC_COLUMNS:
+        # ビン数の決め方の日本語名を選択肢として渡し、NumPyのルール名（またはビン数）に戻す
+        label = st.selectbox('ビン数の決め方', list(BIN_RULES.values()), key='histogram_bins')
+        bins = next(rule for rule, rule_label in BIN_RULES.items() if rule_label == label)
+    section_figure('histogram', data_access.dataset_version(), (col,), lambda: sections.build_histogram(col, bins, active_filters), options=(bins,))
+
+
+histogram_section()
 ############################################################################
 
 ##################################箱ひげ図##################################
-st.markdown('<a name="section3"></a>', unsafe_allow_html=True)
-# 箱ひげ図セクション
-st.header('箱ひげ図')
+@section_fragment
+@tracing.traced('section.box')
+def box_section():
+    if not chart_section('section3', '箱ひげ図', 'box'):
+        return
+    # 箱ひげ図のカラム選択。キーを使って他のセレクトボックスと区別します。
+    col = column_selectbox('箱ひげ図に使用するカラムを選択してください', key='boxplot_select')
+    section_figure('box', data_access.dataset_version(), (col,), lambda: sections.build_box(col, active_filters))
 
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
 
-# 箱ひげ図のカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_boxplot_japanese = st.selectbox('箱ひげ図に使用するカラムを選択してください', japanese_column_names, index=0, key='boxplot_select')
-selected_boxplot_english = list(column_mapping.keys())[japanese_column_names.index(selected_boxplot_japanese)]
-
-# 選択されたカラムに基づいて箱ひげ図を描画
-fig = px.box(df, y=selected_boxplot_english, title=f'{column_mapping[selected_boxplot_english]}の箱ひげ図')
-st.plotly_chart(fig)
+box_section()
 #############################################################################
 
 ####################################棒グラフ#################################
-st.markdown('<a name="section4"></a>', unsafe_allow_html=True)
-# 棒グラフセクション
-st.header('棒グラフ')
-# 棒グラフのカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_bar_category_japanese = st.selectbox('棒グラフのカテゴリとして使用するカラムを選択してください', japanese_column_names, index=0, key='bar_category_select')
-# 棒グラフの値カラム選択
-selected_bar_value_japanese = st.selectbox('棒グラフの値として使用するカラムを選択してください', japanese_column_names, index=1, key='bar_value_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_bar_category_english = list(column_mapping.keys())[japanese_column_names.index(selected_bar_category_japanese)]
-selected_bar_value_english = list(column_mapping.keys())[japanese_column_names.index(selected_bar_value_japanese)]
-
-# 選択されたカラムに基づいて棒グラフを描画
-fig = px.bar(df, x=selected_bar_category_english, y=selected_bar_value_english, title=f'{column_mapping[selected_bar_category_english]}による{column_mapping[selected_bar_value_english]}の棒グラフ')
-st.plotly_chart(fig)
+@section_fragment
+@tracing.traced('section.bar')
+def bar_section():
+    if not chart_section('section4', '棒グラフ', 'bar', show_mapping=False):
+        return
+    # 棒グラフのカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
+    category = column_selectbox('棒グラフのカテゴリとして使用するカラムを選択してください', key='bar_category_select')
+    # 棒グラフの値カラム選択（数値のカラムのみ）
+    value = column_selectbox('棒グラフの値として使用するカラムを選択してください', key='bar_value_select')
+    section_figure('bar', data_access.dataset_version(), (category, value), lambda: sections.build_bar(category, value, active_filters), options=(sections.CHART_TOP_N,))
+
+
+bar_section()
 #############################################################################
 
 #####################################円グラフ#################################
-st.markdown('<a name="section5"></a>', unsafe_allow_html=True)
-# 円グラフセクション
-st.header('円グラフ')
-# 円グラフのカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_pie_chart_japanese = st.selectbox('円グラフに使用するカテゴリカラムを選択してください', japanese_column_names, index=0, key='pie_chart_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_pie_chart_english = list(column_mapping.keys())[japanese_column_names.index(selected_pie_chart_japanese)]
-
-# 選択されたカラムに基づいて円グラフを描画
-fig = px.pie(df, names=selected_pie_chart_english, title=f'{column_mapping[selected_pie_chart_english]}の円グラフ')
-st.plotly_chart(fig)
+@section_fragment
+@tracing.traced('section.pie')
+def pie_section():
+    if not chart_section('section5', '円グラフ', 'pie', show_mapping=False):
+        return
+    # 円グラフのカテゴリカラム選択。値の種類が多すぎるカラムは選択肢に含めない
+    col = column_selectbox('円グラフに使用するカテゴリカラムを選択してください', key='pie_chart_select')
+    section_figure('pie', data_access.dataset_version(), (col,), lambda: sections.build_pie(col, active_filters), options=(sections.CHART_TOP_N,))
+
+
+pie_section()
 ###############################################################################
 
 
 ###################################ヒートマップ#################################
-st.markdown('<a name="section6"></a>', unsafe_allow_html=True)
-# ヒートマップセクション
-st.header('ヒートマップ')
-# ヒートマップのX軸カテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_heatmap_x_japanese = st.selectbox('ヒートマップのX軸に使用するカテゴリカラムを選択してください', japanese_column_names, index=0, key='heatmap_x_select')
-# ヒートマップのY軸カテゴリカラム選択。
-selected_heatmap_y_japanese = st.selectbox('ヒートマップのY軸に使用するカテゴリカラムを選択してください', japanese_column_names, index=1, key='heatmap_y_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_heatmap_x_english = list(column_mapping.keys())[japanese_column_names.index(selected_heatmap_x_japanese)]
-selected_heatmap_y_english = list(column_mapping.keys())[japanese_column_names.index(selected_heatmap_y_japanese)]
-
-# データフレームをピボットしてヒートマップ用のデータを準備
-heatmap_df = df.groupby([selected_heatmap_x_english, selected_heatmap_y_english]).size().reset_index(name='counts')
-heatmap_df_pivot = heatmap_df.pivot(index=selected_heatmap_y_english, columns=selected_heatmap_x_english, values='counts')
-
-# ヒートマップを描画
-fig = px.imshow(heatmap_df_pivot, labels=dict(x=column_mapping[selected_heatmap_x_english], y=column_mapping[selected_heatmap_y_english], color="Count"), x=heatmap_df_pivot.columns, y=heatmap_df_pivot.index, aspect="auto", title=f'{column_mapping[selected_heatmap_x_english]}と{column_mapping[selected_heatmap_y_english]}のヒートマップ')
-st.plotly_chart(fig)
+@section_fragment
+@tracing.traced('section.heatmap')
+def heatmap_section():
+    if not chart_section('section6', 'ヒートマップ', 'heatmap', show_mapping=False):
+        return
+    # ヒートマップのX軸・Y軸のカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
+    x = column_selectbox('ヒートマップのX軸に使用するカテゴリカラムを選択してください', key='heatmap_x_select')
+    y = column_selectbox('ヒートマップのY軸に使用するカテゴリカラムを選択してください', key='heatmap_y_select')
+    section_figure('heatmap', data_access.dataset_version(), (x, y), lambda: sections.build_heatmap(x, y, active_filters), options=(sections.CHART_TOP_N,))
+
+
+heatmap_section()
 #############################################################################
 
+# 投入したグラフを、終わったものから順に表示する
+show_figures()
+
+# グラフキャッシュのヒット・ミス・削除の回数（この実行で描画した分まで含める）
+with st.sidebar.expander('グラフキャッシュ', expanded=False):
+    st.write(get_figure_cache().stats())
+    st.write(get_query_executor().stats())
+
 st.markdown('<a name="section7"></a>', unsafe_allow_html=True)
 st.title('Streamlitアプリのユーザー制御について')
 
@@ -275,23 +572,106 @@ StreamlitアプリにDjangoの認証システムを組み込むことで、よ
 
 st.markdown('<a name="section8"></a>', unsafe_allow_html=True)
 
-# APIキーの設定
-openai.api_key = OPENAI_API_KEY
+@st.cache_resource
+def get_chat_metrics():
+    """ChatGPTの応答時間の記録（全セッションで共有）"""
+    return chat.ChatMetricsLog()
+
+
+@st.cache_resource
+def get_response_cache():
+    """ChatGPTの応答キャッシュ（保存先が未設定ならNone）"""
+    if not chat.CHAT_CACHE_DIR:
+        return None
+    return ResponseCache(chat.CHAT_CACHE_DIR, chat.CHAT_CACHE_TTL, chat.CHAT_CACHE_SIZE_MB * 1024 ** 2)
+
+
+@st.cache_resource
+def get_chat_scheduler():
+    """OpenAI APIへの問い合わせの順番待ち（全セッションで共有）"""
+    return ChatScheduler(chat.CHAT_MAX_CONCURRENCY, chat.CHAT_MAX_QUEUE, chat.CHAT_TOKENS_PER_MINUTE)
+
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def chat_summary_blocks(data_version):
+    """ChatGPTに渡すORDERSの要約ブロック（データバージョンごとに集計キューブ等から作る）"""
+    # 上位の顧客だけを集計側で絞り込んで受け取る
+    customers = sections.section_engine(['CUSTOMERNAME', 'SALES']).bar('CUSTOMERNAME', 'SALES', limit=TOP_CUSTOMERS)
+    return build_summary_blocks(data_access.aggregate_cube(data_version), customers)
+
+
+def finish_chat(metrics):
+    # 受信が終わったとき（中断・タイムアウトを含む）に、受け取った分の応答と計測結果を残す
+    get_chat_metrics().record(metrics)
+    st.session_state['chat_answer'] = metrics
+    tracing.current_span().set(
+        status=metrics['status'], ttft=metrics['ttft'], prompt_tokens=metrics['prompt_tokens'],
+        completion_tokens=metrics['completion_tokens'], bytes=len(metrics['text'].encode()),
+    )
+
+
+def chat_caption(metrics):
+    status = {'completed': '完了', 'cached': 'キャッシュ', 'timeout': 'タイムアウト', 'cancelled': '中断', 'error': 'エラー'}[metrics['status']]
+    ttft = '-' if metrics['ttft'] is None else f"{metrics['ttft']:.2f}秒"
+    speed = '-' if metrics['tokens_per_sec'] is None else f"{metrics['tokens_per_sec']:.1f}トークン/秒"
+    tokens = f"トークン数: 入力{metrics['prompt_tokens']:,} / 出力{metrics['completion_tokens']:,}"
+    return f"{status} / 最初の応答まで: {ttft} / 全体: {metrics['elapsed']:.2f}秒 / 受信速度: {speed} / {tokens}"
+
 
 st.title("ChatGPT Demo")
 
 # ユーザーからの入力を受け取る
 user_input = st.text_input("あなたの質問を入力してください:")
+# ORDERSの集計結果（行データではなく要約）をコンテキストとして渡し、データに基づいて回答させる
+grounded = st.toggle('ORDERSのデータに基づいて回答する', key='chat_grounded')
 
-# 「送信」ボタンが押されたら応答を取得する
+# 「送信」ボタンが押されたら、応答を届いた分から表示する
 if st.button("送信"):
-    response = openai.ChatCompletion.create(
-        model="gpt-4-0125-preview",  # 使用するモデルを指定
-        messages=[{"role": "system", "content": "You are a helpful assistant."}, 
-                    {"role": "user", "content": user_input}],
+    # 受信中に押すとスクリプトが再実行され、受信を打ち切る
+    st.button("停止")
+    # 混雑時は順番待ちの位置を表示する
+    queue_status = st.empty()
+    client = scheduled_chat_client(
+        chat.chat_client(), get_chat_scheduler(),
+        on_wait=lambda position: queue_status.info(f'順番待ち: {position}番目') if position else queue_status.empty(),
     )
-    # 応答を表示
-    st.text_area("ChatGPTの応答:", value=response['choices'][0]['message']['content'], height=200, max_chars=None, key=None)
+    messages = chat.build_messages(user_input)
+    if grounded:
+        # 質問に関連する要約ブロックを、トークン数の上限に収まるだけ渡す
+        context, context_titles, context_tokens = build_context(
+            chat_summary_blocks(data_access.dataset_version()), user_input, chat.CHAT_CONTEXT_TOKENS,
+            lambda text: count_tokens(text, chat.CHAT_MODEL),
+        )
+        messages = chat.build_messages(user_input, grounded_system_message(context))
+        with st.expander(f"ChatGPTに渡した集計結果（{context_tokens:,}トークン: {'、'.join(context_titles)}）", expanded=False):
+            st.text(context)
+    # 同じ質問への応答がキャッシュにあれば、問い合わせずにすぐ表示する
+    stream = chat.answer_chat(client, messages, get_response_cache(), on_finish=finish_chat)
+    try:
+        # 順番待ち・応答の受信・表示をまとめてトレースに残す（finish_chatで状態とトークン数を付ける）
+        with tracing.span('chat', model=chat.CHAT_MODEL, grounded=grounded):
+            if chat.CHAT_STREAM:
+                st.write_stream(stream)
+            else:
+                with st.spinner('ChatGPTの応答を待っています...'):
+                    st.text_area("ChatGPTの応答:", value=''.join(stream), height=200)
+    except SchedulerError as e:
+        st.warning(f'混雑しているため、しばらくしてから送信してください（{e}）')
+    except chat.api_error() as e:
+        st.error(f'ChatGPTの応答を取得できませんでした: {e}')
+    else:
+        st.caption(chat_caption(st.session_state['chat_answer']))
+elif 'chat_answer' in st.session_state:
+    # 直前の応答（中断した場合は受け取った分まで）を表示する
+    answer = st.session_state['chat_answer']
+    st.text_area("ChatGPTの応答:", value=answer['text'], height=200)
+    st.caption(chat_caption(answer))
+
+with st.expander('ChatGPTの応答時間・トークン数', expanded=False):
+    st.write(get_chat_metrics().stats())
+    if get_response_cache() is not None:
+        st.write(get_response_cache().stats())
+    st.write(get_chat_scheduler().stats())
 
 
 
@@ -372,356 +752,37 @@ Streamlit in Snowflakeは2023年12月に一般提供が開始されたばかり
 ''')
 
 ###############################サイドバーにソースコードを表示################################
-code = '''
-import snowflake.connector
-import streamlit as st
-import os
-from dotenv import load_dotenv
-import pandas as pd
-import numpy as np
-import plotly.express as px
-import openai
-
-load_dotenv()
-
-# 環境変数ファイルの読み込み
-user = os.getenv('SNOWFLAKE_USER')
-password = os.getenv('SNOWFLAKE_PASSWORD')
-account = os.getenv('SNOWFLAKE_ACCOUNT')
-warehouse = os.getenv('SNOWFLAKE_WAREHOUSE')
-database = os.getenv('SNOWFLAKE_DATABASE')
-schema = os.getenv('SNOWFLAKE_SCHEMA')
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-
-
-# Streamlitアプリのタイトル
-st.title('Snowflake Data Analysis App')
-
-st.text("""
-【アプリ概要】
-Snowflake上のデータ（ORDERSテーブル）を取得し、ユーザーが選択したカラムを多様なグラフで表示する
-""")
-
-# Markdownを使用してリンクを表示
-st.markdown('[今回のLTのきっかけ記事（NTTドコモがStreamlitを社内導入）](https://news.yahoo.co.jp/articles/624de9b79dd9e53164ece15231d6e524a36d8ad4)')
-
-st.markdown('[ソースコード](https://github.com/seiji0906/snowflake-streamlit)')
-st.markdown('[サンプルデータ元](https://www.kaggle.com/datasets/kyanyoga/sample-sales-data?resource=download)')
-
-st.markdown('[Streamlit公式ページ](https://streamlit.io)')
-st.markdown('[Streamlit Cheat Sheet](https://cheat-sheet.streamlit.app)')
-
-# 目次
-st.markdown("""
-# 目次
-1. [散布図](#section1)
-2. [ヒストグラム](#section2)
-3. [箱ひげ図](#section3)
-4. [棒グラフ](#section4)
-5. [円グラフ](#section5)
-6. [ヒートマップ](#section6)
-7. [Streamlitアプリのユーザー制御について](#section7)
-8. [ChatGPT](#section8)
-9. [妄想](#section9)
-10. [AutoGen](#section10)
-""", unsafe_allow_html=True)
-
-
-###### 文字列表示系
-# st.text('Fixed width text')
-# st.markdown('_Markdown_') # see #*
-# st.caption('Balloons. Hundreds of them...')
-# st.write('Most objects') # df, err, func, keras!
-# st.write(['st', 'is <', 3]) # see *
-# st.title('My title')
-# st.header('My header')
-# st.subheader('My sub')
-# st.code('for i in range(8): foo()')
-
-###################snowflakeへ接続########################
-# Snowflakeへの接続情報
-conn_info = {
-    'user': user,
-    'password': password,
-    'account': account,
-    'warehouse': warehouse,
-    'database': database,
-    'schema': schema
-}
-
-# Snowflakeに接続
-conn = snowflake.connector.connect(**conn_info)
-
-    # SQLクエリの実行とDataFrameへの読み込み
-sql_query = "SELECT * FROM orders"
-df = pd.read_sql(sql_query, conn)
-
-# 接続を閉じる
-conn.close()
-#########################################################
-
-
-#####################ORDERSテーブルのカラム名とその日本語のマッピング#######################
-# 英語のカラム名とそれに対応する日本語訳をマッピングしたオブジェクト
-column_mapping = {
-    "ORDERNUMBER": "注文番号",
-    "QUANTITYORDERED": "注文数量",
-    "PRICEEACH": "単価",
-    "ORDERLINENUMBER": "注文行番号",
-    "SALES": "売上",
-    "ORDERDATE": "注文日（データ空です。）",
-    "STATUS": "ステータス",
-    "QTR_ID": "四半期ID",
-    "MONTH_ID": "月ID",
-    "YEAR_ID": "年ID",
-    "PRODUCTLINE": "製品ライン",
-    "MSRP": "希望小売価格",
-    "PRODUCTCODE": "製品コード",
-    "CUSTOMERNAME": "顧客名",
-    "PHONE": "電話番号",
-    "ADDRESSLINE1": "住所1",
-    "ADDRESSLINE2": "住所2",
-    "CITY": "市区町村",
-    "STATE": "都道府県",
-    "POSTALCODE": "郵便番号",
-    "COUNTRY": "国",
-    "TERRITORY": "地域",
-    "CONTACTLASTNAME": "担当者姓",
-    "CONTACTFIRSTNAME": "担当者名",
-    "DEALSIZE": "取引規模"
-}
-############################################################################################
-
-
-
-############################### 散布図 #####################################
-st.markdown('<a name="section1"></a>', unsafe_allow_html=True)
-st.header('散布図')
-
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
-
-# 日本語のカラム名のリストを選択肢として渡す
-japanese_column_names = list(column_mapping.values())
-selected_x_japanese = st.selectbox('X軸に使用するカラムを選択してください', japanese_column_names, index=0, key='scatter_x')
-selected_y_japanese = st.selectbox('Y軸に使用するカラムを選択してください', japanese_column_names, index=1, key='scatter_y')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_x_english = list(column_mapping.keys())[japanese_column_names.index(selected_x_japanese)]
-selected_y_english = list(column_mapping.keys())[japanese_column_names.index(selected_y_japanese)]
-
-
-# 散布図を表示
-fig = px.scatter(df, x=selected_x_english, y=selected_y_english, title=f'{column_mapping[selected_x_english]} vs {column_mapping[selected_y_english]}')
-st.plotly_chart(fig)
-############################################################################
-
-
-#############################ヒストグラム##################################
-st.markdown('<a name="section2"></a>', unsafe_allow_html=True)
-# ヒストグラムセクション
-st.header('ヒストグラム')
-
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
-
-# ヒストグラムのカラム選択。キーを使って散布図のセレクトボックスと区別します。
-selected_histogram_japanese = st.selectbox('ヒストグラムに使用するカラムを選択してください', japanese_column_names, index=0, key='histogram_select')
-selected_histogram_english = list(column_mapping.keys())[japanese_column_names.index(selected_histogram_japanese)]
-
-# 選択されたカラムに基づいてヒストグラムを描画
-fig = px.histogram(df, x=selected_histogram_english, title=f'{column_mapping[selected_histogram_english]}のヒストグラム')
-st.plotly_chart(fig)
-############################################################################
-
-##################################箱ひげ図##################################
-st.markdown('<a name="section3"></a>', unsafe_allow_html=True)
-# 箱ひげ図セクション
-st.header('箱ひげ図')
-
-# st.expanderを使用してカラム名マッピングを閉じた状態で表示
-with st.expander("カラム名マッピングを表示", expanded=False):
-    st.write(column_mapping)
-
-# 箱ひげ図のカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_boxplot_japanese = st.selectbox('箱ひげ図に使用するカラムを選択してください', japanese_column_names, index=0, key='boxplot_select')
-selected_boxplot_english = list(column_mapping.keys())[japanese_column_names.index(selected_boxplot_japanese)]
-
-# 選択されたカラムに基づいて箱ひげ図を描画
-fig = px.box(df, y=selected_boxplot_english, title=f'{column_mapping[selected_boxplot_english]}の箱ひげ図')
-st.plotly_chart(fig)
-#############################################################################
-
-####################################棒グラフ#################################
-st.markdown('<a name="section4"></a>', unsafe_allow_html=True)
-# 棒グラフセクション
-st.header('棒グラフ')
-# 棒グラフのカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_bar_category_japanese = st.selectbox('棒グラフのカテゴリとして使用するカラムを選択してください', japanese_column_names, index=0, key='bar_category_select')
-# 棒グラフの値カラム選択
-selected_bar_value_japanese = st.selectbox('棒グラフの値として使用するカラムを選択してください', japanese_column_names, index=1, key='bar_value_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_bar_category_english = list(column_mapping.keys())[japanese_column_names.index(selected_bar_category_japanese)]
-selected_bar_value_english = list(column_mapping.keys())[japanese_column_names.index(selected_bar_value_japanese)]
-
-# 選択されたカラムに基づいて棒グラフを描画
-fig = px.bar(df, x=selected_bar_category_english, y=selected_bar_value_english, title=f'{column_mapping[selected_bar_category_english]}による{column_mapping[selected_bar_value_english]}の棒グラフ')
-st.plotly_chart(fig)
-#############################################################################
-
-#####################################円グラフ#################################
-st.markdown('<a name="section5"></a>', unsafe_allow_html=True)
-# 円グラフセクション
-st.header('円グラフ')
-# 円グラフのカテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_pie_chart_japanese = st.selectbox('円グラフに使用するカテゴリカラムを選択してください', japanese_column_names, index=0, key='pie_chart_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_pie_chart_english = list(column_mapping.keys())[japanese_column_names.index(selected_pie_chart_japanese)]
-
-# 選択されたカラムに基づいて円グラフを描画
-fig = px.pie(df, names=selected_pie_chart_english, title=f'{column_mapping[selected_pie_chart_english]}の円グラフ')
-st.plotly_chart(fig)
-###############################################################################
-
-
-###################################ヒートマップ#################################
-st.markdown('<a name="section6"></a>', unsafe_allow_html=True)
-# ヒートマップセクション
-st.header('ヒートマップ')
-# ヒートマップのX軸カテゴリカラム選択。キーを使って他のセレクトボックスと区別します。
-selected_heatmap_x_japanese = st.selectbox('ヒートマップのX軸に使用するカテゴリカラムを選択してください', japanese_column_names, index=0, key='heatmap_x_select')
-# ヒートマップのY軸カテゴリカラム選択。
-selected_heatmap_y_japanese = st.selectbox('ヒートマップのY軸に使用するカテゴリカラムを選択してください', japanese_column_names, index=1, key='heatmap_y_select')
-
-# 選択された日本語名から英語のカラム名を逆引き
-selected_heatmap_x_english = list(column_mapping.keys())[japanese_column_names.index(selected_heatmap_x_japanese)]
-selected_heatmap_y_english = list(column_mapping.keys())[japanese_column_names.index(selected_heatmap_y_japanese)]
-
-# データフレームをピボットしてヒートマップ用のデータを準備
-heatmap_df = df.groupby([selected_heatmap_x_english, selected_heatmap_y_english]).size().reset_index(name='counts')
-heatmap_df_pivot = heatmap_df.pivot(index=selected_heatmap_y_english, columns=selected_heatmap_x_english, values='counts')
-
-# ヒートマップを描画
-fig = px.imshow(heatmap_df_pivot, labels=dict(x=column_mapping[selected_heatmap_x_english], y=column_mapping[selected_heatmap_y_english], color="Count"), x=heatmap_df_pivot.columns, y=heatmap_df_pivot.index, aspect="auto", title=f'{column_mapping[selected_heatmap_x_english]}と{column_mapping[selected_heatmap_y_english]}のヒートマップ')
-st.plotly_chart(fig)
-#############################################################################
-
-st.markdown('<a name="section7"></a>', unsafe_allow_html=True)
-st.title('Streamlitアプリのユーザー制御について')
-
-st.markdown("""
-
-『streamlitのアプリ内で、ユーザー制御を行い、ユーザーによって閲覧するデータを制限する方法を最新の情報をもとに調査してください。』
-
-**ChatGPT**
-
-『Streamlitにおけるユーザー制御とデータアクセスの制限には複数のアプローチがあります。以下に、最新情報に基づいた方法を紹介します。
-
-### **1. Streamlitのセキュリティ機能**（[参考元資料](https://streamlit.io/security)）
-
-Streamlitは、GitHubやGSuiteなどのSSOプロバイダーを通じたアクセスとサインインを行います。また、AES256を使用してセンシティブな顧客データ（例：シークレット、認証トークン）を暗号化し、データを保護します。さらに、権限とロールベースのアクセスコントロールを通じて、GitHubで割り当てられた権限を引き継ぎ、アプリの変更やデプロイが可能なユーザーを制限します。
-
-### **2. Streamlit-Authenticator**（[参考元資料](https://blog.streamlit.io/streamlit-authenticator-part-1-adding-an-authentication-component-to-your-app/)）
-
-Streamlit-Authenticatorは、ユーザー認証をアプリに追加するためのコンポーネントです。YAMLファイルにユーザー情報を定義し、ハッシュ化されたパスワードとともに認証オブジェクトを作成します。ログインウィジェットをレンダリングして認証状態を管理し、ユーザー名に基づいて個々のユーザーに特化した体験を提供することが可能です。
-
-### **3. Djangoを使用したユーザー制御**（[参考元資料](https://www.the-analytics.club/streamlit-advanced-authentication/)）
-
-StreamlitアプリにDjangoの認証システムを組み込むことで、より強力なユーザー管理とデータアクセス制御を実現します。Djangoの管理インターフェイスを利用して、新しいユーザーやユーザーグループの作成、グループメンバーシップの管理ができます。また、特定のダッシュボードへのアクセスをユーザーのロールに基づいて制限することができます。
-
-### **4. 単純なパスワードベースの認証**（[参考元資料](https://docs.streamlit.io/knowledge-base/deploy/authentication-without-sso)）
-
-**`.streamlit/secrets.toml`**ファイルにパスワードを設定し、Streamlitアプリでこのパスワードを要求することで、簡易的なユーザー認証を実現することも可能です。クラウドにデプロイされたアプリでは、Streamlitのシークレット管理機能を利用して、このパスワードをアプリに渡します。
-
-### **5. st.experimental_userを使ったユーザー情報の取得**（[参考元資料](https://docs.streamlit.io/library/api-reference/personalization/st.experimental_user)）
-
-**`st.experimental_user`**は、現在のユーザーに関する情報をアクセスするための読み取り専用の辞書ライクなオブジェクトです。これを利用することで、ログインしているユーザーのメールアドレスに基づいてアプリのコンテンツをカスタマイズすることができます。ただし、この機能は実験的なものであり、APIは変更される可能性があることに注意が必要です。』
-            """)
-
-# .streamlit/secrets.toml
-# openai_api_key = "YOUR_OPENAI_API_KEY"
-
-st.markdown('<a name="section8"></a>', unsafe_allow_html=True)
-
-# APIキーの設定
-openai.api_key = OPENAI_API_KEY
-
-st.title("ChatGPT Demo")
-
-# ユーザーからの入力を受け取る
-user_input = st.text_input("あなたの質問を入力してください:")
-
-# 「送信」ボタンが押されたら応答を取得する
-if st.button("送信"):
-    response = openai.ChatCompletion.create(
-        model="gpt-4-0125-preview",  # 使用するモデルを指定
-        messages=[{"role": "system", "content": "You are a helpful assistant."}, 
-                    {"role": "user", "content": user_input}],
-    )
-    # 応答を表示
-    st.text_area("ChatGPTの応答:", value=response['choices'][0]['message']['content'], height=200, max_chars=None, key=None)
-
-
-
-
-st.markdown('<a name="section9"></a>', unsafe_allow_html=True)
-st.title('妄想')
-
-st.markdown("""
-Azure上に売上データ等で、RAGを構築してGPT(AzureOpenAI)に参照させて、（かつ、AutoGenとかでGPT同士の会話を見ながら、簡易的なデータ分析ができる？？（←現状、コストと得られるものが見合わないかも。。）
-加えて、autoGenでプログラミングのお願いをすると、openinterpreterのように、ローカル上でパッケージ等をインストールするので、環境をめちゃくちゃにされる可能性。ユーザーに使用させるのには向かないかも。
-""")
-
-
-######################AutoGenを利用#########################
-
-st.markdown('<a name="section10"></a>', unsafe_allow_html=True)
-
-# from autogen import AssistantAgent, UserProxyAgent, config_list_from_json
-
-# # OAI_CONFIG_LIST.jsonファイルに設定を記述
-
-# # Load LLM inference endpoints from an env variable or a file
-# # See https://microsoft.github.io/autogen/docs/FAQ#set-your-api-endpoints
-# # and OAI_CONFIG_LIST_sample.json
-# config_list = config_list_from_json(env_or_file="OAI_CONFIG_LIST.json")
-# assistant = AssistantAgent("assistant", llm_config={"config_list": config_list})
-# user_proxy = UserProxyAgent("user_proxy", code_execution_config={"work_dir": "coding", "use_docker": False}) # IMPORTANT: set to True to run code in docker, recommended
-# user_proxy.initiate_chat(assistant, message="NVIDIAのここ5年間の株価をプロットします。")
-# # This initiates an automated chat between the two agents to solve the task
-# import streamlit as st
-# from autogen import AssistantAgent, UserProxyAgent
-
-# # Initialize your AutoGen setup
-# # config_list = config_list_from_json(env_or_file="OAI_CONFIG_LIST.json")
-# assistant = AssistantAgent("assistant", llm_config={"config_list": [{"model": "gpt-4", "api_key": OPENAI_API_KEY}, {"model": "gpt-3.5-turbo", "api_key": OPENAI_API_KEY}]})
-# user_proxy = UserProxyAgent("user_proxy", code_execution_config={"work_dir": "coding", "use_docker": False})  # IMPORTANT: set to True to run code in docker, recommended
-
-# def initiate_chat(message):
-#     # This function will handle the chat initiation and return the assistant's response
-#     # Note: This is a placeholder function. You'll need to adapt it to your actual AutoGen setup and ensure it captures and returns the assistant's response correctly.
-#     response = "This is where you'll display the assistant's response."
-#     return response
-
-# # Streamlit UI
-# st.title("AutoGen Integration Example")
-
-# # User input
-# user_message = st.text_input("Enter your message:", "")
-
-# # Button to initiate chat
-# if st.button("Send"):
-#     # Initiate chat with the assistant and capture the response
-#     response = initiate_chat(user_message)
-    
-#     # Display the response
-#     st.text_area("Assistant's Response:", value=response, height=300)
-
-# # Note: This is a simplified example. The actual implementation of the initiate_chat function
-# # will depend on how you've set up your AutoGen configuration and how you handle the chat logic.
-'''
-st.sidebar.code(code, language='python')
+@st.cache_data(show_spinner=False)
+def read_source(path, mtime):
+    """サイドバーに表示するソースコード（ファイルが更新されるまでキャッシュする）"""
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+app_path = os.path.abspath(__file__)
+st.sidebar.code(read_source(app_path, os.path.getmtime(app_path)), language='python')
+
+# ストリーミングで読み込み中なら、読み込みが終わるまでグラフを描き直す
+# （待っている間もChatGPT等の他の部分を使えるよう、ページをすべて描いてから最後に行う）
+show_streaming_figures()
+
+# この実行の処理時間の内訳を記録し、パネルが開いていればサイドバーに表示する
+trace.finish()
+trace_records = get_trace_log().record(trace)
+if show_trace:
+    with trace_panel:
+        st.caption(f"全体: {trace.root.duration * 1000:,.0f} ms / スパン数: {len(trace_records)}")
+        st.dataframe(
+            [
+                {
+                    'スパン': '　' * r['depth'] + r['span'],
+                    'ms': r['duration_ms'],
+                    'bytes': r.get('bytes'),
+                    'rows': r.get('rows'),
+                }
+                for r in trace_records
+            ],
+            hide_index=True,
+        )
+        st.download_button('JSON Linesで保存', tracing.to_jsonl(trace_records), file_name=f'trace-{trace.trace_id}.jsonl')
+        st.download_button('Prometheus形式で保存', get_trace_log().prometheus(), file_name='app_spans.prom')
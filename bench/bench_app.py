@@ -0,0 +1,205 @@
+"""ORDERSの行数を変えてアプリ全体（app.py）を動かすベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_app --rows 10000,100000,1000000 --json bench_app.json
+    python -m bench.bench_app --rows 100000 --compare bench_app.json   # 前回の結果と比べる
+
+行数ごとに合成ORDERSをsqliteへ書き出し（--data-dirに既にあれば再利用）、bench.local_snowflake を
+バックエンドとして登録したうえで、StreamlitのAppTestで全セクションを開いた状態のapp.pyを実行する。
+計測するのは次の値で、行数ごとに別プロセスで実行する。
+    load_seconds: ORDERSの取得（query_orders）にかかった秒数の合計
+    first_run_seconds: 最初の実行（取得・集計・全グラフの作成を含む）の秒数
+    peak_rss_mb / peak_rss_delta_mb: ピークRSSと、アプリの実行前からの増分
+    build_seconds: グラフごとの作成（トレースのfigure.build）の秒数
+    payload_bytes: グラフごとにブラウザへ送るメッセージのバイト数（payload_total_bytesは全要素の合計）
+    rerun: 何も操作しない再実行と、セレクトボックスを変えたときの再実行の秒数
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+from bench.bench_fetch import _peak_rss_mb, _reset_peak_rss
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECTIONS = ['scatter', 'histogram', 'box', 'bar', 'pie', 'heatmap']
+# 再実行の計測で操作するセレクトボックス（キー, 選ぶ選択肢のインデックス）
+INTERACTIONS = [('scatter_x', 2), ('histogram_select', 2), ('bar_category_select', 2), ('heatmap_y_select', 2)]
+
+
+def _payload_bytes(node):
+    """要素ツリーの各要素のメッセージのバイト数の合計"""
+    proto = getattr(node, 'proto', None)
+    size = proto.ByteSize() if proto is not None and not getattr(node, 'children', None) else 0
+    return size + sum(_payload_bytes(child) for child in getattr(node, 'children', {}).values())
+
+
+def _run(db_path, options, result_queue):
+    os.chdir(ROOT)
+    from streamlit.testing.v1 import AppTest
+
+    import data_access
+    import tracing
+    from bench import local_snowflake
+
+    local_snowflake.register(db_path, options['latency'])
+
+    loads = []
+    query_orders = data_access.query_orders
+
+    def timed_query_orders(sql_query, backend=None):
+        start = time.perf_counter()
+        df = query_orders(sql_query, backend)
+        loads.append(time.perf_counter() - start)
+        return df
+
+    data_access.query_orders = timed_query_orders
+
+    # グラフの作成はワーカースレッドで行われるため、トレースのfigure.buildのスパンから秒数を取る
+    builds = []
+    record = tracing.TraceLog.record
+
+    def recording(self, trace):
+        records = record(self, trace)
+        builds.extend((r['chart'], r['duration_ms'] / 1000) for r in records if r['span'] == 'figure.build')
+        return records
+
+    tracing.TraceLog.record = recording
+
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=options['timeout'])
+    _reset_peak_rss()
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    at.run()
+    first_run = time.perf_counter() - start
+    if at.exception:
+        result_queue.put({'rows': options['rows'], 'error': [e.message for e in at.exception]})
+        return
+
+    charts = at.get('plotly_chart')
+    result = {
+        'rows': options['rows'],
+        'engine': options['engine'],
+        'latency': options['latency'],
+        'load_seconds': round(sum(loads), 3),
+        'first_run_seconds': round(first_run, 3),
+        'build_seconds': {name: round(seconds, 4) for name, seconds in builds},
+        'payload_bytes': {name: chart.proto.ByteSize() for name, chart in zip(SECTIONS, charts)},
+        'payload_total_bytes': _payload_bytes(at._tree),
+    }
+
+    plain = []
+    for _ in range(options['reruns']):
+        start = time.perf_counter()
+        at.run()
+        plain.append(time.perf_counter() - start)
+    interactions = {}
+    for key, index in INTERACTIONS:
+        builds.clear()
+        start = time.perf_counter()
+        at.selectbox(key=key).select_index(index).run()
+        interactions[key] = {
+            'seconds': round(time.perf_counter() - start, 3),
+            'builds': [name for name, _ in builds],
+        }
+    result['rerun'] = {
+        'plain_p50_seconds': round(statistics.median(plain), 3),
+        'plain_max_seconds': round(max(plain), 3),
+        'interactions': interactions,
+    }
+    result['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+    result['peak_rss_delta_mb'] = round(result['peak_rss_mb'] - baseline, 1)
+    result['queries'] = len(local_snowflake.executed_queries())
+    result_queue.put(result)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results, baseline_file):
+    """前回の結果（同じ行数）との比を表示する"""
+    with open(baseline_file) as f:
+        baseline = {r['rows']: r for r in json.load(f)['results'] if 'error' not in r}
+    for r in results:
+        before = baseline.get(r['rows'])
+        if before is None or 'error' in r:
+            continue
+        for key in ('load_seconds', 'first_run_seconds', 'peak_rss_delta_mb', 'payload_total_bytes'):
+            if before.get(key):
+                print(f"{r['rows']:>10,} rows  {key:<20} {before[key]:>12} -> {r[key]:>12}  ({r[key] / before[key]:.2f}x)")
+        key = 'plain_p50_seconds'
+        if before['rerun'].get(key):
+            print(f"{r['rows']:>10,} rows  rerun {key:<14} {before['rerun'][key]:>12} -> {r['rerun'][key]:>12}  "
+                  f"({r['rerun'][key] / before['rerun'][key]:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10000,100000', help='合成ORDERSの行数（カンマ区切り）')
+    parser.add_argument('--engine', default='sql', choices=['sql', 'pandas'], help='グラフの集計方法（AGGREGATION_ENGINE）')
+    parser.add_argument('--latency', type=float, default=0.0, help='クエリごとに入れる遅延（秒）')
+    parser.add_argument('--reruns', type=int, default=5, help='何も操作しない再実行の回数')
+    parser.add_argument('--timeout', type=float, default=600, help='1回の実行の待ち時間の上限（秒）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='合成ORDERSのsqliteを置くディレクトリ（未指定なら一時ディレクトリ）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    parser.add_argument('--compare', help='比較する前回の結果（--jsonで書き出したファイル）')
+    args = parser.parse_args()
+
+    from bench.synthetic_orders import write_sqlite
+
+    # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+    os.environ.update(
+        DATA_BACKEND='local_snowflake',
+        CHART_SECTIONS_OPEN=','.join(SECTIONS),
+        AGGREGATION_ENGINE=args.engine,
+        # 前回の実行の結果を使わないよう、スナップショットと応答キャッシュは保存しない
+        ORDERS_SNAPSHOT_DIR='',
+        CHAT_CACHE_DIR='',
+        QUERY_CACHE_DIR='',
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for rows in [int(r) for r in args.rows.split(',')]:
+            db_path = os.path.join(data_dir, f'orders_{rows}_{args.seed}.db')
+            if not os.path.exists(db_path):
+                write_sqlite(db_path, rows, args.seed)
+            options = {
+                'rows': rows, 'engine': args.engine, 'latency': args.latency,
+                'reruns': args.reruns, 'timeout': args.timeout,
+            }
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=_run, args=(db_path, options, result_queue))
+            proc.start()
+            result = result_queue.get()
+            proc.join()
+            results.append(result)
+            if 'error' in result:
+                print(f"{rows:>10,} rows  error: {result['error']}")
+                continue
+            print(f"{rows:>10,} rows  load {result['load_seconds']:>7.3f} s  first run {result['first_run_seconds']:>7.3f} s  "
+                  f"rerun p50 {result['rerun']['plain_p50_seconds']:>6.3f} s  peak RSS +{result['peak_rss_delta_mb']:.1f} MB  "
+                  f"payload {result['payload_total_bytes'] / 1024:.1f} KB")
+
+    if args.compare:
+        _compare(results, args.compare)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': _git_commit(), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
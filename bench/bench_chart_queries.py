@@ -0,0 +1,196 @@
+"""グラフのクエリを並行して実行する（query_executor）ベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_chart_queries --latency 0.5 --workers 1,4 --json chart_queries.json
+
+bench.local_snowflake をバックエンドとして登録し、クエリごとに遅延（--latency秒）を入れて次を計る。
+それぞれ別プロセスで実行する（設定はモジュールの読み込み時に環境変数から読まれるため）。
+    queries: 6つのグラフが別々のクエリを実行する場合を真似て、既定の選択の集計・射影クエリを
+             QueryExecutorに投入し、全部が返るまでの秒数と、グラフごとに結果が届いた時刻を計る
+             （workers=1が順番に実行した場合に相当する）
+    app: 全セクションを開いたapp.pyをAppTestで実行し、最初のグラフ・最後のグラフを送るまでの秒数と全体の秒数
+    cancel: 実行中のクエリを取り消してからワーカーが空くまでの秒数と、ウェアハウス側で取り消されたか。
+            期限（--timeout）を過ぎたジョブが期限どおりに返るか。相乗りしたジョブは、期限切れで
+            1つのセッションが手放しても実行を続け、全員が手放したら取り消されるか
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECTIONS = ['scatter', 'histogram', 'box', 'bar', 'pie', 'heatmap']
+
+
+def _chart_queries(engine):
+    """グラフごとのクエリ（既定の選択）。グラフ名 -> 結果を返す関数"""
+    import data_access
+
+    return {
+        'scatter': lambda: data_access.execute_query('SELECT QUANTITYORDERED, PRICEEACH FROM ORDERS'),
+        'histogram': lambda: engine.histogram('SALES'),
+        'box': lambda: data_access.execute_query('SELECT SALES FROM ORDERS WHERE SALES IS NOT NULL'),
+        'bar': lambda: engine.bar('PRODUCTLINE', 'SALES'),
+        'pie': lambda: engine.pie('STATUS'),
+        'heatmap': lambda: engine.heatmap('COUNTRY', 'YEAR_ID'),
+    }
+
+
+def _queries(options):
+    import data_access
+    from aggregation import SqlAggregationEngine
+    from query_executor import QueryExecutor
+
+    engine = SqlAggregationEngine(data_access.execute_query, dialect='sqlite')
+    executor = QueryExecutor(options['workers'], timeout=0)
+    start = time.perf_counter()
+    jobs = {executor.submit(name, func): name for name, func in _chart_queries(engine).items()}
+    arrivals = {}
+    for job in executor.as_completed(list(jobs)):
+        job.result()
+        arrivals[jobs[job]] = round(time.perf_counter() - start, 3)
+    return {'wall_seconds': round(time.perf_counter() - start, 3), 'arrivals': arrivals}
+
+
+def _app(options):
+    from streamlit.runtime.scriptrunner.script_run_context import ScriptRunContext
+    from streamlit.testing.v1 import AppTest
+
+    charts = []
+    enqueue = ScriptRunContext.enqueue
+
+    def timed_enqueue(self, msg):
+        if msg.HasField('delta') and msg.delta.new_element.WhichOneof('type') == 'plotly_chart':
+            charts.append(time.perf_counter())
+        return enqueue(self, msg)
+
+    ScriptRunContext.enqueue = timed_enqueue
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=options['timeout'] + 600)
+    start = time.perf_counter()
+    at.run()
+    end = time.perf_counter()
+    return {
+        'error': [e.message for e in at.exception] or None,
+        'charts': len(at.get('plotly_chart')),
+        'first_chart_seconds': round(charts[0] - start, 3) if charts else None,
+        'last_chart_seconds': round(charts[-1] - start, 3) if charts else None,
+        'full_run_seconds': round(end - start, 3),
+    }
+
+
+def _cancel(options):
+    import data_access
+    from bench import local_snowflake
+    from query_executor import QueryExecutor, QueryTimeout
+
+    sql_query = 'SELECT PRODUCTLINE, SUM(SALES) AS SALES FROM ORDERS GROUP BY PRODUCTLINE'
+    executor = QueryExecutor(1, timeout=0)
+    job = executor.submit('cancel', lambda: data_access.execute_query(sql_query))
+    time.sleep(min(0.1, options['latency'] / 2))
+    start = time.perf_counter()
+    executor.release(job)
+    # 次のジョブが始まれば、取り消したジョブのワーカーが空いたことになる
+    executor.submit('next', lambda: None).future.result()
+    freed = time.perf_counter() - start
+
+    executor = QueryExecutor(1, timeout=options['timeout'])
+    start = time.perf_counter()
+    job = executor.submit('timeout', lambda: data_access.execute_query(sql_query + ' ORDER BY 1'))
+    next(executor.as_completed([job]))
+    try:
+        job.result()
+        timed_out = False
+    except QueryTimeout:
+        timed_out = True
+
+    # 相乗りしているジョブは、1つのセッションが期限切れで手放しても、もう1つのセッションのために実行を続ける
+    executor = QueryExecutor(1, timeout=options['timeout'])
+    job = executor.submit('shared', lambda: data_access.execute_query(sql_query + ' ORDER BY 2'))
+    executor.submit('shared', lambda: None)
+    next(executor.as_completed([job]))
+    shared_kept_running = job.reason is None
+    next(executor.as_completed([job]))
+    return {
+        'cancel_freed_seconds': round(freed, 3),
+        'aborted_queries': len(local_snowflake.aborted_queries()),
+        'timeout': options['timeout'],
+        'timed_out': timed_out,
+        'timeout_returned_seconds': round(time.perf_counter() - start, 3),
+        'shared_timeout_kept_running': shared_kept_running,
+        'shared_timeout_cancelled': job.reason == 'timeout',
+    }
+
+
+def _run(phase, db_path, options, result_queue):
+    os.chdir(ROOT)
+    from bench import local_snowflake
+
+    local_snowflake.register(db_path, options['latency'])
+    result = {'phase': phase, 'workers': options['workers']}
+    result.update({'queries': _queries, 'app': _app, 'cancel': _cancel}[phase](options))
+    result['executed_queries'] = len(local_snowflake.executed_queries())
+    result_queue.put(result)
+
+
+def _spawn(ctx, phase, db_path, options):
+    # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+    os.environ['CHART_QUERY_WORKERS'] = str(options['workers'])
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(phase, db_path, options, result_queue))
+    proc.start()
+    result = result_queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000, help='合成ORDERSの行数')
+    parser.add_argument('--latency', type=float, default=0.5, help='クエリごとに入れる遅延（秒）')
+    parser.add_argument('--workers', default='1,4', help='同時に実行するクエリの数（カンマ区切り）')
+    parser.add_argument('--timeout', type=float, default=0.3, help='cancelで使うジョブの期限（秒。--latencyより短くする）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    from bench.synthetic_orders import write_sqlite
+
+    os.environ.update(
+        DATA_BACKEND='local_snowflake',
+        CHART_SECTIONS_OPEN=','.join(SECTIONS),
+        # 前回の実行の結果を使わないよう、スナップショットとクエリキャッシュは保存しない
+        ORDERS_SNAPSHOT_DIR='',
+        CHAT_CACHE_DIR='',
+        QUERY_CACHE_DIR='',
+        POOL_SIZE=str(max(int(w) for w in args.workers.split(',')) + 1),
+    )
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows)
+        for workers in [int(w) for w in args.workers.split(',')]:
+            options = {'workers': workers, 'latency': args.latency, 'timeout': args.timeout}
+            for phase in ('queries', 'app'):
+                result = _spawn(ctx, phase, db_path, options)
+                results.append(result)
+                if phase == 'queries':
+                    print(f"workers {workers}  queries: all {result['wall_seconds']:.3f} s  arrivals {result['arrivals']}")
+                else:
+                    print(f"workers {workers}  app: first chart {result['first_chart_seconds']} s  "
+                          f"last chart {result['last_chart_seconds']} s  full run {result['full_run_seconds']} s  "
+                          f"charts {result['charts']}  error {result['error']}")
+        result = _spawn(ctx, 'cancel', db_path, {'workers': 1, 'latency': args.latency, 'timeout': args.timeout})
+        results.append(result)
+        print(f"cancel: worker freed after {result['cancel_freed_seconds']} s  aborted {result['aborted_queries']}  "
+              f"timeout {result['timeout']} s -> returned after {result['timeout_returned_seconds']} s "
+              f"(timed out: {result['timed_out']})  shared job: kept running after one timeout "
+              f"{result['shared_timeout_kept_running']}, cancelled after both {result['shared_timeout_cancelled']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rows': args.rows, 'latency': args.latency, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""ChatSchedulerの負荷試験（フェイクのOpenAIサーバーに対して実行する）
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_chat_scheduler --users 20 --error-rate 0.3
+    python -m bench.bench_chat_scheduler --users 20 --no-scheduler   # 順番待ち・リトライ無しと比較する
+
+複数のユーザーが同時に質問した状況を、スレッドで再現する。429を一定の割合で返すサーバーに対して、
+成功・失敗の数、リトライ回数、サーバー側で同時に応答中だった数の最大、応答時間を出力する。
+"""
+import argparse
+import json
+import threading
+import time
+
+import openai
+
+import chat
+from bench.fake_openai_server import start_server
+from chat_scheduler import ChatScheduler, ScheduledChatClient
+from tokens import count_message_tokens, count_tokens
+
+
+def run(users, error_rate, first_token_delay, token_delay, tokens, concurrency, tokens_per_minute, use_scheduler, seed):
+    server, api_base = start_server(
+        first_token_delay=first_token_delay, token_delay=token_delay, tokens=tokens, error_rate=error_rate, seed=seed,
+    )
+    scheduler = ChatScheduler(concurrency, max_queue=users, tokens_per_minute=tokens_per_minute)
+    results = []
+    lock = threading.Lock()
+
+    def user(i):
+        client = chat.OpenAIChatClient(api_key='dummy', api_base=api_base)
+        if use_scheduler:
+            client = ScheduledChatClient(client, scheduler, count_message_tokens, count_tokens, expected_completion_tokens=tokens, max_backoff=2.0)
+        record = {}
+        try:
+            for _ in chat.stream_chat(client, chat.build_messages(f'質問{i}'), model='gpt-4', timeout=60, on_finish=record.update):
+                pass
+        except openai.error.OpenAIError as e:
+            record['error'] = type(e).__name__
+        with lock:
+            results.append(record)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    server.shutdown()
+
+    done = sorted(r['elapsed'] for r in results if r.get('status') == 'completed')
+    return {
+        'users': users,
+        'scheduler': use_scheduler,
+        'completed': len(done),
+        'errors': sum(1 for r in results if 'error' in r),
+        'server_requests': {str(k): v for k, v in server.RequestHandlerClass.counts.items() if k != 'in_flight'},
+        'scheduler_stats': scheduler.stats() if use_scheduler else None,
+        'elapsed_p50_s': round(done[len(done) // 2], 3) if done else None,
+        'elapsed_max_s': round(done[-1], 3) if done else None,
+        'wall_s': round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.3, help='サーバーが429を返す割合')
+    parser.add_argument('--first-token-delay', type=float, default=0.3)
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=chat.CHAT_MAX_CONCURRENCY)
+    parser.add_argument('--tokens-per-minute', type=int, default=chat.CHAT_TOKENS_PER_MINUTE)
+    parser.add_argument('--no-scheduler', action='store_true', help='順番待ち・リトライ無しで直接問い合わせる')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+    result = run(
+        args.users, args.error_rate, args.first_token_delay, args.token_delay, args.tokens,
+        args.concurrency, args.tokens_per_minute, not args.no_scheduler, args.seed,
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
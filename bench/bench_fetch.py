@@ -0,0 +1,158 @@
+"""DBAPIの行（pd.read_sql相当）とArrowでの取得の比較ベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_fetch --rows 500000
+    python -m bench.bench_fetch --backend snowflake   # 実際のSnowflakeで比較する
+
+--backend を指定しない場合は、合成ORDERSを返すローカルのカーソルで比較する。
+ローカルのカーソルはコネクタと同様に、fetchallではArrowの結果をPythonのタプルに展開して返す。
+どちらのパスも同じカーソル（同じ種類・同じ行）で同じクエリを実行し、次の3つを分けて計測する。
+    execute: クエリの実行
+    fetch: 結果の受け取り（read_sql: fetchallでタプルのリスト、arrow: fetch_arrow_allでArrowのTable）
+    convert: DataFrameへの変換とカラムの型揃え（read_sql: pd.read_sqlと同じくfrom_records、arrow: arrow_to_pandas）
+ローカルのカーソルは結果をメモリに持っているため、arrowのfetchには転送の時間が含まれない
+（ウェアハウスからの転送を含めて比べるには --backend を指定する）。
+各パスは別プロセスで実行し、経過時間とピークRSSの増分を計測する。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+import data_access
+from bench.synthetic_orders import generate_orders
+
+
+class _LocalCursor:
+    """Snowflakeのカーソル相当。fetchallはPythonのタプルで、fetch_arrow_allはArrowのTableで行を返す"""
+
+    def __init__(self, table):
+        self._table = table
+        self.description = [(name,) for name in table.column_names]
+
+    def execute(self, sql, *args):
+        return self
+
+    def fetchall(self):
+        columns = [col.to_pylist() for col in self._table.columns]
+        return list(zip(*columns))
+
+    def fetch_arrow_all(self):
+        return self._table
+
+    def close(self):
+        pass
+
+
+class _LocalConnection:
+    def __init__(self, table):
+        self._table = table
+
+    def cursor(self):
+        return _LocalCursor(self._table)
+
+    def close(self):
+        pass
+
+
+def _reset_peak_rss():
+    # ru_maxrssは親プロセスの値を引き継ぐため、Linuxではピーク値(VmHWM)をリセットしてから計測する
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linuxではru_maxrssはKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(path, ipc_file, backend, result_queue):
+    if backend:
+        conn = data_access.connect(backend)
+    else:
+        conn = _LocalConnection(pa.ipc.open_file(pa.memory_map(ipc_file)).read_all())
+
+    _reset_peak_rss()
+    baseline = _peak_rss_mb()
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.execute(data_access.ORDERS_QUERY)
+    executed = time.perf_counter()
+    if path == 'read_sql':
+        rows = cur.fetchall()
+        fetched = time.perf_counter()
+        # pd.read_sql もDBAPIの接続ではfetchallの結果をfrom_recordsでDataFrameにする
+        df = pd.DataFrame.from_records(rows, columns=[d[0] for d in cur.description])
+        del rows
+    else:
+        table = cur.fetch_arrow_all()
+        fetched = time.perf_counter()
+        df = data_access.arrow_to_pandas(table)
+        del table
+    df = data_access.apply_column_types(df)
+    converted = time.perf_counter()
+    cur.close()
+    result_queue.put({
+        'path': path,
+        'rows': len(df),
+        'execute_seconds': round(executed - start, 3),
+        'fetch_seconds': round(fetched - executed, 3),
+        'convert_seconds': round(converted - fetched, 3),
+        'seconds': round(converted - start, 3),
+        'peak_rss_delta_mb': round(_peak_rss_mb() - baseline, 1),
+        'frame_mb': round(df.memory_usage(deep=True).sum() / 1024 ** 2, 1),
+    })
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200_000, help='合成ORDERSの行数')
+    parser.add_argument('--backend', help='data_accessのバックエンド名（指定時は実際の接続で比較）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ipc_file = os.path.join(tmpdir, 'orders.arrow')
+        if not args.backend:
+            table = pa.Table.from_pandas(generate_orders(args.rows), preserve_index=False)
+            with pa.OSFile(ipc_file, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            del table
+
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for path in ('read_sql', 'arrow'):
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=_run, args=(path, ipc_file, args.backend, result_queue))
+            proc.start()
+            results.append(result_queue.get())
+            proc.join()
+
+    for r in results:
+        print(f"{r['path']:>9}: {r['rows']:>9,} rows  {r['seconds']:>7.3f} s "
+              f"(execute {r['execute_seconds']:.3f} s, fetch {r['fetch_seconds']:.3f} s, convert {r['convert_seconds']:.3f} s)  "
+              f"peak RSS +{r['peak_rss_delta_mb']:.1f} MB  frame {r['frame_mb']:.1f} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""絞り込み（クロスフィルタ）の索引のベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_filters --rows 1000000 --json filters.json
+
+合成ORDERSをsqliteへ書き出し、bench.local_snowflake をバックエンドとしてカラムストアに読み込んでから、
+絞り込みを1つずつ増やしながら（年 → 国 → 製品ライン）、6つのグラフのセクションが使うカラムを次の2通りで取り出す。
+    mask: セクションごとに全行のDataFrameを作り、絞り込みのカラムのisinを組み合わせたマスクで絞り込む
+    index: ColumnStore.get(カラム, 絞り込み)。値ごとの行番号の索引から行を求め、絞り込んだ行を共有する
+計測するのは、6セクション分の秒数（indexは絞り込みを変えた直後の1回目と、同じ絞り込みでの2回目）と、
+索引を作る秒数・バイト数。両方の結果が一致するかも確かめる。
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# セクションごとに使うカラム（散布図・ヒストグラム・箱ひげ図・棒グラフ・円グラフ・ヒートマップの既定の選択）
+SECTION_COLUMNS = [
+    ['QUANTITYORDERED', 'PRICEEACH'], ['SALES'], ['SALES'], ['PRODUCTLINE', 'SALES'], ['STATUS'], ['COUNTRY', 'YEAR_ID'],
+]
+FILTER_STEPS = ['YEAR_ID', 'COUNTRY', 'PRODUCTLINE']
+
+
+def _mask_views(store, filters):
+    views = []
+    filter_columns = [col for col, _ in filters]
+    for columns in SECTION_COLUMNS:
+        df = store.get(list(dict.fromkeys([*columns, *filter_columns])))
+        mask = np.ones(len(df), dtype=bool)
+        for col, values in filters:
+            mask &= df[col].isin(values).to_numpy()
+        views.append(df.loc[mask, columns].reset_index(drop=True))
+    return views
+
+
+def _index_views(store, filters):
+    return [store.get(columns, filters).reset_index(drop=True) for columns in SECTION_COLUMNS]
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000, help='合成ORDERSの行数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='合成ORDERSのsqliteを置くディレクトリ（未指定なら一時ディレクトリ）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    os.environ.update(DATA_BACKEND='local_snowflake', ORDERS_SNAPSHOT_DIR='', QUERY_CACHE_DIR='')
+    from bench import local_snowflake
+    from bench.synthetic_orders import write_sqlite
+    import data_access
+    import filters as filters_module
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+        db_path = os.path.join(data_dir, f'orders_{args.rows}_{args.seed}.db')
+        if not os.path.exists(db_path):
+            write_sqlite(db_path, args.rows, args.seed)
+        backend = local_snowflake.register(db_path, 0.0)
+        # Streamlitの実行環境の外では cache_resource が効かないため、カラムストアを1つ作って使い回す
+        store = data_access._column_store(backend)
+        all_columns = sorted({col for columns in SECTION_COLUMNS for col in columns} | set(FILTER_STEPS))
+        _, load = _timed(store.get, all_columns)
+
+        selections = {}
+        results = []
+        for col in FILTER_STEPS:
+            # 行数の最も多い値で絞り込む
+            selections[col] = [store.get([col])[col].value_counts().index[0]]
+            filters = filters_module.normalize(selections)
+            expected, mask_seconds = _timed(_mask_views, store, filters)
+            built = set(store._indexes)
+            actual, first_seconds = _timed(_index_views, store, filters)
+            _, second_seconds = _timed(_index_views, store, filters)
+            matches = all(e.equals(a) for e, a in zip(expected, actual))
+            result = {
+                'filters': {c: [str(v) for v in values] for c, values in filters},
+                'rows': len(actual[0]),
+                'mask_seconds': round(mask_seconds, 4),
+                'index_first_seconds': round(first_seconds, 4),
+                'index_second_seconds': round(second_seconds, 4),
+                'built_indexes': sorted(set(store._indexes) - built),
+                'matches': matches,
+            }
+            results.append(result)
+            print(f"{len(filters)} filters  {result['rows']:>9,} rows  mask {mask_seconds * 1000:>8.1f} ms  "
+                  f"index {first_seconds * 1000:>8.1f} ms (same filters {second_seconds * 1000:.1f} ms)  "
+                  f"built {result['built_indexes']}  matches {matches}")
+        index_bytes = sum(index.nbytes for index in store._indexes.values())
+        print(f"rows {args.rows:,}  load {load:.2f} s  index {index_bytes / 1024 ** 2:.1f} MB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rows': args.rows, 'index_bytes': index_bytes, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
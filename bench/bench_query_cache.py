@@ -0,0 +1,125 @@
+"""プロセス間で共有するクエリキャッシュ（query_cache）の待ち合わせのベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_query_cache --processes 4 --threads 8 --latency 0.5
+    python -m bench.bench_query_cache --no-cache   # キャッシュを使わない場合と比べる
+
+レプリカが同時に同じクエリを実行する状況を真似て、--processes個のプロセスの--threads個のスレッドが
+一斉に data_access.execute_query で同じSQLを実行する。接続は bench.local_snowflake（実行回数を数える）で、
+キャッシュは一時ディレクトリに作るため、ウェアハウスへ届く実行はキャッシュありなら1回になる。
+    executions: 全プロセスでlocal_snowflakeが実行したクエリの数
+    status: 各呼び出しのキャッシュの結果（hit / miss / coalesced / fallback）の回数
+    wall_seconds: 全スレッドがそろってから、最後の結果が返るまでの秒数
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY = 'SELECT STATUS, COUNT(*) AS ORDERS, SUM(SALES) AS SALES FROM ORDERS GROUP BY STATUS ORDER BY STATUS'
+
+
+def _run(db_path, options, barrier, result_queue):
+    os.chdir(ROOT)
+    import data_access
+    from bench import local_snowflake
+    from query_cache import QueryCache
+
+    backend = local_snowflake.register(db_path, options['latency'])
+    statuses = collections.Counter()
+    rows = set()
+    lock = threading.Lock()
+    get_or_execute = QueryCache.get_or_execute
+
+    def counted_get_or_execute(self, key, execute):
+        table, status = get_or_execute(self, key, execute)
+        with lock:
+            statuses[status] += 1
+        return table, status
+
+    QueryCache.get_or_execute = counted_get_or_execute
+
+    def worker():
+        df = data_access.execute_query(QUERY, backend)
+        with lock:
+            rows.add(len(df))
+
+    threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+    # 全プロセスの準備（モジュールの読み込み等）が終わってから一斉に始める
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result_queue.put({
+        'executions': len(local_snowflake.executed_queries()),
+        'status': dict(statuses),
+        'rows': sorted(rows),
+        'end': time.perf_counter() - start,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='同時に実行するプロセス（レプリカ）の数')
+    parser.add_argument('--threads', type=int, default=8, help='プロセスごとのスレッド（セッション）の数')
+    parser.add_argument('--latency', type=float, default=0.5, help='クエリごとに入れる遅延（秒）')
+    parser.add_argument('--rows', type=int, default=100_000, help='合成ORDERSの行数')
+    parser.add_argument('--no-cache', action='store_true', help='クエリキャッシュを使わずに実行する')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    from bench.synthetic_orders import write_sqlite
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows)
+        # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+        os.environ.update(
+            DATA_BACKEND='local_snowflake',
+            ORDERS_SNAPSHOT_DIR='',
+            CHAT_CACHE_DIR='',
+            QUERY_CACHE_DIR='' if args.no_cache else os.path.join(tmpdir, 'query_cache'),
+            # 接続プールがスレッド数より小さいと、待ち合わせではなくプールの順番待ちを計ることになる
+            POOL_SIZE=str(args.threads),
+        )
+        ctx = multiprocessing.get_context('spawn')
+        barrier = ctx.Barrier(args.processes)
+        result_queue = ctx.Queue()
+        options = {'threads': args.threads, 'latency': args.latency}
+        procs = [ctx.Process(target=_run, args=(db_path, options, barrier, result_queue)) for _ in range(args.processes)]
+        for proc in procs:
+            proc.start()
+        runs = [result_queue.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+
+    status = collections.Counter()
+    for r in runs:
+        status.update(r['status'])
+    result = {
+        'cache': not args.no_cache,
+        'processes': args.processes,
+        'threads': args.threads,
+        'latency': args.latency,
+        'calls': args.processes * args.threads,
+        'executions': sum(r['executions'] for r in runs),
+        'status': dict(status),
+        'result_rows': sorted({n for r in runs for n in r['rows']}),
+        'wall_seconds': round(max(r['end'] for r in runs), 3),
+    }
+    print(f"cache={result['cache']}  calls {result['calls']}  executions {result['executions']}  "
+          f"wall {result['wall_seconds']} s  status {result['status']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""app.pyの起動の速さ（モジュールの読み込み時間と最初の描画までの時間）のベンチマーク
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_startup --rows 100000 --json startup.json
+
+計測はそれぞれ新しいプロセスで行う（読み込み済みのモジュールが再利用されないように）。
+ORDERSは合成データをsqliteバックエンドから読む（登録のためにアプリのモジュールを先に読み込まないよう、
+bench.local_snowflake は使わない）。
+    import_ms: app.pyが先頭で読み込むモジュールごとの読み込み時間（streamlitの読み込み後、python -X importtime の累計）
+    import_total_ms: それらをまとめて読み込む時間
+    first_paint_seconds: スクリプトの開始から最初の要素（タイトル）を送るまで
+    first_chart_seconds: 最初のグラフを送るまで
+    full_run_seconds: スクリプトの最後まで
+    loaded: 最後まで実行したあとに読み込まれているか（ChatGPTを使っていなければopenaiは読み込まない）
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 読み込まれているかを確かめるモジュール
+WATCHED_MODULES = ['openai', 'plotly.express', 'pandas', 'pyarrow', 'snowflake.connector']
+
+
+def app_imports(path=os.path.join(ROOT, 'app.py')):
+    """app.pyのモジュールの最上位にあるimport文のモジュール名（関数の中で読み込むものは含めない）"""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.append(node.module)
+    return [n for n in dict.fromkeys(names) if n != 'streamlit']
+
+
+def _import_ms(module):
+    """streamlitを読み込んだ状態から、moduleの読み込みにかかる時間（ミリ秒）"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import streamlit; import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    # 「import time: 自身 | 累計 | モジュール名」の行のうち、moduleの行（streamlitが読み込み済みなら無い）
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module and not fields[2].startswith('  '):
+            return round(int(fields[1]) / 1000, 1)
+    return 0.0
+
+
+def _import_total_ms(modules):
+    code = (
+        'import time, streamlit; start = time.perf_counter(); '
+        + '; '.join(f'import {m}' for m in modules)
+        + '; print(time.perf_counter() - start)'
+    )
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return round(float(proc.stdout.strip().splitlines()[-1]) * 1000, 1)
+
+
+def _first_paint(timeout, result_queue):
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    from streamlit.runtime.scriptrunner.script_run_context import ScriptRunContext
+    from streamlit.testing.v1 import AppTest
+
+    events = {}
+    enqueue = ScriptRunContext.enqueue
+
+    def timed_enqueue(self, msg):
+        now = time.perf_counter()
+        if msg.HasField('delta'):
+            events.setdefault('first_paint', now)
+            if msg.delta.new_element.WhichOneof('type') == 'plotly_chart':
+                events.setdefault('first_chart', now)
+        return enqueue(self, msg)
+
+    ScriptRunContext.enqueue = timed_enqueue
+
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=timeout)
+    start = time.perf_counter()
+    at.run()
+    end = time.perf_counter()
+    result_queue.put({
+        'error': [e.message for e in at.exception] or None,
+        'first_paint_seconds': round(events['first_paint'] - start, 3) if 'first_paint' in events else None,
+        'first_chart_seconds': round(events['first_chart'] - start, 3) if 'first_chart' in events else None,
+        'full_run_seconds': round(end - start, 3),
+        'loaded': {m: m in sys.modules for m in WATCHED_MODULES},
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000, help='合成ORDERSの行数')
+    parser.add_argument('--repeat', type=int, default=3, help='最初の描画までの時間を計る回数（中央値を使う）')
+    parser.add_argument('--timeout', type=float, default=600, help='1回の実行の待ち時間の上限（秒）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    modules = app_imports()
+    result = {
+        'import_ms': {m: _import_ms(m) for m in modules},
+        'import_total_ms': _import_total_ms(modules),
+    }
+
+    from bench.synthetic_orders import write_sqlite
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows)
+        # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+        os.environ.update(DATA_BACKEND='sqlite', SQLITE_PATH=db_path, ORDERS_SNAPSHOT_DIR='', CHAT_CACHE_DIR='', QUERY_CACHE_DIR='')
+        ctx = multiprocessing.get_context('spawn')
+        for _ in range(args.repeat):
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=_first_paint, args=(args.timeout, result_queue))
+            proc.start()
+            runs.append(result_queue.get())
+            proc.join()
+    for key in ('first_paint_seconds', 'first_chart_seconds', 'full_run_seconds'):
+        values = [r[key] for r in runs if r[key] is not None]
+        result[key] = round(statistics.median(values), 3) if values else None
+    result.update(rows=args.rows, loaded=runs[-1]['loaded'], error=runs[-1]['error'])
+
+    for module, ms in sorted(result['import_ms'].items(), key=lambda x: -x[1]):
+        print(f'import {module:<20} {ms:>8.1f} ms')
+    print(f"import total          {result['import_total_ms']:>8.1f} ms")
+    print(f"first paint {result['first_paint_seconds']} s / first chart {result['first_chart_seconds']} s / "
+          f"full run {result['full_run_seconds']} s")
+    print('loaded: ' + ', '.join(f'{m}={v}' for m, v in result['loaded'].items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
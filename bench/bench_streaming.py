@@ -0,0 +1,208 @@
+"""ORDERSのストリーミングの読み込み（streaming）のベンチマークと、全件をメモリに載せた場合との一致の確認
+
+実行例（リポジトリのルートで）:
+    python -m bench.bench_streaming --rows 100000,1000000 --json streaming.json
+
+行数ごとに合成ORDERSをsqliteへ書き出し、bench.local_snowflake をバックエンドとして登録して、
+グラフに使うカラム（StreamingSummary.columns）を次の2通りで読み込み・集計する。それぞれ別プロセスで実行する。
+    memory: 全件を1つのDataFrameにしてから、ヒストグラム・箱ひげ図・2次元ビン・集計キューブを求める
+    stream: data_access.iter_batches でバッチごとに受け取り、StreamingSummaryに足し込む
+計測するのは秒数とピークRSSの増分（peak_rss_delta_mb）。
+--check を付けると、同じ行数で両方の結果を比べ、一致しなかった集計を表示する
+（分位点は値の種類が STREAM_EXACT_VALUES を超えたカラムでは近似になるため、差の大きさを表示する）。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from bench.bench_fetch import _peak_rss_mb, _reset_peak_rss
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _summary(backend):
+    import data_access
+    from columns import CUBE_DIMENSIONS, CUBE_MEASURES
+
+    total_rows, _, bounds = data_access.stream_bounds(backend)
+    return data_access.StreamingSummary(bounds, total_rows, CUBE_DIMENSIONS, CUBE_MEASURES, data_access.BOX_MAX_OUTLIERS)
+
+
+def _memory(backend, summary):
+    """全件をメモリに載せた場合の集計"""
+    import charts
+    import data_access
+    import summaries
+    from columns import CUBE_DIMENSIONS, CUBE_MEASURES, INTEGER_COLUMNS, NUMERIC_COLUMNS
+    from cube import AggregateCube
+
+    df = data_access.query_orders(f"SELECT {', '.join(summary.columns)} FROM orders", backend)
+    result = {
+        'histogram': {
+            (col, rule): summaries.histogram(df[col], rule, data_access.HISTOGRAM_MAX_BINS, integer=col in INTEGER_COLUMNS)
+            for col in NUMERIC_COLUMNS for rule in summaries.BIN_RULES
+        },
+        'box': {col: summaries.box(df[col], data_access.BOX_MAX_OUTLIERS) for col in NUMERIC_COLUMNS},
+        'density': {
+            (x, y): charts.density_grid(df[[x, y]].dropna() if x != y else df[[x]].dropna(), x, y)
+            for x in NUMERIC_COLUMNS for y in NUMERIC_COLUMNS
+        },
+        'cube': AggregateCube.from_frame(df, CUBE_DIMENSIONS, CUBE_MEASURES),
+    }
+    return result
+
+
+def _stream(backend, summary):
+    """バッチごとに足し込んだ場合の集計"""
+    import data_access
+    import summaries
+    from columns import NUMERIC_COLUMNS
+
+    with data_access.get_pool(backend).connection() as conn:
+        for df in data_access.iter_batches(conn, f"SELECT {', '.join(summary.columns)} FROM orders"):
+            summary.add(df)
+    summary.finish()
+    return {
+        'histogram': {
+            (col, rule): summary.histogram(col, rule, data_access.HISTOGRAM_MAX_BINS)
+            for col in NUMERIC_COLUMNS for rule in summaries.BIN_RULES
+        },
+        'box': {col: summary.box(col, data_access.BOX_MAX_OUTLIERS) for col in NUMERIC_COLUMNS},
+        'density': {(x, y): summary.density(x, y) for x in NUMERIC_COLUMNS for y in NUMERIC_COLUMNS},
+        'cube': summary.cube(),
+        'exact': {col: summary.exact(col) for col in NUMERIC_COLUMNS},
+    }
+
+
+def _cube_frames(cube):
+    """キューブから作るグラフの集計（円グラフ・棒グラフ・ヒートマップ）をすべて並べる"""
+    frames = {}
+    for a in cube.dimensions:
+        frames[('pie', a)] = cube.pie(a)
+        for m in cube.measures:
+            frames[('bar', a, m)] = cube.bar(a, m)
+        for b in cube.dimensions:
+            frames[('heatmap', a, b)] = cube.heatmap(a, b)
+    return frames
+
+
+def _compare(memory, stream):
+    """一致しなかった集計の一覧（名前 -> 差の説明）"""
+    import numpy as np
+    import pandas as pd
+
+    mismatches = {}
+    for key, expected in memory['histogram'].items():
+        actual = stream['histogram'][key]
+        if not expected.reset_index(drop=True).equals(actual.reset_index(drop=True)):
+            if len(expected) == len(actual) and np.allclose(expected[['bin_start', 'bin_end']], actual[['bin_start', 'bin_end']]):
+                diff = int(np.abs(expected['count'].to_numpy() - actual['count'].to_numpy()).sum())
+                mismatches[f'histogram {key}'] = f'count diff {diff} (exact={stream["exact"][key[0]]})'
+            else:
+                mismatches[f'histogram {key}'] = f'bins {len(expected)} -> {len(actual)} (exact={stream["exact"][key[0]]})'
+    for col, expected in memory['box'].items():
+        actual = stream['box'][col]
+        if expected is None or actual is None:
+            if expected is not actual:
+                mismatches[f'box {col}'] = 'empty'
+            continue
+        for stat in ('count', 'mean', 'q1', 'median', 'q3', 'lowerfence', 'upperfence', 'outlier_count'):
+            if not np.isclose(expected[stat], actual[stat]):
+                mismatches[f'box {col} {stat}'] = f'{expected[stat]} -> {actual[stat]} (exact={stream["exact"][col]})'
+    for key, (counts, x_labels, y_labels) in memory['density'].items():
+        s_counts, s_x, s_y = stream['density'][key]
+        if not (np.array_equal(counts, s_counts) and np.allclose(x_labels, s_x) and np.allclose(y_labels, s_y)):
+            mismatches[f'density {key}'] = f'cells differ: {int(np.abs(counts - s_counts).sum()) if counts.shape == s_counts.shape else "shape"}'
+    expected_frames, actual_frames = _cube_frames(memory['cube']), _cube_frames(stream['cube'])
+    for key, expected in expected_frames.items():
+        actual = actual_frames[key]
+        try:
+            pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True), check_dtype=False)
+        except AssertionError as e:
+            mismatches[f'cube {key}'] = str(e).splitlines()[0]
+    return mismatches
+
+
+def _run(mode, db_path, options, result_queue):
+    os.chdir(ROOT)
+    from bench import local_snowflake
+
+    backend = local_snowflake.register(db_path, 0.0)
+    summary = _summary(backend)
+    _reset_peak_rss()
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    result = {'memory': _memory, 'stream': _stream}[mode](backend, summary)
+    seconds = time.perf_counter() - start
+    peak = _peak_rss_mb()
+    output = {
+        'mode': mode,
+        'rows': options['rows'],
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(peak, 1),
+        'peak_rss_delta_mb': round(peak - baseline, 1),
+    }
+    if options['check']:
+        # 比較のため、結果はpickleして親プロセスへ送る
+        output['result'] = result
+    result_queue.put(output)
+
+
+def _spawn(ctx, mode, db_path, options):
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(mode, db_path, options, result_queue))
+    proc.start()
+    result = result_queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='100000,1000000', help='合成ORDERSの行数（カンマ区切り）')
+    parser.add_argument('--batch-rows', type=int, default=20_000, help='ストリーミングで1回に受け取る行数（STREAM_BATCH_ROWS）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true', help='全件をメモリに載せた場合と結果を比べる')
+    parser.add_argument('--data-dir', help='合成ORDERSのsqliteを置くディレクトリ（未指定なら一時ディレクトリ）')
+    parser.add_argument('--json', help='結果を書き出すJSONファイル')
+    args = parser.parse_args()
+
+    from bench.synthetic_orders import write_sqlite
+
+    # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+    os.environ.update(
+        DATA_BACKEND='local_snowflake',
+        ORDERS_SNAPSHOT_DIR='',
+        QUERY_CACHE_DIR='',
+        STREAM_BATCH_ROWS=str(args.batch_rows),
+    )
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+        for rows in [int(r) for r in args.rows.split(',')]:
+            db_path = os.path.join(data_dir, f'orders_{rows}_{args.seed}.db')
+            if not os.path.exists(db_path):
+                write_sqlite(db_path, rows, args.seed)
+            options = {'rows': rows, 'check': args.check}
+            runs = {mode: _spawn(ctx, mode, db_path, options) for mode in ('memory', 'stream')}
+            for mode, run in runs.items():
+                print(f"{rows:>10,} rows  {mode:<6}  {run['seconds']:>7.3f} s  peak RSS +{run['peak_rss_delta_mb']:.1f} MB")
+            if args.check:
+                mismatches = _compare(runs['memory'].pop('result'), runs['stream'].pop('result'))
+                runs['stream']['mismatches'] = mismatches
+                print(f"{rows:>10,} rows  check: {len(mismatches)} mismatches")
+                for name, detail in mismatches.items():
+                    print(f'    {name}: {detail}')
+            results.extend(runs.values())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'batch_rows': args.batch_rows, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
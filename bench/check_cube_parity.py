@@ -0,0 +1,78 @@
+"""集計キューブ（AggregateCube）の結果の一致の確認
+
+実行例（リポジトリのルートで）:
+    python -m bench.check_cube_parity --rows 50000
+
+合成ORDERSをsqliteへ書き出し（数値カラムのNULLと、値がすべてNULLのカテゴリを加える）、
+bench.local_snowflake をバックエンドとして、集計キューブを次の2通りで作る。
+    from_query: AggregateCube.from_query。アプリと同じく data_access.execute_query でクエリを実行する
+    from_frame: AggregateCube.from_frame。アプリと同じくカラムストアから読み込んだ（省メモリな型にした）DataFrameを使う
+それぞれの円グラフ・棒グラフ（上位だけの棒グラフを含む）・ヒートマップの集計を、同じDataFrameを直接集計した結果
+（PandasAggregationEngine）と、次元・数値カラムのすべての組み合わせで比べる。
+一致しなければ、食い違ったキューブ・グラフ・カラムを表示して終了コード1で終わる。
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50_000, help='合成ORDERSの行数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ.update(DATA_BACKEND='local_snowflake', ORDERS_SNAPSHOT_DIR='', QUERY_CACHE_DIR='')
+    import data_access
+    from aggregation import PandasAggregationEngine
+    from bench import local_snowflake
+    from bench.check_engine_parity import _compare
+    from bench.synthetic_orders import write_sqlite
+    from columns import CUBE_DIMENSIONS, CUBE_MEASURES
+    from cube import AggregateCube
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows, args.seed)
+        with sqlite3.connect(db_path) as conn:
+            # 合計・件数のNULLの扱いを確かめるため、数値カラムの一部と、1つのカテゴリの値すべてをNULLにする
+            conn.execute('UPDATE orders SET SALES = NULL WHERE ORDERLINENUMBER % 7 = 0')
+            conn.execute('UPDATE orders SET MSRP = NULL WHERE STATUS = (SELECT MIN(STATUS) FROM orders)')
+        backend = local_snowflake.register(db_path, 0.0)
+        # Streamlitの実行環境の外では cache_resource が効かないため、カラムストアを1つ作って使い回す
+        df = data_access._column_store(backend).get(CUBE_DIMENSIONS + CUBE_MEASURES)
+        direct = PandasAggregationEngine(df)
+        cubes = {
+            'from_query': AggregateCube.from_query(
+                lambda sql_query: data_access.execute_query(sql_query, backend), CUBE_DIMENSIONS, CUBE_MEASURES,
+            ),
+            'from_frame': AggregateCube.from_frame(df, CUBE_DIMENSIONS, CUBE_MEASURES),
+        }
+        cases = [('pie', (col,), {}) for col in CUBE_DIMENSIONS]
+        cases += [('bar', pair, {}) for pair in itertools.product(CUBE_DIMENSIONS, CUBE_MEASURES)]
+        cases += [('bar', pair, {'limit': 3}) for pair in itertools.product(CUBE_DIMENSIONS, CUBE_MEASURES)]
+        cases += [('heatmap', pair, {}) for pair in itertools.product(CUBE_DIMENSIONS, repeat=2)]
+
+        mismatches = []
+        for (name, cube), (chart, columns, options) in itertools.product(cubes.items(), cases):
+            difference = _compare(getattr(cube, chart)(*columns, **options), getattr(direct, chart)(*columns, **options))
+            if difference is not None:
+                mismatches.append((name, chart, columns, difference))
+
+    print(f'rows {args.rows:,}  compared {len(cases)} aggregations x {len(cubes)} cubes')
+    for name, chart, columns, difference in mismatches:
+        print(f"NG: {name} {chart} {', '.join(columns)}: {difference}")
+    if mismatches:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
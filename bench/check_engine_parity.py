@@ -0,0 +1,100 @@
+"""集計エンジン（SQL・pandas）の結果の一致の確認
+
+実行例（リポジトリのルートで）:
+    python -m bench.check_engine_parity --rows 50000
+
+合成ORDERSをsqliteへ書き出し、bench.local_snowflake をバックエンドとして、同じデータを次の2通りで集計する。
+    sql: SqlAggregationEngine。アプリと同じく data_access.execute_query でクエリを実行する
+    pandas: PandasAggregationEngine。アプリと同じくカラムストアから読み込んだ（省メモリな型にした）DataFrameを使う
+ヒストグラム・円グラフ・棒グラフ（上位だけの棒グラフを含む）・ヒートマップについて、グラフの選択肢に出るカラム（の組み合わせ）ごとに
+結果が一致するかを確かめる。一致しなければ、食い違ったグラフとカラムを表示して終了コード1で終わる。
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _comparable(df, other):
+    """型の違い（category型・sqliteの文字列の日付・整数と浮動小数点数）を除いて、otherと比べられる形にする"""
+    import pandas as pd
+
+    df = df.reset_index(drop=True)
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+        if col in other and pd.api.types.is_datetime64_any_dtype(other[col]):
+            df[col] = pd.to_datetime(df[col])
+        elif pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].astype('float64')
+    return df
+
+
+def _compare(sql_result, pandas_result):
+    """一致すればNone、食い違っていればその内容"""
+    import pandas as pd
+
+    try:
+        pd.testing.assert_frame_equal(
+            _comparable(sql_result, pandas_result), _comparable(pandas_result, sql_result), check_dtype=False, rtol=1e-9,
+        )
+    except AssertionError as e:
+        return ' '.join(str(e).split())[:300]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50_000, help='合成ORDERSの行数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ.update(DATA_BACKEND='local_snowflake', ORDERS_SNAPSHOT_DIR='', QUERY_CACHE_DIR='')
+    import data_access
+    from aggregation import PandasAggregationEngine, SqlAggregationEngine
+    from bench import local_snowflake
+    from bench.synthetic_orders import write_sqlite
+    from columns import column_mapping, registry
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows, args.seed)
+        backend = local_snowflake.register(db_path, 0.0)
+        # Streamlitの実行環境の外では cache_resource が効かないため、カラムストアを1つ作って使い回す
+        df = data_access._column_store(backend).get(list(column_mapping))
+        engines = {
+            'sql': SqlAggregationEngine(lambda sql_query: data_access.execute_query(sql_query, backend), dialect='sqlite'),
+            'pandas': PandasAggregationEngine(df),
+        }
+        # グラフの選択肢は値の種類数で決まるため、アプリと同じく種類数を設定してから選ぶ
+        registry.set_cardinality(engines['sql'].cardinality(list(column_mapping)))
+        bar_pairs = list(itertools.product(registry.eligible('bar_category'), registry.eligible('bar_value')))
+        cases = [('histogram', (col,), {}) for col in registry.eligible('histogram')]
+        cases += [('pie', (col,), {}) for col in registry.eligible('pie')]
+        cases += [('bar', pair, {}) for pair in bar_pairs]
+        cases += [('bar', pair, {'limit': 10}) for pair in bar_pairs]
+        cases += [('heatmap', pair, {}) for pair in itertools.product(registry.eligible('heatmap'), repeat=2)]
+
+        mismatches = []
+        for chart, columns, options in cases:
+            results = {name: getattr(engine, chart)(*columns, **options) for name, engine in engines.items()}
+            difference = _compare(results['sql'], results['pandas'])
+            if difference is not None:
+                mismatches.append((chart, columns, difference))
+
+    counts = {chart: sum(1 for c, _, _ in cases if c == chart) for chart in dict.fromkeys(c for c, _, _ in cases)}
+    print(f"rows {args.rows:,}  compared {', '.join(f'{chart} {n}' for chart, n in counts.items())}")
+    for chart, columns, difference in mismatches:
+        print(f"NG: {chart} {', '.join(columns)}: {difference}")
+    if mismatches:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""差分更新中にカラムを追加した場合の、絞り込み（クロスフィルタ）の確認
+
+実行例（リポジトリのルートで）:
+    python -m bench.check_refresh_filters --rows 20000
+
+合成ORDERSをメモリ上のDataFrameから返す取得関数でカラムストアを作り、差分更新の問い合わせ中に
+（別のセッションがグラフのカラムを選んだ場合と同じく）カラムを追加する。差分には、保持済みの行
+（ウォーターマークと同じ値の行）も含める。その後、追加したカラムと差分に含まれたカラムを絞り込みで
+取り出し、元のデータと行ごとに一致するかを確かめる。
+差分の行は（ウェアハウスと同じく）順序を保証せずに返す。一致しなければ終了コード1で終わる。
+"""
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.synthetic_orders import generate_orders  # noqa: E402
+from column_store import ORDER_KEY, ColumnStore  # noqa: E402
+from filters import normalize  # noqa: E402
+
+WATERMARK = 'ORDERNUMBER'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20_000, help='合成ORDERSの行数')
+    args = parser.parse_args()
+
+    orders = generate_orders(args.rows)
+    # 取得済みの行は、ウォーターマークが中央の行の値以下の行（その値の行は、差分で取得し直される）
+    cutoff = orders[WATERMARK].iloc[len(orders) // 2]
+    visible = {'rows': orders[orders[WATERMARK] <= cutoff]}
+    store = None
+
+    def fetch(columns, since):
+        rows = visible['rows']
+        if since is not None:
+            # 差分の問い合わせ中に、別のセッションがカラムを追加する
+            store.get(['PRODUCTLINE'])
+            visible['rows'] = rows = orders
+            # ウェアハウスは行の順序を保証しないため、差分の行は並びを崩して返す
+            rows = rows[rows[WATERMARK] >= since].sample(frac=1, random_state=0)
+        return rows[list(dict.fromkeys([*ORDER_KEY, WATERMARK, *columns]))]
+
+    store = ColumnStore(fetch, watermark_column=WATERMARK)
+    store.get(['COUNTRY', 'SALES'])
+    new_rows = store.refresh()
+    print(f'rows {len(orders):,}  held before refresh {int((orders[WATERMARK] <= cutoff).sum()):,}  new rows {new_rows:,}')
+
+    failures = []
+    country = orders['COUNTRY'].dropna().iloc[0]
+    df = store.get([*ORDER_KEY, 'PRODUCTLINE', 'SALES'], normalize({'COUNTRY': [country]}))
+    # 取り出した行のキーで、元のデータの行を引く
+    expected = orders.set_index(ORDER_KEY).loc[pd.MultiIndex.from_frame(df[ORDER_KEY])].reset_index()
+    if not (expected['COUNTRY'] == country).all():
+        failures.append('絞り込みの条件に当てはまらない行が含まれています')
+    # 追加したカラムは、差分で増えた行（ウォーターマークが中央の行の値より後の行）では欠損になり得るため、それ以外の行を比べる
+    held = (df[WATERMARK] <= cutoff).to_numpy()
+    for col, rows in [('PRODUCTLINE', held), ('SALES', slice(None))]:
+        got, want = df.loc[rows, col].reset_index(drop=True), expected.loc[rows, col].reset_index(drop=True)
+        mismatched = int((~((got == want) | (got.isna() & want.isna()))).sum())
+        print(f'{col}: {len(got):,} rows  mismatched {mismatched:,}')
+        if mismatched:
+            failures.append(f'{col}: {mismatched:,}行が元のデータと一致しません')
+
+    for failure in failures:
+        print(f'NG: {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""スナップショットからの起動（ウォームスタート）の確認
+
+実行例（リポジトリのルートで）:
+    python -m bench.check_snapshot_restore --rows 20000
+
+bench.local_snowflake をバックエンドにして、一時ディレクトリをスナップショットの保存先にし、
+別々のプロセスで app.py（散布図のセクションを開いた状態）を2回実行する。
+    1回目: ORDERSを取得してグラフを描き、スナップショットにグラフのカラムが保存されるまで待つ
+    2回目: スナップショットから復元してグラフを描く。ORDERSの行の取得（差分更新以外）が無いことを確かめる
+確認に失敗したら終了コード1で終わる。
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _snapshot_columns(snapshot_dir):
+    """最新のスナップショットに保存されたカラム"""
+    import pyarrow as pa
+
+    if not os.path.isdir(snapshot_dir):
+        return []
+    files = [os.path.join(snapshot_dir, f) for f in os.listdir(snapshot_dir) if f.endswith('.arrow')]
+    if not files:
+        return []
+    with pa.memory_map(max(files, key=os.path.getmtime)) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def _run(phase, db_path, result_queue):
+    os.chdir(ROOT)
+    from streamlit.testing.v1 import AppTest
+
+    import data_access
+    from bench import local_snowflake
+
+    local_snowflake.register(db_path, 0.0)
+    # カラムストアの取得のうち、差分更新（since指定）ではない全行の取得を記録する
+    full_fetches = []
+    build_projection_query = data_access.build_projection_query
+
+    def recording(columns, since=None, watermark_column=None):
+        if since is None:
+            full_fetches.append(list(columns))
+        return build_projection_query(columns, since, watermark_column)
+
+    data_access.build_projection_query = recording
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=300)
+    at.run()
+    result = {
+        'error': [e.message for e in at.exception] or None,
+        'charts': len(at.get('plotly_chart')),
+        'full_fetches': full_fetches,
+    }
+    if phase == 'first':
+        # バックグラウンドの保存（グラフのカラムを取得した後の再保存を含む）が終わるまで待つ
+        deadline = time.monotonic() + 60
+        while len(_snapshot_columns(os.environ['ORDERS_SNAPSHOT_DIR'])) <= 2 or data_access._snapshot_lock.locked():
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+    result_queue.put(result)
+
+
+def _spawn(ctx, phase, db_path):
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(phase, db_path, result_queue))
+    proc.start()
+    result = result_queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20_000, help='合成ORDERSの行数')
+    args = parser.parse_args()
+
+    from bench.synthetic_orders import write_sqlite
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, 'orders.db')
+        write_sqlite(db_path, args.rows)
+        snapshot_dir = os.path.join(tmpdir, 'snapshots')
+        # 設定はモジュールの読み込み時に環境変数から読まれるため、子プロセスを起動する前に設定する
+        os.environ.update(
+            DATA_BACKEND='local_snowflake',
+            CHART_SECTIONS_OPEN='scatter',
+            ORDERS_SNAPSHOT_DIR=snapshot_dir,
+            CHAT_CACHE_DIR='',
+            QUERY_CACHE_DIR='',
+        )
+        ctx = multiprocessing.get_context('spawn')
+        first = _spawn(ctx, 'first', db_path)
+        saved = _snapshot_columns(snapshot_dir)
+        print(f"first run: charts {first['charts']}  error {first['error']}  snapshot columns {saved}")
+        if first['error'] or not saved:
+            failures.append('1回目の実行でスナップショットが保存されませんでした')
+        else:
+            # キーのカラム（ORDERNUMBER、ORDERLINENUMBER）の他に、グラフのカラムが保存されていること
+            if len(saved) <= 2:
+                failures.append(f'スナップショットにグラフのカラムが含まれていません: {saved}')
+            second = _spawn(ctx, 'second', db_path)
+            print(f"second run: charts {second['charts']}  error {second['error']}  full fetches {second['full_fetches']}")
+            if second['error'] or second['charts'] == 0:
+                failures.append('2回目の実行でグラフを描けませんでした')
+            if second['full_fetches']:
+                failures.append(f"2回目の実行でORDERSの行を取得しました: {second['full_fetches']}")
+    for failure in failures:
+        print(f'NG: {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""OpenAI APIのChatCompletionを真似るローカルのフェイクサーバー
+
+実行例（リポジトリのルートで）:
+    python -m bench.fake_openai_server --port 8765 --first-token-delay 0.5 --token-delay 0.02
+    OPENAI_API_BASE=http://127.0.0.1:8765/v1 OPENAI_API_KEY=dummy streamlit run app.py
+
+stream=Trueの要求にはServer-Sent Eventsで1トークンずつ返し、それ以外は全文をJSONで返す。
+遅延と、指定した割合での429（レート制限）を注入できる。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # サーバーの設定（start_serverで上書きする）
+    first_token_delay = 0.2
+    token_delay = 0.02
+    tokens = 50
+    error_rate = 0.0
+    seed = 0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+    # 受け付けた要求の数（ステータスコードごと）と、同時に応答中だった数の最大
+    counts = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, status):
+        with self.rng_lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def _send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _answer_tokens(self, request):
+        question = request['messages'][-1]['content'] if request.get('messages') else ''
+        words = [f'「{question[:20]}」', 'への', '回答', 'です', '。']
+        return [words[i % len(words)] if i < len(words) else f' token{i}' for i in range(self.tokens)]
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        with self.rng_lock:
+            rate_limited = self.rng.random() < self.error_rate
+        if rate_limited:
+            self._count(429)
+            self._send_json(
+                429, {'error': {'message': 'Rate limit reached (fake)', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                headers=[('Retry-After', '1')],
+            )
+            return
+        self._count(200)
+        with self.rng_lock:
+            self.counts['in_flight'] = self.counts.get('in_flight', 0) + 1
+            self.counts['max_in_flight'] = max(self.counts.get('max_in_flight', 0), self.counts['in_flight'])
+        try:
+            self._respond(request)
+        finally:
+            with self.rng_lock:
+                self.counts['in_flight'] -= 1
+
+    def _respond(self, request):
+        time.sleep(self.first_token_delay)
+        tokens = self._answer_tokens(request)
+        model = request.get('model', 'fake')
+        if not request.get('stream'):
+            time.sleep(self.token_delay * len(tokens))
+            self._send_json(200, {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}],
+            })
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self.token_delay)
+                chunk = {
+                    'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+                }
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが受信を中断した
+            pass
+
+
+def start_server(port=0, **options):
+    """フェイクサーバーを別スレッドで起動する。戻り値は (サーバー, api_base)
+
+    optionsには first_token_delay, token_delay, tokens, error_rate, seed を指定できる。
+    """
+    seed = options.pop('seed', 0)
+    handler = type('Handler', (FakeOpenAIHandler,), {**options, 'rng': random.Random(seed), 'counts': {}})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help='最初のトークンまでの遅延（秒）')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='トークン間の遅延（秒）')
+    parser.add_argument('--tokens', type=int, default=50, help='応答のトークン数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='429を返す割合（0〜1）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    server, api_base = start_server(
+        args.port, first_token_delay=args.first_token_delay, token_delay=args.token_delay,
+        tokens=args.tokens, error_rate=args.error_rate, seed=args.seed,
+    )
+    print(f'OPENAI_API_BASE={api_base}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""snowflake.connector.connect の代わりに使う、sqliteのファイルを読むローカルの接続
+
+実行例（リポジトリのルートで）:
+    python -m bench.synthetic_orders --rows 1000000 --sqlite orders.db
+    python -m bench.bench_app --rows 100000   # registerしてからAppTestでapp.pyを動かす
+
+カーソルはSnowflakeのコネクタと同じく fetch_arrow_all / fetch_arrow_batches / fetch_pandas_all を持つため、
+data_access.fetch_frame はArrowの経路を通る。ウェアハウスの応答時間を真似るため、
+executeごとに遅延（latency秒）を入れられる。SQLはsqliteで実行するため、方言は 'sqlite' で登録する。
+
+非同期の投入（execute_async → get_query_status_throw_if_error → get_results_from_sfqid / abort_query）も
+真似る。投入からlatency秒の間は実行中として扱い、その間に取り消されたクエリはsqliteで実行しない。
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+
+import data_access
+
+# 読み込むsqliteのファイルと、executeごとに入れる遅延（秒）
+LOCAL_SNOWFLAKE_PATH = os.getenv('LOCAL_SNOWFLAKE_PATH', 'orders.db')
+LOCAL_SNOWFLAKE_LATENCY = float(os.getenv('LOCAL_SNOWFLAKE_LATENCY', '0'))
+
+BACKEND_NAME = 'local_snowflake'
+
+
+class LocalSnowflakeCursor:
+    """Snowflakeのカーソルのうち、data_accessが使う部分だけを真似たカーソル"""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cur = connection._conn.cursor()
+        self.description = None
+        self.sfqid = None
+
+    def execute(self, sql, params=None):
+        if self._connection.latency:
+            time.sleep(self._connection.latency)
+        return self._execute(sql, params)
+
+    def _execute(self, sql, params=None):
+        self._cur.execute(sql, params or ())
+        self.description = self._cur.description
+        self._connection._count(sql)
+        return self
+
+    def execute_async(self, sql, params=None):
+        """クエリを投入してすぐに返る（結果は get_results_from_sfqid で受け取る）"""
+        self.sfqid = self._connection._submit(sql, params)
+        return {'queryId': self.sfqid}
+
+    def get_results_from_sfqid(self, query_id):
+        """投入したクエリが終わるまで待ち、結果をこのカーソルから読めるようにする"""
+        query = self._connection._async_queries[query_id]
+        remaining = query['ready_at'] - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.sfqid = query_id
+        return self._execute(query['sql'], query['params'])
+
+    def abort_query(self, query_id):
+        """実行中のクエリを取り消す"""
+        return self._connection._abort(query_id)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cur.fetchmany(size or self._cur.arraysize)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetch_arrow_batches(self, batch_rows=None):
+        """結果をbatch_rows行（既定は STREAM_BATCH_ROWS）ずつArrowのTableにして返す（Snowflakeのコネクタの結果のチャンクの代わり）"""
+        batch_rows = batch_rows or data_access.STREAM_BATCH_ROWS
+        names = [d[0] for d in self.description]
+        while True:
+            rows = self._cur.fetchmany(batch_rows)
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            yield pa.table({name: pa.array(col) for name, col in zip(names, columns)})
+
+    def fetch_arrow_all(self, batch_rows=100_000):
+        """結果をArrowのTableで返す（0行ならNone。Snowflakeのコネクタと同じ）
+
+        一度にPythonのタプルへ展開しないよう、batch_rows行ずつArrowへ変換する。
+        """
+        tables = list(self.fetch_arrow_batches(batch_rows))
+        if not tables:
+            return None
+        # NULLだけのバッチはnull型になるため、他のバッチの型に揃えて連結する
+        return pa.concat_tables(tables, promote_options='default')
+
+    def fetch_pandas_all(self):
+        table = self.fetch_arrow_all()
+        if table is None:
+            return pd.DataFrame(columns=[d[0] for d in self.description])
+        return data_access.arrow_to_pandas(table)
+
+    def close(self):
+        self._cur.close()
+
+
+class LocalSnowflakeConnection:
+    """sqliteの接続を包んだ、Snowflakeの接続の代わり"""
+
+    def __init__(self, path, latency=0.0):
+        # Streamlitはスレッドを跨いで実行されるため、同一スレッド制約を外す
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self.latency = latency
+        self._closed = False
+        # クエリID -> {'sql', 'params', 'ready_at', 'status'}
+        self._async_queries = {}
+
+    def _count(self, sql):
+        with _lock:
+            _queries.append(sql)
+
+    def _submit(self, sql, params):
+        query_id = uuid.uuid4().hex
+        self._async_queries[query_id] = {
+            'sql': sql, 'params': params, 'ready_at': time.monotonic() + self.latency, 'status': 'RUNNING',
+        }
+        return query_id
+
+    def _abort(self, query_id):
+        query = self._async_queries[query_id]
+        if query['status'] != 'RUNNING':
+            return False
+        query['status'] = 'ABORTED'
+        with _lock:
+            _aborted.append(query['sql'])
+        return True
+
+    def get_query_status_throw_if_error(self, query_id):
+        """投入したクエリの状態（'RUNNING' / 'SUCCESS' / 'ABORTED'）"""
+        query = self._async_queries[query_id]
+        if query['status'] == 'RUNNING' and time.monotonic() >= query['ready_at']:
+            query['status'] = 'SUCCESS'
+        return query['status']
+
+    def is_still_running(self, status):
+        return status == 'RUNNING'
+
+    def cursor(self):
+        return LocalSnowflakeCursor(self)
+
+    def is_closed(self):
+        return self._closed
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if not self._closed:
+            self._conn.close()
+            self._closed = True
+
+
+# 実行したSQLと、実行中に取り消したSQL（ベンチマークで問い合わせ回数を数えるため）
+_queries = []
+_aborted = []
+_lock = threading.Lock()
+
+
+def connect(path=None, latency=None, **conn_info):
+    """snowflake.connector.connect と同じ形で呼べる接続関数（user・account等の接続情報は無視する）"""
+    return LocalSnowflakeConnection(
+        path or LOCAL_SNOWFLAKE_PATH,
+        LOCAL_SNOWFLAKE_LATENCY if latency is None else latency,
+    )
+
+
+def register(path=None, latency=None, name=BACKEND_NAME):
+    """data_accessのバックエンドとして登録する。登録したバックエンド名を返す"""
+    data_access.register_backend(name, lambda: connect(path, latency), dialect='sqlite')
+    return name
+
+
+def executed_queries(clear=False):
+    """これまでに実行したSQLのリスト"""
+    with _lock:
+        queries = list(_queries)
+        if clear:
+            _queries.clear()
+    return queries
+
+
+def aborted_queries(clear=False):
+    """これまでに取り消したSQLのリスト"""
+    with _lock:
+        queries = list(_aborted)
+        if clear:
+            _aborted.clear()
+    return queries
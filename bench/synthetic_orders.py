@@ -0,0 +1,111 @@
+"""ORDERSテーブルと同じ25カラムの合成データを生成する
+
+実行例（リポジトリのルートで）:
+    python -m bench.synthetic_orders --rows 1000000 --sqlite orders.db
+    DATA_BACKEND=sqlite SQLITE_PATH=orders.db streamlit run app.py
+
+1万〜1000万行を想定し、sqliteへはチャンクごとに生成して書き込むため、メモリには1チャンク分しか載らない。
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+STATUSES = ["Shipped", "Cancelled", "Resolved", "On Hold", "In Process", "Disputed"]
+PRODUCTLINES = ["Classic Cars", "Motorcycles", "Planes", "Ships", "Trains", "Trucks and Buses", "Vintage Cars"]
+COUNTRIES = ["USA", "France", "Spain", "Australia", "UK", "Italy", "Finland", "Norway", "Singapore", "Canada",
+             "Denmark", "Germany", "Sweden", "Austria", "Japan", "Switzerland", "Belgium", "Philippines", "Ireland"]
+TERRITORIES = ["NA", "EMEA", "APAC", "Japan"]
+DEALSIZES = ["Small", "Medium", "Large"]
+
+
+def generate_orders(rows, seed=0, start=0, total_rows=None):
+    """rows行の合成ORDERSをDataFrameで返す
+
+    カーディナリティは元データ（Kaggleのsample sales data）に近づけている。
+    start: 先頭行の通し番号（チャンクに分けて生成する場合に、注文番号が重複しないようにする）
+    total_rows: 全体の行数（顧客数・都市数をチャンクの大きさではなく全体の行数に合わせる）
+    """
+    rng = np.random.default_rng(seed)
+    total_rows = total_rows or start + rows
+    n_customers = max(92, total_rows // 300)
+    n_products = 109
+    n_cities = max(73, total_rows // 1000)
+    row_id = start + np.arange(rows)
+
+    customer = rng.integers(0, n_customers, rows)
+    product = rng.integers(0, n_products, rows)
+    quantity = rng.integers(6, 98, rows)
+    price = rng.uniform(26.0, 100.0, rows).round(2)
+    msrp = (33 + product * 1.7).astype(np.int64)
+    year = rng.integers(2003, 2006, rows)
+    month = rng.integers(1, 13, rows)
+    sales = (quantity * price * rng.uniform(0.9, 1.6, rows)).round(2)
+
+    return pd.DataFrame({
+        "ORDERNUMBER": 10100 + row_id // 10,
+        "QUANTITYORDERED": quantity,
+        "PRICEEACH": price,
+        "ORDERLINENUMBER": row_id % 10 + 1,
+        "SALES": sales,
+        "ORDERDATE": pd.to_datetime({"year": year, "month": month, "day": rng.integers(1, 29, rows)}),
+        "STATUS": np.array(STATUSES)[rng.choice(len(STATUSES), rows, p=[0.92, 0.02, 0.02, 0.02, 0.01, 0.01])],
+        "QTR_ID": (month - 1) // 3 + 1,
+        "MONTH_ID": month,
+        "YEAR_ID": year,
+        "PRODUCTLINE": np.array(PRODUCTLINES)[product % len(PRODUCTLINES)],
+        "MSRP": msrp,
+        "PRODUCTCODE": np.char.add("S", product.astype(str)),
+        "CUSTOMERNAME": np.char.add("Customer ", customer.astype(str)),
+        "PHONE": np.char.add("+1 555 ", (1000000 + customer).astype(str)),
+        "ADDRESSLINE1": np.char.add(customer.astype(str), " Market Street"),
+        "ADDRESSLINE2": np.where(customer % 9 == 0, np.char.add("Suite ", (customer % 400).astype(str)), None),
+        "CITY": np.char.add("City ", (customer % n_cities).astype(str)),
+        "STATE": np.where(customer % 3 == 0, np.char.add("ST", (customer % 16).astype(str)), None),
+        "POSTALCODE": np.char.zfill((customer % n_cities * 131).astype(str), 5),
+        "COUNTRY": np.array(COUNTRIES)[customer % len(COUNTRIES)],
+        "TERRITORY": np.array(TERRITORIES)[customer % len(TERRITORIES)],
+        "CONTACTLASTNAME": np.char.add("Last", (customer % 77).astype(str)),
+        "CONTACTFIRSTNAME": np.char.add("First", (customer % 72).astype(str)),
+        "DEALSIZE": np.array(DEALSIZES)[np.digitize(sales, [3000, 7000])],
+    })
+
+
+def iter_orders(rows, seed=0, chunk_rows=500_000):
+    """rows行の合成ORDERSをchunk_rows行ずつのDataFrameで返すイテレータ（チャンクごとに乱数の系列を変える）"""
+    for i, start in enumerate(range(0, rows, chunk_rows)):
+        yield generate_orders(min(chunk_rows, rows - start), seed=(seed, i), start=start, total_rows=rows)
+
+
+def write_sqlite(path, rows, seed=0, chunk_rows=500_000, table='orders'):
+    """合成ORDERSをsqliteのファイルに書き込む（既存のテーブルは置き換える）"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+        for chunk in iter_orders(rows, seed, chunk_rows):
+            chunk.to_sql(table, conn, if_exists='append', index=False, chunksize=50_000)
+        # 差分取得（ORDERNUMBER >= 前回の最大値）で全件を走査しないようにする
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_ordernumber ON {table} (ORDERNUMBER)')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000, help='合成ORDERSの行数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-rows', type=int, default=500_000, help='1回に生成・書き込みする行数')
+    parser.add_argument('--sqlite', default='orders.db', help='書き込むsqliteのファイル')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    write_sqlite(args.sqlite, args.rows, args.seed, args.chunk_rows)
+    size_mb = os.path.getsize(args.sqlite) / 1024 ** 2
+    print(f'{args.sqlite}: {args.rows:,} rows  {size_mb:.1f} MB  {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""グラフの作成処理"""
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+# 散布図の描画モードを切り替える行数の閾値
+SCATTER_WEBGL_THRESHOLD = int(os.getenv('SCATTER_WEBGL_THRESHOLD', '5000'))
+SCATTER_SAMPLE_THRESHOLD = int(os.getenv('SCATTER_SAMPLE_THRESHOLD', '100000'))
+SCATTER_BIN_THRESHOLD = int(os.getenv('SCATTER_BIN_THRESHOLD', '1000000'))
+# サンプリング時の点数と乱数シード（同じデータなら毎回同じ点が選ばれる）
+SCATTER_SAMPLE_SIZE = int(os.getenv('SCATTER_SAMPLE_SIZE', '50000'))
+SCATTER_SAMPLE_SEED = int(os.getenv('SCATTER_SAMPLE_SEED', '0'))
+# 2次元ビン分けのビン数（各軸）
+SCATTER_BINS = int(os.getenv('SCATTER_BINS', '100'))
+
+SCATTER_MODE_LABELS = {
+    'svg': 'SVG（全件）',
+    'webgl': 'WebGL（全件）',
+    'sample': 'WebGL（層化サンプリング）',
+    'density': '2次元ビン分け（密度）',
+}
+
+
+def scatter_mode(rows):
+    """行数から散布図の描画モードを決める"""
+    if rows <= SCATTER_WEBGL_THRESHOLD:
+        return 'svg'
+    if rows <= SCATTER_SAMPLE_THRESHOLD:
+        return 'webgl'
+    if rows <= SCATTER_BIN_THRESHOLD:
+        return 'sample'
+    return 'density'
+
+
+def _axis_bins(values, bins):
+    """軸の値をビン番号に変換する。数値は等幅のビン、それ以外はカテゴリごと"""
+    if pd.api.types.is_numeric_dtype(values):
+        arr = values.to_numpy(dtype=np.float64)
+        lo, hi = arr.min(), arr.max()
+        if lo == hi:
+            return np.zeros(len(arr), dtype=np.int64), np.array([lo])
+        edges = np.linspace(lo, hi, bins + 1)
+        index = np.minimum(((arr - lo) * bins / (hi - lo)).astype(np.int64), bins - 1)
+        return index, (edges[:-1] + edges[1:]) / 2
+    codes, labels = pd.factorize(values, sort=True)
+    return codes.astype(np.int64), np.asarray(labels)
+
+
+def stratified_sample(df, x, y, size, seed=SCATTER_SAMPLE_SEED, bins=50):
+    """x, yの2次元グリッドで層化したサンプルを返す
+
+    各セルから件数に比例した数を抽出し、点の少ないセルも最低1点は残す。
+    乱数シードを固定しているため、同じデータからは常に同じサンプルになる。
+    """
+    if len(df) <= size:
+        return df
+    ix, _ = _axis_bins(df[x], bins)
+    iy, _ = _axis_bins(df[y], bins)
+    cell = ix * (iy.max() + 1) + iy
+    rng = np.random.default_rng(seed)
+    # セル順・セル内はランダムな順に並べ、セル内での順位を求める
+    order = np.lexsort((rng.random(len(df)), cell))
+    sorted_cell = cell[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+    counts = np.diff(np.r_[starts, len(order)])
+    rank = np.arange(len(order)) - np.repeat(starts, counts)
+    quota = np.maximum(1, np.round(counts * size / len(df))).astype(np.int64)
+    keep = order[rank < np.repeat(quota, counts)]
+    return df.iloc[np.sort(keep)]
+
+
+def density_grid(df, x, y, bins=SCATTER_BINS):
+    """x, yを2次元にビン分けした件数を返す (件数, xのラベル, yのラベル)"""
+    ix, x_labels = _axis_bins(df[x], bins)
+    iy, y_labels = _axis_bins(df[y], bins)
+    counts = np.bincount(ix * len(y_labels) + iy, minlength=len(x_labels) * len(y_labels))
+    return counts.reshape(len(x_labels), len(y_labels)).T, x_labels, y_labels
+
+
+def scatter_figure(df, x, y, title):
+    """行数に応じた描画方法で散布図を作る
+
+    戻り値は (figure, 描画モード, 描画した点数)。密度表示の場合の点数は件数のあるセル数。
+    """
+    data = df[[x, y]].dropna() if x != y else df[[x]].dropna()
+    mode = scatter_mode(len(data))
+    if mode == 'density':
+        counts, x_labels, y_labels = density_grid(data, x, y)
+        return density_figure(counts, x_labels, y_labels, x, y, title), mode, int(np.count_nonzero(counts))
+    if mode == 'sample':
+        data = stratified_sample(data, x, y, SCATTER_SAMPLE_SIZE)
+    fig = px.scatter(data, x=x, y=y, title=title, render_mode='svg' if mode == 'svg' else 'webgl')
+    return fig, mode, len(data)
+
+
+def density_figure(counts, x_labels, y_labels, x, y, title):
+    """2次元ビンの件数（density_gridと同じ形）から密度のヒートマップを作る"""
+    fig = go.Figure(go.Heatmap(z=np.where(counts > 0, counts, np.nan), x=x_labels, y=y_labels, colorscale='Viridis', colorbar={'title': 'Count'}))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+    return fig
+
+
+def histogram_figure(histogram_df, col, title):
+    """集計エンジンのヒストグラム（ビンごとの件数、または値ごとの件数）から棒グラフを作る"""
+    if 'bin_start' in histogram_df:
+        # 0件（読み込み中等）でも作れるよう、ビンの中央をカラムにしたDataFrameから作る
+        bins_df = histogram_df.assign(bin_mid=(histogram_df['bin_start'] + histogram_df['bin_end']) / 2)
+        fig = px.bar(bins_df, x='bin_mid', y='count', labels={'bin_mid': col}, title=title)
+        fig.update_traces(width=(histogram_df['bin_end'] - histogram_df['bin_start']).tolist())
+        fig.update_layout(bargap=0)
+        return fig
+    return px.bar(histogram_df, x='name', y='count', labels={'name': col}, title=title)
+
+
+def bar_figure(bar_df, category, value, title):
+    """カテゴリごとの集計値 (category, value) から棒グラフを作る"""
+    return px.bar(bar_df, x='category', y='value', labels={'category': category, 'value': value}, title=title)
+
+
+def pie_figure(pie_df, col, title):
+    """値ごとの件数 (name, count) から円グラフを作る"""
+    return px.pie(pie_df, names='name', values='count', labels={'name': col}, title=title)
+
+
+def heatmap_figure(heatmap_df, x_label, y_label, title):
+    """組み合わせごとの件数 (x, y, count) をピボットしてヒートマップを作る"""
+    pivot = heatmap_df.pivot(index='y', columns='x', values='count')
+    return px.imshow(pivot, labels=dict(x=x_label, y=y_label, color="Count"), x=pivot.columns, y=pivot.index, aspect="auto", title=title)
+
+
+def box_figure(summary, col, title):
+    """サーバー側で求めた統計量（summaries.box）から箱ひげ図を作る。外れ値は抽出した分だけ点で描く"""
+    fig = go.Figure()
+    if summary is not None:
+        fig.add_trace(go.Box(
+            x=[col], q1=[summary['q1']], median=[summary['median']], q3=[summary['q3']],
+            lowerfence=[summary['lowerfence']], upperfence=[summary['upperfence']], mean=[summary['mean']],
+            name=col, boxpoints=False,
+        ))
+        if summary['outliers']:
+            fig.add_trace(go.Scatter(
+                x=[col] * len(summary['outliers']), y=summary['outliers'], mode='markers',
+                name='外れ値', marker={'size': 4},
+            ))
+    fig.update_layout(title=title, yaxis_title=col, showlegend=False)
+    return fig
@@ -0,0 +1,201 @@
+"""ChatGPTへの問い合わせ
+
+応答はストリーミングで受け取り、届いた分から表示する。
+クライアントは差し替え可能で、ローカル検証時は OPENAI_API_BASE にフェイクのサーバー
+（bench/fake_openai_server.py）を指定するか、register_chat_client で登録したクライアントを使う。
+"""
+import collections
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from tokens import count_message_tokens, count_tokens
+
+load_dotenv()
+
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# OpenAI APIの接続先（未指定なら本番のAPI。フェイクのサーバーを使う場合は http://127.0.0.1:8765/v1 等）
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
+# チャットのクライアント名（'openai' / register_chat_clientで登録した名前）
+CHAT_BACKEND = os.getenv('CHAT_BACKEND', 'openai')
+# 使用するモデル
+CHAT_MODEL = os.getenv('CHAT_MODEL', 'gpt-4-0125-preview')
+# 応答全体の待ち時間の上限（秒）。超えたら受信を打ち切る
+CHAT_TIMEOUT = float(os.getenv('CHAT_TIMEOUT', '60'))
+# 応答を届いた分から表示するか（0なら全文が届いてから表示する）
+CHAT_STREAM = os.getenv('CHAT_STREAM', '1') == '1'
+# 応答キャッシュの保存先（空文字ならキャッシュしない）・有効期限（秒）・容量（MB）
+CHAT_CACHE_DIR = os.getenv('CHAT_CACHE_DIR', '.chat_cache')
+CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', str(7 * 24 * 3600)))
+CHAT_CACHE_SIZE_MB = float(os.getenv('CHAT_CACHE_SIZE_MB', '256'))
+# OpenAI APIへの問い合わせの同時実行数・順番待ちの上限・1分あたりのトークン数の上限（全セッション合計）
+CHAT_MAX_CONCURRENCY = int(os.getenv('CHAT_MAX_CONCURRENCY', '2'))
+CHAT_MAX_QUEUE = int(os.getenv('CHAT_MAX_QUEUE', '20'))
+CHAT_TOKENS_PER_MINUTE = int(os.getenv('CHAT_TOKENS_PER_MINUTE', '30000'))
+# 順番待ちの時点での応答のトークン数の見積もり
+CHAT_EXPECTED_COMPLETION_TOKENS = int(os.getenv('CHAT_EXPECTED_COMPLETION_TOKENS', '500'))
+# 順番待ちの上限（秒）と、レート制限等の一時的なエラーでの試行回数
+CHAT_QUEUE_TIMEOUT = float(os.getenv('CHAT_QUEUE_TIMEOUT', '120'))
+CHAT_RETRY_ATTEMPTS = int(os.getenv('CHAT_RETRY_ATTEMPTS', '5'))
+# ORDERSのデータに基づいて回答する場合に、集計結果のコンテキストに使うトークン数の上限
+CHAT_CONTEXT_TOKENS = int(os.getenv('CHAT_CONTEXT_TOKENS', '1500'))
+
+SYSTEM_MESSAGE = "You are a helpful assistant."
+
+
+class ChatClient:
+    """チャットの応答をストリーミングで返すクライアント"""
+
+    def stream(self, messages, model, timeout):
+        """応答のテキストを届いた順に返すイテレータ
+
+        timeoutは接続・受信待ちの上限（秒）。呼び出し側がイテレータを閉じたら受信をやめる。
+        """
+        raise NotImplementedError
+
+
+class OpenAIChatClient(ChatClient):
+    """OpenAI APIのChatCompletionをstream=Trueで呼び出す"""
+
+    def __init__(self, api_key=OPENAI_API_KEY, api_base=OPENAI_API_BASE):
+        self.api_key = api_key
+        self.api_base = api_base
+
+    def stream(self, messages, model, timeout):
+        # openaiは読み込みに時間がかかるため、問い合わせるときに初めて読み込む
+        import openai
+        options = {'api_base': self.api_base} if self.api_base else {}
+        response = openai.ChatCompletion.create(
+            model=model, messages=messages, stream=True,
+            api_key=self.api_key, request_timeout=timeout, **options,
+        )
+        try:
+            for chunk in response:
+                content = chunk['choices'][0].get('delta', {}).get('content')
+                if content:
+                    yield content
+        finally:
+            response.close()
+
+
+_clients = {'openai': OpenAIChatClient}
+
+
+def api_error():
+    """OpenAI APIのエラーの基底クラス（except節で使う。openaiはここで初めて読み込む）"""
+    import openai
+    return openai.error.OpenAIError
+
+
+def register_chat_client(name, factory):
+    """チャットのクライアントを登録する（factoryは引数なしでChatClientを返す関数）"""
+    _clients[name] = factory
+
+
+def chat_client(backend=None):
+    return _clients[backend or CHAT_BACKEND]()
+
+
+def build_messages(user_input, system_message=SYSTEM_MESSAGE):
+    return [{"role": "system", "content": system_message}, {"role": "user", "content": user_input}]
+
+
+def stream_chat(client, messages, model=CHAT_MODEL, timeout=CHAT_TIMEOUT, on_finish=None):
+    """応答を届いた順に返し、終了時に計測結果をon_finishへ渡す
+
+    計測結果は辞書で、status（'completed' / 'timeout' / 'cancelled' / 'error'）、
+    ttft（最初の応答までの秒数）、elapsed（全体の秒数）、chunks（受け取った断片の数）、
+    prompt_tokens / completion_tokens（tiktokenで数えたトークン数）、
+    tokens_per_sec（最初の応答以降の受信速度）、text（受け取ったテキスト）を持つ。
+    表示の途中で再実行（停止ボタン等）されるとイテレータが閉じられ、'cancelled' になる。
+    """
+    metrics = {'status': 'error', 'model': model, 'ttft': None, 'chunks': 0}
+    parts = []
+    start = time.monotonic()
+    chunks = client.stream(messages, model, timeout)
+    try:
+        for text in chunks:
+            if metrics['ttft'] is None:
+                metrics['ttft'] = time.monotonic() - start
+            metrics['chunks'] += 1
+            parts.append(text)
+            yield text
+            if time.monotonic() - start > timeout:
+                metrics['status'] = 'timeout'
+                break
+        else:
+            metrics['status'] = 'completed'
+    except GeneratorExit:
+        metrics['status'] = 'cancelled'
+        raise
+    finally:
+        chunks.close()
+        metrics['elapsed'] = time.monotonic() - start
+        metrics['text'] = ''.join(parts)
+        metrics['prompt_tokens'] = count_message_tokens(messages, model)
+        metrics['completion_tokens'] = count_tokens(metrics['text'], model)
+        streaming = metrics['elapsed'] - (metrics['ttft'] or 0)
+        metrics['tokens_per_sec'] = metrics['completion_tokens'] / streaming if streaming > 0 else None
+        if on_finish is not None:
+            on_finish(metrics)
+
+
+def answer_chat(client, messages, cache=None, model=CHAT_MODEL, timeout=CHAT_TIMEOUT, on_finish=None):
+    """キャッシュにあればすぐに返し、無ければstream_chatで問い合わせて最後まで受け取れた応答を保存する
+
+    キャッシュから返した場合の計測結果はstatusが'cached'で、トークン数は保存時のもの。
+    """
+    cached = cache.get(messages, model) if cache is not None else None
+    if cached is not None:
+        if on_finish is not None:
+            on_finish({
+                'status': 'cached', 'model': model, 'ttft': 0.0, 'elapsed': 0.0, 'chunks': 1,
+                'tokens_per_sec': None, **cached,
+            })
+        yield cached['text']
+        return
+
+    def finish(metrics):
+        if cache is not None and metrics['status'] == 'completed':
+            cache.set(messages, model, metrics['text'], metrics['prompt_tokens'], metrics['completion_tokens'])
+        if on_finish is not None:
+            on_finish(metrics)
+
+    yield from stream_chat(client, messages, model, timeout, finish)
+
+
+class ChatMetricsLog:
+    """直近の問い合わせの計測結果を保持する（プロセス全体で共有する）"""
+
+    def __init__(self, maxlen=200):
+        self._records = collections.deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, metrics):
+        with self._lock:
+            self._records.append({k: v for k, v in metrics.items() if k != 'text'})
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def stats(self):
+        """TTFTと受信速度の中央値・p95、状態ごとの件数、トークン数の合計
+
+        saved_tokensはキャッシュから返したことで問い合わせずに済んだトークン数。
+        """
+        records = self.records()
+        stats = dict(collections.Counter(r['status'] for r in records))
+        for key in ('prompt_tokens', 'completion_tokens'):
+            stats[key] = sum(r.get(key) or 0 for r in records if r['status'] != 'cached')
+        stats['saved_tokens'] = sum(
+            (r.get('prompt_tokens') or 0) + (r.get('completion_tokens') or 0) for r in records if r['status'] == 'cached'
+        )
+        for key in ('ttft', 'tokens_per_sec'):
+            values = sorted(r[key] for r in records if r.get(key) is not None)
+            if values:
+                stats[f'{key}_p50'] = round(values[len(values) // 2], 3)
+                stats[f'{key}_p95'] = round(values[min(len(values) - 1, int(len(values) * 0.95))], 3)
+        return stats
@@ -0,0 +1,58 @@
+"""ChatGPTの応答をディスクにキャッシュする
+
+同じ（表記ゆれを除いて同じ）質問・モデル・システムメッセージへの応答はキャッシュから返し、
+有料で時間のかかる問い合わせを繰り返さない。diskcacheを使うため、プロセス間でも共有される。
+"""
+import hashlib
+import json
+import re
+import unicodedata
+
+import diskcache
+
+
+def normalize_prompt(text):
+    """表記ゆれを除いた質問文（全角・半角、大文字・小文字、空白、末尾の句読点の違いを無視する）"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?？!！.。 ')
+
+
+def cache_key(messages, model):
+    """モデルとメッセージ（正規化したもの）から作るキー"""
+    normalized = [[m['role'], normalize_prompt(m['content'])] for m in messages]
+    payload = json.dumps([model, normalized], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """有効期限とサイズ上限付きの応答キャッシュ
+
+    directory: キャッシュの保存先
+    ttl: 有効期限（秒）
+    size_limit: 合計サイズの上限（バイト）。超えたら最も長く使われていないものから削除する
+    """
+
+    def __init__(self, directory, ttl, size_limit):
+        self.ttl = ttl
+        self._cache = diskcache.Cache(
+            directory, size_limit=int(size_limit), eviction_policy='least-recently-used', statistics=True,
+        )
+
+    def get(self, messages, model):
+        """キャッシュされた応答 {'text', 'prompt_tokens', 'completion_tokens'}。無ければNone"""
+        return self._cache.get(cache_key(messages, model))
+
+    def set(self, messages, model, text, prompt_tokens, completion_tokens):
+        self._cache.set(
+            cache_key(messages, model),
+            {'text': text, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens},
+            expire=self.ttl,
+        )
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        hits, misses = self._cache.stats()
+        return {'hits': hits, 'misses': misses, 'entries': len(self._cache), 'bytes': self._cache.volume()}
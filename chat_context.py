@@ -0,0 +1,156 @@
+"""ORDERSの集計結果からChatGPTに渡すコンテキストを組み立てる
+
+行データではなく集計キューブ等の集計結果を要約ブロックにし、質問との関連度の高い順に、
+トークン数の上限に収まるだけ詰める。テーブルが大きくなってもプロンプトのトークン数は増えない。
+"""
+import re
+import unicodedata
+from collections import namedtuple
+
+from columns import column_mapping
+
+# 要約ブロック。title: 見出し / terms: 質問に含まれていれば関連があるとみなす語 /
+# values: ブロック内のグループの値（質問に含まれていれば関連が高い） / lines: 本文の行（重要な順）
+SummaryBlock = namedtuple('SummaryBlock', ['title', 'terms', 'values', 'lines'])
+
+# 集計キューブから要約を作る次元と、カラムごとに関連があるとみなす語
+BLOCK_DIMENSIONS = {
+    'PRODUCTLINE': ['製品', '商品', 'product'],
+    'COUNTRY': ['国', '国別', 'country'],
+    'YEAR_ID': ['年', '年別', '推移', 'year'],
+    'QTR_ID': ['四半期', 'quarter'],
+    'MONTH_ID': ['月', '月別', '季節', 'month'],
+    'TERRITORY': ['地域', 'エリア', 'territory'],
+    'DEALSIZE': ['取引規模', '規模', 'deal'],
+    'STATUS': ['ステータス', '状態', '出荷', 'キャンセル', 'status'],
+}
+# 2つの次元を組み合わせた要約（売上の内訳）
+BLOCK_PAIRS = [('PRODUCTLINE', 'YEAR_ID'), ('COUNTRY', 'YEAR_ID'), ('PRODUCTLINE', 'COUNTRY')]
+# 売上に関する語（全体の要約に関連があるとみなす）
+SALES_TERMS = ['売上', '売り上げ', '合計', '全体', 'sales', 'revenue']
+
+OVERVIEW_TITLE = '全体'
+# 要約に含める売上上位の顧客の数
+TOP_CUSTOMERS = 10
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', str(text)).casefold()
+
+
+def _fmt(value):
+    return f'{value:,.0f}' if abs(value) >= 100 else f'{value:,.2f}'
+
+
+def build_summary_blocks(cube, customers=None, top_customers=TOP_CUSTOMERS):
+    """集計キューブ（と顧客ごとの売上）から要約ブロックのリストを作る
+
+    customers: 顧客ごとの売上 (category, value)。Noneなら顧客のブロックは作らない
+    """
+    blocks = []
+    overall = cube.rollup(['YEAR_ID']).sum()
+    blocks.append(SummaryBlock(
+        OVERVIEW_TITLE, SALES_TERMS, [],
+        [
+            f"注文明細数: {int(overall['n']):,}",
+            f"売上合計: {_fmt(overall['SALES_sum'])}",
+            f"注文数量合計: {_fmt(overall['QUANTITYORDERED_sum'])}",
+            f"平均単価: {_fmt(overall['PRICEEACH_sum'] / max(overall['PRICEEACH_n'], 1))}",
+        ],
+    ))
+    for col, terms in BLOCK_DIMENSIONS.items():
+        table = cube.rollup([col]).sort_values('SALES_sum', ascending=False)
+        lines = [
+            f"{value}: 売上{_fmt(row['SALES_sum'])} / 件数{int(row['n']):,} / 平均売上{_fmt(row['SALES_sum'] / max(row['SALES_n'], 1))}"
+            f" / 数量{_fmt(row['QUANTITYORDERED_sum'])}"
+            for value, row in table.iterrows()
+        ]
+        blocks.append(SummaryBlock(
+            f'{column_mapping[col]}（{col}）別の売上', [normalize(col), normalize(column_mapping[col]), *terms],
+            [normalize(v) for v in table.index], lines,
+        ))
+    for a, b in BLOCK_PAIRS:
+        table = cube.rollup([a, b]).sort_values('SALES_sum', ascending=False)
+        lines = [f"{va} × {vb}: 売上{_fmt(row['SALES_sum'])} / 件数{int(row['n']):,}" for (va, vb), row in table.iterrows()]
+        values = {normalize(v) for v in table.index.get_level_values(0)} | {normalize(v) for v in table.index.get_level_values(1)}
+        blocks.append(SummaryBlock(
+            f'{column_mapping[a]}×{column_mapping[b]}別の売上',
+            [normalize(a), normalize(b), normalize(column_mapping[a]), normalize(column_mapping[b]), *BLOCK_DIMENSIONS[a], *BLOCK_DIMENSIONS[b]],
+            sorted(values), lines,
+        ))
+    if customers is not None and len(customers):
+        top = customers.dropna().sort_values('value', ascending=False).head(top_customers)
+        blocks.append(SummaryBlock(
+            f'売上上位{len(top)}社の顧客', ['顧客', '取引先', '上位', 'customer', normalize('CUSTOMERNAME')],
+            [normalize(v) for v in top['category']],
+            [f'{i}. {row.category}: 売上{_fmt(row.value)}' for i, row in enumerate(top.itertuples(), 1)],
+        ))
+    return blocks
+
+
+def score_block(block, question):
+    """質問との関連度。見出しの語は1語につき2点、グループの値は1つにつき3点"""
+    question = normalize(question)
+    score = sum(2 for term in set(block.terms) if term and term in question)
+    for value in block.values:
+        if value.isdigit():
+            # 数字は前後が数字でない箇所だけを数え、1〜2桁（月・四半期等）は偶然の一致が多いため数えない
+            if len(value) >= 4 and re.search(rf'(?<!\d){value}(?!\d)', question):
+                score += 3
+        elif len(value) >= 2 and value in question:
+            score += 3
+    return score
+
+
+def build_context(blocks, question, budget, count_tokens, default_titles=2):
+    """関連度の高い順に、トークン数がbudgetに収まるだけブロックを詰めた文字列を返す
+
+    全体の要約は常に先頭に入れる。関連のあるブロックが無い場合は、全体の次のdefault_titles個を入れる。
+    収まらないブロックは収まる行までで切り、1行も入らなければ次のブロックを試す。
+    戻り値は (コンテキストの文字列, 入れたブロックの見出しのリスト, トークン数)。
+    """
+    scored = [(score_block(b, question), i, b) for i, b in enumerate(blocks)]
+    overview = [b for s, i, b in scored if b.title == OVERVIEW_TITLE]
+    relevant = [b for s, i, b in sorted(scored, key=lambda x: (-x[0], x[1])) if s > 0 and b.title != OVERVIEW_TITLE]
+    if not relevant:
+        relevant = [b for b in blocks if b.title != OVERVIEW_TITLE][:default_titles]
+
+    parts, titles, used = [], [], 0
+    for block in overview + relevant:
+        header = f'## {block.title}'
+        cost = count_tokens(header) + 1
+        lines = []
+        for line in block.lines:
+            line_cost = count_tokens(line) + 1
+            if used + cost + line_cost > budget:
+                break
+            lines.append(line)
+            cost += line_cost
+        if len(lines) < len(block.lines):
+            # 省略した旨の行も上限に収まるよう、入れた行を減らす
+            while lines:
+                note = f'（ほか{len(block.lines) - len(lines)}件は省略）'
+                if used + cost + count_tokens(note) + 1 <= budget:
+                    lines.append(note)
+                    cost += count_tokens(note) + 1
+                    break
+                cost -= count_tokens(lines.pop()) + 1
+        if not lines:
+            continue
+        parts.append('\n'.join([header, *lines]))
+        titles.append(block.title)
+        used += cost
+    # 行ごとに数えた合計と、つなげた文字列のトークン数はわずかに異なるため、最後に確かめる
+    while parts and count_tokens('\n\n'.join(parts)) > budget:
+        parts.pop()
+        titles.pop()
+    context = '\n\n'.join(parts)
+    return context, titles, count_tokens(context)
+
+
+def grounded_system_message(context):
+    return (
+        "You are a helpful assistant. 以下はSnowflakeのORDERSテーブル（売上データ）の集計結果です。"
+        "この集計結果に基づいて日本語で回答し、集計結果から分からないことは分からないと答えてください。\n\n"
+        + context
+    )
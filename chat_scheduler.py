@@ -0,0 +1,218 @@
+"""OpenAI APIへの問い合わせの順番待ちとリトライ
+
+全セッションが1つのAPIキーを共有するため、プロセス全体で同時実行数と1分あたりのトークン数を制限し、
+超えた分は先着順に待たせる。レート制限（429）等の一時的なエラーは、ジッター付きの指数バックオフで
+リトライする（応答を表示し始める前までに限る）。
+"""
+import collections
+import itertools
+import threading
+import time
+
+import tenacity
+
+import chat
+from chat import ChatClient
+from tokens import count_message_tokens, count_tokens
+
+
+def retryable_errors():
+    """リトライする一時的なエラー（openaiは問い合わせるときに初めて読み込む）"""
+    import openai
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    )
+
+
+class SchedulerError(Exception):
+    """順番待ちに入れなかった、または待ち時間が上限を超えた"""
+
+
+class QueueFull(SchedulerError):
+    pass
+
+
+class QueueTimeout(SchedulerError):
+    pass
+
+
+class ChatScheduler:
+    """同時実行数と1分あたりのトークン数を制限する先着順のキュー
+
+    max_concurrency: 同時に問い合わせる数の上限
+    max_queue: 待っている要求の数の上限（超えたらQueueFull）
+    tokens_per_minute: 直近60秒間に使うトークン数（見積もり）の上限
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, max_concurrency=2, max_queue=20, tokens_per_minute=30000):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.tokens_per_minute = tokens_per_minute
+        self._cond = threading.Condition()
+        self._waiting = collections.deque()
+        self._running = 0
+        # 直近60秒間に開始した要求の [開始時刻, トークン数]
+        self._window = collections.deque()
+        self._tickets = itertools.count()
+        self._counters = collections.Counter()
+        self._wait_times = collections.deque(maxlen=1000)
+
+    def _window_tokens(self, now):
+        while self._window and now - self._window[0][0] >= self.WINDOW:
+            self._window.popleft()
+        return sum(tokens for _, tokens in self._window)
+
+    def _budget_wait(self, tokens, now):
+        """トークンの枠が空くまでの秒数（すぐ使えるなら0）"""
+        used = self._window_tokens(now)
+        # 枠より大きい要求も、他に使っている要求が無ければ通す
+        if used == 0 or used + tokens <= self.tokens_per_minute:
+            return 0.0
+        return self.WINDOW - (now - self._window[0][0])
+
+    def acquire(self, tokens, on_wait=None, timeout=None, poll=0.5):
+        """順番が来るまで待ち、要求の記録（releaseに渡す）を返す
+
+        tokens: この要求で使うトークン数の見積もり
+        on_wait: 待っている間、on_wait(先頭からの順番) の形で定期的に呼ばれる
+        """
+        start = time.monotonic()
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._counters['rejected'] += 1
+                raise QueueFull(f'順番待ちが{self.max_queue}件に達しています')
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    position = self._waiting.index(ticket) + 1
+                    delay = poll
+                    if position == 1 and self._running < self.max_concurrency:
+                        budget_wait = self._budget_wait(tokens, now)
+                        if budget_wait == 0:
+                            self._waiting.popleft()
+                            self._running += 1
+                            entry = [now, tokens]
+                            self._window.append(entry)
+                            self._counters['started'] += 1
+                            self._wait_times.append(now - start)
+                            self._cond.notify_all()
+                            return entry
+                        delay = min(poll, budget_wait)
+                    if timeout is not None and now - start >= timeout:
+                        self._counters['timeouts'] += 1
+                        raise QueueTimeout(f'{timeout}秒以内に順番が来ませんでした')
+                if on_wait is not None:
+                    on_wait(position)
+                with self._cond:
+                    self._cond.wait(delay)
+        except BaseException:
+            # 待っている間に中断された場合も、後ろの要求が進めるようにキューから外す
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+            raise
+
+    def release(self, entry, used_tokens=None):
+        """要求の終了。使ったトークン数が分かれば見積もりを置き換える"""
+        with self._cond:
+            self._running -= 1
+            if used_tokens is not None:
+                entry[1] = used_tokens
+            self._cond.notify_all()
+
+    def count_retry(self):
+        with self._cond:
+            self._counters['retries'] += 1
+
+    def stats(self):
+        """待っている数・実行中の数・直近60秒のトークン数と、待ち時間の統計"""
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update(
+                waiting=len(self._waiting), running=self._running,
+                window_tokens=self._window_tokens(time.monotonic()), tokens_per_minute=self.tokens_per_minute,
+            )
+            waits = sorted(self._wait_times)
+        if waits:
+            stats['wait_avg_ms'] = round(sum(waits) / len(waits) * 1000, 2)
+            stats['wait_p95_ms'] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2)
+            stats['wait_max_ms'] = round(waits[-1] * 1000, 2)
+        return stats
+
+
+class ScheduledChatClient(ChatClient):
+    """ChatSchedulerの順番を待ってから問い合わせ、一時的なエラーはリトライするクライアント
+
+    client: 実際に問い合わせるChatClient
+    count_message_tokens: count_message_tokens(messages, model) の形で呼ばれ、プロンプトのトークン数を返す関数
+    count_tokens: count_tokens(text, model) の形で呼ばれ、応答のトークン数を返す関数
+    expected_completion_tokens: 応答のトークン数の見積もり（順番待ちの時点では分からないため）
+    on_wait: 順番待ちの間に on_wait(順番) の形で呼ばれる（待ち終わったら on_wait(0)）
+    """
+
+    def __init__(self, client, scheduler, count_message_tokens, count_tokens, expected_completion_tokens=500,
+                 attempts=5, max_backoff=30.0, on_wait=None, queue_timeout=None):
+        self._client = client
+        self._scheduler = scheduler
+        self._count_message_tokens = count_message_tokens
+        self._count_tokens = count_tokens
+        self._expected_completion_tokens = expected_completion_tokens
+        self._attempts = attempts
+        self._max_backoff = max_backoff
+        self._on_wait = on_wait
+        self._queue_timeout = queue_timeout
+
+    def _start(self, messages, model, timeout):
+        """最初の応答が届くまでをリトライする。(最初のテキスト, 残りのイテレータ) を返す"""
+        retrying = tenacity.Retrying(
+            retry=tenacity.retry_if_exception_type(retryable_errors()),
+            wait=tenacity.wait_random_exponential(multiplier=0.5, max=self._max_backoff),
+            stop=tenacity.stop_after_attempt(self._attempts),
+            before_sleep=lambda state: self._scheduler.count_retry(),
+            reraise=True,
+        )
+        for attempt in retrying:
+            with attempt:
+                chunks = self._client.stream(messages, model, timeout)
+                return next(chunks, None), chunks
+
+    def stream(self, messages, model, timeout):
+        prompt_tokens = self._count_message_tokens(messages, model)
+        entry = self._scheduler.acquire(prompt_tokens + self._expected_completion_tokens, self._on_wait, self._queue_timeout)
+        parts = []
+        chunks = None
+        try:
+            if self._on_wait is not None:
+                self._on_wait(0)
+            first, chunks = self._start(messages, model, timeout)
+            if first is None:
+                return
+            parts.append(first)
+            yield first
+            for text in chunks:
+                parts.append(text)
+                yield text
+        finally:
+            if chunks is not None:
+                chunks.close()
+            # 見積もりを、プロンプトと実際に受け取った応答のトークン数に置き換える
+            self._scheduler.release(entry, prompt_tokens + self._count_tokens(''.join(parts), model))
+
+
+def scheduled_chat_client(client, scheduler, on_wait=None):
+    """環境変数の設定（chatモジュール）に従ってScheduledChatClientを作る"""
+    return ScheduledChatClient(
+        client, scheduler, count_message_tokens, count_tokens,
+        expected_completion_tokens=chat.CHAT_EXPECTED_COMPLETION_TOKENS, attempts=chat.CHAT_RETRY_ATTEMPTS,
+        on_wait=on_wait, queue_timeout=chat.CHAT_QUEUE_TIMEOUT,
+    )
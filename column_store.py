@@ -0,0 +1,285 @@
+"""カラム単位でORDERSをキャッシュするストア
+
+グラフで新しいカラムが選ばれたときは、そのカラムだけを取得して既存のカラムに結合する。
+ORDERSは行が増えるだけなので、更新時はウォーターマーク以降の行だけを取得して追記する。
+絞り込み（クロスフィルタ）を指定した場合は、値ごとの行番号の索引から当てはまる行を求め、
+絞り込んだ行のカラム（ビュー）をセッション・グラフ間で共有する。
+"""
+import collections
+import threading
+import time
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from filters import ValueIndex, select_rows
+
+# 行を一意に特定するキー。カラムを後から取得しても、このキーで行を揃えて結合する
+ORDER_KEY = ["ORDERNUMBER", "ORDERLINENUMBER"]
+
+
+class ColumnStore:
+    """取得済みのカラムを保持し、不足分だけを取得する
+
+    fetch: fetch(カラム名のリスト, since) の形で呼ばれ、ORDER_KEYとウォーターマークのカラムを
+        含むDataFrameを返す関数。sinceがNone以外のときは、ウォーターマークのカラムが
+        since以上の行だけを返す。
+    watermark_column: 差分取得の基準にする、単調増加するカラム
+    compact: compact(カラム名, Series) の形で呼ばれ、省メモリな型にしたSeriesを返す関数（任意）
+    max_views: 保持する絞り込んだ行（ビュー）の数
+    """
+
+    def __init__(self, fetch, watermark_column="ORDERNUMBER", compact=None, max_views=4):
+        self._fetch = fetch
+        self.watermark_column = watermark_column
+        self._compact = compact
+        self.max_views = max_views
+        # カラム -> Series。すべてのSeriesの行の並びは self._index と同じ（行番号で絞り込めるように）
+        self._columns = {}
+        # 絞り込み用の、カラム -> 値ごとの行番号の索引と、絞り込み -> (行番号, キー, カラム -> 絞り込んだSeries)。
+        # 行が変わったら（データバージョンが変わったら）作り直す
+        self._indexes = {}
+        self._views = collections.OrderedDict()
+        # カラム名 -> 変換前のバイト数（メモリレポート用）
+        self.memory_before = {}
+        self._lock = threading.Lock()
+        # 差分更新・全件取得を1つのスレッドだけが行うためのロック（取得中も self._lock は読み取りに空けておく）
+        self._refresh_lock = threading.Lock()
+        self._index = None
+        self.version = None
+        self.watermark = None
+        self.refreshed_at = None
+        self.reloaded_at = None
+        # 直近の差分更新で増えた行数
+        self.last_refresh_rows = 0
+        # 保持しているカラムの組が変わるたびに増える番号（データバージョンが同じでもスナップショットを保存し直すため）
+        self.columns_generation = 0
+        # ディスクに保存済みの (データバージョン, カラムの組の番号)
+        self.snapshot_state = None
+
+    def _watermark_of(self, frame):
+        if self.watermark_column in ORDER_KEY:
+            values = frame.index.get_level_values(self.watermark_column)
+        else:
+            values = frame[self.watermark_column]
+        return values.max() if len(values) else None
+
+    def _compacted(self, name, series, reset=True):
+        if self._compact is None:
+            return series
+        before = int(series.memory_usage(deep=True, index=False))
+        self.memory_before[name] = before if reset else self.memory_before.get(name, 0) + before
+        return self._compact(name, series)
+
+    def _set_version(self):
+        # 取得時刻と行数でデータバージョンを表す
+        self.version = f"{time.strftime('%Y%m%d-%H%M%S')}-{len(self._index)}"
+
+    def _clear_views(self):
+        self._indexes = {}
+        self._views.clear()
+
+    def _load(self, columns):
+        frame = self._fetch(columns, None).set_index(ORDER_KEY)
+        self._columns = {col: self._compacted(col, frame[col]) for col in frame.columns}
+        self._index = frame.index
+        self._clear_views()
+        self.columns_generation += 1
+        self.watermark = self._watermark_of(frame)
+        self.refreshed_at = self.reloaded_at = time.monotonic()
+        self.last_refresh_rows = 0
+        self._set_version()
+
+    def get(self, columns, filters=()):
+        """指定されたカラムのDataFrameを返す（未取得のカラムのみ取得する）
+
+        filters（filters.normalize の形）を指定した場合は、当てはまる行だけを返す。
+        """
+        filter_columns = [col for col, _ in filters]
+        with self._lock:
+            missing = [c for c in dict.fromkeys([*columns, *filter_columns]) if c not in self._columns and c not in ORDER_KEY]
+            if self.version is None:
+                self._load(missing)
+            elif missing:
+                # 行の並びを保持しているキーに揃える（取得後に追加された行は、次の差分更新で追記する）
+                frame = self._fetch(missing, None).set_index(ORDER_KEY).reindex(self._index)
+                for col in missing:
+                    self._columns[col] = self._compacted(col, frame[col])
+                self.columns_generation += 1
+            if filters:
+                columns_data, index = self._view(filters, [c for c in columns if c not in ORDER_KEY])
+            else:
+                columns_data = self._columns
+                index = self._index
+            # 差分更新は self._columns のSeriesを置き換えるため、同じ時点のSeriesをロックの中で取り出す
+            parts = [columns_data[c] for c in columns if c not in ORDER_KEY]
+
+        # キーで行を揃えて結合する（キーのカラムはインデックスから復元する）
+        df = pd.concat(parts, axis=1) if parts else pd.DataFrame(index=index)
+        df = df.reset_index()
+        return df[list(columns)]
+
+    def _view(self, filters, columns):
+        """絞り込んだ行のカラムとキー（同じ絞り込みは、作ったビューを共有する）"""
+        view = self._views.get(filters)
+        if view is None:
+            for col, _ in filters:
+                if col not in self._indexes:
+                    self._indexes[col] = ValueIndex(self._columns[col])
+            rows = select_rows([(self._indexes[col], values) for col, values in filters])
+            view = self._views[filters] = (rows, self._index.take(rows), {})
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+        else:
+            self._views.move_to_end(filters)
+        rows, index, taken = view
+        for col in columns:
+            if col not in taken:
+                taken[col] = self._columns[col].take(rows)
+        return taken, index
+
+    def refresh(self):
+        """ウォーターマーク以降の行だけを取得して追記する。増えた行数を返す
+
+        同じウォーターマークの行にも追加があり得るため「以上」で取得し、キーで重複を除く。
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        with self._lock:
+            if self.version is None:
+                return 0
+            columns = list(self._columns)
+            watermark = self.watermark
+        # 取得中も他のセッションは保持済みのデータを読めるよう、ロックの外で問い合わせる
+        frame = self._fetch(columns, watermark).set_index(ORDER_KEY)
+        with self._lock:
+            self.refreshed_at = time.monotonic()
+            # ORDERSは行が増えるだけなので、保持済みのキーの行（ウォーターマークと同じ値の行）は除き、
+            # 新しい行だけを末尾に追記する。保持している行の並びは変えないため、全カラムの並びが揃ったままになる
+            frame = frame[self._index.get_indexer(frame.index) < 0]
+            frame = frame[~frame.index.duplicated(keep='last')]
+            new_rows = len(frame)
+            if new_rows:
+                # 取得中に追加されたカラムは、差分の行では欠損として揃える
+                frame = frame.reindex(columns=list(self._columns))
+                self._index = self._index.append(frame.index)
+                for col, series in self._columns.items():
+                    self._columns[col] = self._append(col, series, frame[col])
+                self._clear_views()
+                latest = self._watermark_of(frame)
+                self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+                self._set_version()
+            self.last_refresh_rows = new_rows
+            return new_rows
+
+    def _append(self, name, series, new):
+        """保持しているSeriesに差分の行を連結する
+
+        省メモリな型への変換は差分の行だけに行い、保持している型に合わせる（category型はカテゴリを統合する）。
+        """
+        new = self._compacted(name, new, reset=False)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            if not isinstance(new.dtype, pd.CategoricalDtype) or new.cat.categories.dtype != series.cat.categories.dtype:
+                new = new.astype(object).astype('category')
+            values = union_categoricals([series.array, new.array])
+        else:
+            if isinstance(series.dtype, pd.StringDtype) or isinstance(new.dtype, pd.CategoricalDtype):
+                new = new.astype(series.dtype)
+            # 数値は両方が収まる型になる（差分の値が保持している型に収まらなければ広げる）
+            values = pd.concat([series, new], ignore_index=True).array
+        return pd.Series(values, index=self._index, name=name)
+
+    def reload(self):
+        """保持しているカラムをすべて取得し直す（差分更新のずれを解消する）"""
+        with self._refresh_lock:
+            self._reload()
+
+    def _reload(self):
+        with self._lock:
+            if self.version is not None:
+                self._load(list(self._columns))
+
+    def stamp(self):
+        """プロセスによらないデータの識別子 (ウォーターマーク, 行数)
+
+        データバージョンは取得時刻を含みプロセスごとに異なるため、プロセス間で共有する
+        キャッシュのキーにはこちらを使う（同じ行を保持していれば、どのプロセスでも同じになる）。
+        """
+        with self._lock:
+            return str(self.watermark), 0 if self._index is None else len(self._index)
+
+    def held_columns(self):
+        """保持しているカラム（カラム名 -> Series）"""
+        with self._lock:
+            return dict(self._columns)
+
+    def state(self):
+        """保持しているデータの状態 (データバージョン, カラムの組の番号)。スナップショットが最新かの判定に使う"""
+        return self.version, self.columns_generation
+
+    def snapshot(self):
+        """保持している全カラムをキー付きのDataFrameにして返す (DataFrame, 状態)。状態は state() と同じ形
+
+        更新はSeriesを置き換える（書き換えない）ため、ロックの中ではSeriesとキーを取り出すだけにし、
+        全行のコピー（結合）は読み取りを止めないようロックの外で行う。
+        """
+        with self._lock:
+            if self.version is None:
+                return None, None
+            columns = list(self._columns.values())
+            index = self._index
+            state = self.state()
+        df = pd.concat(columns, axis=1) if columns else pd.DataFrame(index=index)
+        return df.reset_index(), state
+
+    def restore(self, frame, version, age=0.0):
+        """スナップショットから復元する
+
+        ageは保存からの経過秒数で、全件取得の間隔をこの分だけ進める。
+        最新かどうかの確認（差分更新）は呼び出し側がバックグラウンドで行う。
+        """
+        with self._lock:
+            frame = frame.set_index(ORDER_KEY)
+            self._columns = {col: self._compacted(col, frame[col]) for col in frame.columns}
+            self._index = frame.index
+            self._clear_views()
+            self.columns_generation += 1
+            self.watermark = self._watermark_of(frame)
+            self.version = version
+            self.snapshot_state = self.state()
+            self.refreshed_at = time.monotonic()
+            self.reloaded_at = self.refreshed_at - age
+            self.last_refresh_rows = 0
+
+    def refresh_if_stale(self, ttl, full_reload_interval):
+        """前回の更新からttl秒経っていれば差分更新し、full_reload_interval秒経っていれば全件取得し直す
+
+        期限を同時に過ぎた複数のセッションのうち、更新するのは1つだけで、他のセッションは待たずに
+        保持済みのデータを使う。
+        """
+        if self.version is None or not self._stale(ttl, full_reload_interval):
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            # 最初の判定からロックを取るまでの間に他のスレッドが更新を終えていれば、もう一度問い合わせない
+            stale = self._stale(ttl, full_reload_interval)
+            if stale == 'reload':
+                self._reload()
+            elif stale == 'refresh':
+                self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _stale(self, ttl, full_reload_interval):
+        """必要な更新（'reload' / 'refresh'）。不要ならNone"""
+        with self._lock:
+            reloaded_at, refreshed_at = self.reloaded_at, self.refreshed_at
+        now = time.monotonic()
+        if now - reloaded_at >= full_reload_interval:
+            return 'reload'
+        if now - refreshed_at >= ttl:
+            return 'refresh'
+        return None
@@ -0,0 +1,138 @@
+"""ORDERSテーブルのカラム定義
+
+カラムごとに日本語のラベル・種類・型を持ち、グラフごとに選択肢として適したカラムを絞り込む。
+"""
+from collections import namedtuple
+
+# カラムの種類
+NUMERIC = 'numeric'
+CATEGORICAL = 'categorical'
+TEXT = 'text'
+DATE = 'date'
+
+# name: 英語のカラム名 / label: 日本語のラベル / kind: カラムの種類 / dtype: 'int', 'float', 'str', 'date'
+ColumnInfo = namedtuple('ColumnInfo', ['name', 'label', 'kind', 'dtype'])
+
+COLUMNS = [
+    ColumnInfo("ORDERNUMBER", "注文番号", NUMERIC, 'int'),
+    ColumnInfo("QUANTITYORDERED", "注文数量", NUMERIC, 'int'),
+    ColumnInfo("PRICEEACH", "単価", NUMERIC, 'float'),
+    ColumnInfo("ORDERLINENUMBER", "注文行番号", NUMERIC, 'int'),
+    ColumnInfo("SALES", "売上", NUMERIC, 'float'),
+    ColumnInfo("ORDERDATE", "注文日（データ空です。）", DATE, 'date'),
+    ColumnInfo("STATUS", "ステータス", CATEGORICAL, 'str'),
+    ColumnInfo("QTR_ID", "四半期ID", NUMERIC, 'int'),
+    ColumnInfo("MONTH_ID", "月ID", NUMERIC, 'int'),
+    ColumnInfo("YEAR_ID", "年ID", NUMERIC, 'int'),
+    ColumnInfo("PRODUCTLINE", "製品ライン", CATEGORICAL, 'str'),
+    ColumnInfo("MSRP", "希望小売価格", NUMERIC, 'int'),
+    ColumnInfo("PRODUCTCODE", "製品コード", CATEGORICAL, 'str'),
+    ColumnInfo("CUSTOMERNAME", "顧客名", TEXT, 'str'),
+    ColumnInfo("PHONE", "電話番号", TEXT, 'str'),
+    ColumnInfo("ADDRESSLINE1", "住所1", TEXT, 'str'),
+    ColumnInfo("ADDRESSLINE2", "住所2", TEXT, 'str'),
+    ColumnInfo("CITY", "市区町村", CATEGORICAL, 'str'),
+    ColumnInfo("STATE", "都道府県", CATEGORICAL, 'str'),
+    ColumnInfo("POSTALCODE", "郵便番号", TEXT, 'str'),
+    ColumnInfo("COUNTRY", "国", CATEGORICAL, 'str'),
+    ColumnInfo("TERRITORY", "地域", CATEGORICAL, 'str'),
+    ColumnInfo("CONTACTLASTNAME", "担当者姓", TEXT, 'str'),
+    ColumnInfo("CONTACTFIRSTNAME", "担当者名", TEXT, 'str'),
+    ColumnInfo("DEALSIZE", "取引規模", CATEGORICAL, 'str'),
+]
+
+# 英語のカラム名とそれに対応する日本語訳をマッピングしたオブジェクト
+column_mapping = {c.name: c.label for c in COLUMNS}
+
+# 整数のカラム
+INTEGER_COLUMNS = [c.name for c in COLUMNS if c.dtype == 'int']
+# 小数のカラム
+FLOAT_COLUMNS = [c.name for c in COLUMNS if c.dtype == 'float']
+NUMERIC_COLUMNS = INTEGER_COLUMNS + FLOAT_COLUMNS
+# 日付のカラム
+DATE_COLUMNS = [c.name for c in COLUMNS if c.dtype == 'date']
+# 文字列のカラム
+STRING_COLUMNS = [c.name for c in COLUMNS if c.dtype == 'str']
+
+# 値の種類が少ない文字列カラム（category型で保持する）
+CATEGORY_COLUMNS = [c.name for c in COLUMNS if c.kind == CATEGORICAL]
+# 自由記述に近い文字列カラム（Arrowの文字列型で保持する）
+TEXT_COLUMNS = [c.name for c in COLUMNS if c.kind == TEXT]
+
+# 集計キューブの次元（棒グラフ・円グラフ・ヒートマップのキーになる、値の種類が少ないカラム）
+CUBE_DIMENSIONS = CATEGORY_COLUMNS + ["YEAR_ID", "QTR_ID", "MONTH_ID"]
+# 集計キューブで合計・平均を持つ数値カラム
+CUBE_MEASURES = ["SALES", "QUANTITYORDERED", "PRICEEACH", "MSRP"]
+# サイドバーで絞り込み（クロスフィルタ）に使えるカラム（集計キューブの次元と同じ、値の種類が少ないカラム）
+FILTER_COLUMNS = CUBE_DIMENSIONS
+
+# グラフごとの選択肢の条件: (使えるカラムの種類, 値の種類数の上限, 上限を適用するカラムの種類)
+# 数値・日付を連続値として扱うグラフ（散布図等）では、上限はカテゴリのカラムにだけ適用する。
+# ヒストグラムは日付を値ごとの件数で描くため、日付にも上限を適用する
+CHART_RULES = {
+    'scatter': ({NUMERIC, DATE, CATEGORICAL}, 1000, {CATEGORICAL}),
+    'histogram': ({NUMERIC, DATE, CATEGORICAL}, 200, {DATE, CATEGORICAL}),
+    'box': ({NUMERIC}, None, set()),
+    'bar_category': ({NUMERIC, DATE, CATEGORICAL}, 100, {NUMERIC, DATE, CATEGORICAL}),
+    'bar_value': ({NUMERIC}, None, set()),
+    'pie': ({NUMERIC, CATEGORICAL}, 20, {NUMERIC, CATEGORICAL}),
+    'heatmap': ({NUMERIC, DATE, CATEGORICAL}, 100, {NUMERIC, DATE, CATEGORICAL}),
+}
+
+
+class ColumnRegistry:
+    """カラム名とラベルを相互に引け、グラフごとに適したカラムを返す"""
+
+    def __init__(self, columns):
+        self._by_name = {c.name: c for c in columns}
+        self._by_label = {c.label: c for c in columns}
+        # カラム名 -> 値の種類数（set_cardinalityで更新する）
+        self._cardinality = {}
+        self.cardinality_version = None
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def label(self, name):
+        """英語のカラム名 -> 日本語のラベル"""
+        return self._by_name[name].label
+
+    def name(self, label):
+        """日本語のラベル -> 英語のカラム名"""
+        return self._by_label[label].name
+
+    def kind(self, name):
+        return self._by_name[name].kind
+
+    def set_cardinality(self, stats, version=None):
+        """カラムごとの値の種類数を設定する（データバージョンが変わったときに更新する）"""
+        self._cardinality = dict(stats)
+        self.cardinality_version = version
+
+    def cardinality(self, name):
+        return self._cardinality.get(name)
+
+    def eligible(self, chart):
+        """グラフの選択肢に使えるカラム名のリスト
+
+        値が1つも無いカラムや、種類数が多すぎて集計・描画が重くなるカラムは除く。
+        種類数が未取得のカラムは、種類の条件だけで判定する。
+        """
+        kinds, max_cardinality, limited_kinds = CHART_RULES[chart]
+        names = []
+        for c in self._by_name.values():
+            if c.kind not in kinds:
+                continue
+            n = self._cardinality.get(c.name)
+            if n == 0:
+                continue
+            if c.kind in limited_kinds and max_cardinality is not None and n is not None and n > max_cardinality:
+                continue
+            names.append(c.name)
+        return names
+
+
+registry = ColumnRegistry(COLUMNS)
@@ -0,0 +1,52 @@
+"""ORDERSのメモリ上の表現を小さくする
+
+columnsの定義に従い、値の種類が少ない文字列はcategory型、自由記述の文字列はArrowの文字列型、
+数値は値が収まる最小の幅に変換する。
+"""
+import numpy as np
+import pandas as pd
+
+from columns import CATEGORY_COLUMNS, FLOAT_COLUMNS, INTEGER_COLUMNS, TEXT_COLUMNS
+
+# 値の種類が行数のこの割合を超える場合は、category型にしても小さくならないため変換しない
+CATEGORY_MAX_RATIO = 0.5
+
+
+def compact_series(name, series):
+    """カラム名に応じてSeriesを省メモリな型に変換する"""
+    if name in CATEGORY_COLUMNS:
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        if series.nunique() <= max(1, len(series) * CATEGORY_MAX_RATIO):
+            return series.astype('category')
+        return series.astype('string[pyarrow]')
+    if name in TEXT_COLUMNS:
+        return series.astype('string[pyarrow]')
+    if name in INTEGER_COLUMNS and pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    if name in FLOAT_COLUMNS and series.dtype == np.float64:
+        # 値が変わらない場合だけfloat32にする（集計結果が変わらないように）
+        narrowed = series.astype(np.float32)
+        if ((narrowed.astype(np.float64) == series) | series.isna()).all():
+            return narrowed
+    return series
+
+
+def memory_report(before, columns):
+    """カラムごとのメモリ使用量（変換前・変換後）の表を返す
+
+    before: カラム名 -> 変換前のバイト数
+    columns: カラム名 -> 変換後のSeries
+    """
+    rows = []
+    for name, series in columns.items():
+        after = int(series.memory_usage(deep=True, index=False))
+        rows.append({
+            'column': name,
+            'dtype': str(series.dtype),
+            'before_bytes': before.get(name, after),
+            'after_bytes': after,
+        })
+    report = pd.DataFrame(rows, columns=['column', 'dtype', 'before_bytes', 'after_bytes'])
+    report['ratio'] = (report['after_bytes'] / report['before_bytes'].replace(0, np.nan)).round(3)
+    return report
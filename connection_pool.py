@@ -0,0 +1,195 @@
+"""プロセス全体で共有する接続プール
+
+セッションや再実行のたびに認証・セッション確立を行わないよう、接続を使い回す。
+"""
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """接続の貸し出し待ちがタイムアウトした"""
+
+
+class ConnectionPool:
+    """上限付きの接続プール
+
+    connect: 新しい接続を返す関数
+    max_size: 同時に保持する接続数の上限
+    timeout: 貸し出し待ちの上限（秒）
+    health_check_interval: この秒数以上使われていない接続は貸し出し前に生存確認する
+    passthrough_errors: 接続の状態とは関係の無い例外（クエリの取り消し等）。生存確認をせずにそのまま送出する
+    """
+
+    def __init__(self, connect, max_size=4, timeout=30.0, health_check_interval=60.0, passthrough_errors=()):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.passthrough_errors = tuple(passthrough_errors)
+        # 空き接続 (接続, 最終利用時刻)
+        self._idle = collections.deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        # 貸し出し待ち時間の記録（直近分のみ保持）
+        self._wait_times = collections.deque(maxlen=1000)
+        self._counters = collections.Counter()
+
+    def _acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn = None
+        last_used = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 枠だけ確保し、接続自体はロックの外で作る
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout(f'{self.timeout}秒以内に接続を取得できませんでした')
+                self._cond.wait(remaining)
+
+        if conn is not None and time.monotonic() - last_used > self.health_check_interval:
+            if not self._is_alive(conn):
+                self._counters['health_check_failures'] += 1
+                self._close_quietly(conn)
+                conn = None
+        if conn is None:
+            conn = self._create()
+
+        with self._cond:
+            self._counters['checkouts'] += 1
+            self._wait_times.append(time.monotonic() - start)
+        return conn
+
+    def _create(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._counters['created'] += 1
+        return conn
+
+    def _release(self, conn, broken=False):
+        with self._cond:
+            if broken:
+                self._size -= 1
+                self._counters['discarded'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _is_alive(conn):
+        is_closed = getattr(conn, 'is_closed', None)
+        if callable(is_closed) and is_closed():
+            return False
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute('SELECT 1')
+                cur.fetchone()
+            finally:
+                cur.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """接続を借りて返却する。使用中に接続が切れていれば破棄する"""
+        conn = self._acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = not self._is_alive(conn)
+            raise
+        finally:
+            self._release(conn, broken)
+
+    def run(self, func):
+        """func(conn) を実行する
+
+        セッション切れ等で接続が使えなくなっていた場合は、再接続して一度だけ再実行する。
+        """
+        conn = self._acquire()
+        try:
+            result = func(conn)
+        except self.passthrough_errors:
+            self._release(conn)
+            raise
+        except Exception:
+            if self._is_alive(conn):
+                self._release(conn)
+                raise
+            self._release(conn, broken=True)
+            with self._cond:
+                self._counters['reconnects'] += 1
+        else:
+            self._release(conn)
+            return result
+
+        with self.connection() as conn:
+            return func(conn)
+
+    def keepalive(self):
+        """空き接続の生存確認を行い、切れている接続を破棄する"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._release(conn, broken=not self._is_alive(conn))
+
+    def start_keepalive(self, interval):
+        """interval秒ごとにkeepaliveを行うデーモンスレッドを起動する"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.keepalive()
+
+        thread = threading.Thread(target=loop, name='connection-pool-keepalive', daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """空き接続をすべて閉じる"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """プールの状態と貸し出し待ち時間の統計"""
+        with self._cond:
+            waits = sorted(self._wait_times)
+            stats = dict(self._counters)
+            stats.update(size=self._size, idle=len(self._idle), max_size=self.max_size)
+        if waits:
+            stats['wait_avg_ms'] = round(sum(waits) / len(waits) * 1000, 2)
+            stats['wait_p95_ms'] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2)
+            stats['wait_max_ms'] = round(waits[-1] * 1000, 2)
+        return stats
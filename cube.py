@@ -0,0 +1,147 @@
+"""棒グラフ・円グラフ・ヒートマップ用の集計キューブ
+
+データバージョンごとに1回だけ、カテゴリの次元の2つ組ごとに件数と数値カラムの合計・件数を集計しておき、
+グラフはそこからグループ数に比例する時間で集計結果を返す。
+返すDataFrameの形は aggregation のエンジンと同じ（NULLは集計対象外、キーの昇順）。
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from aggregation import _check_columns
+from columns import INTEGER_COLUMNS
+
+# 上位N件に入らなかった値をまとめるラベル
+OTHER_LABEL = 'その他'
+
+
+class AggregateCube:
+    """次元の2つ組ごとの集計表を持つキューブ
+
+    tables: (次元a, 次元b) -> DataFrame。カラムは a, b, n（件数）と、数値カラムMごとの
+        M_sum（合計）, M_n（NULLを除く件数）。次元のNULLも1つのグループとして残す。
+    """
+
+    def __init__(self, dimensions, measures, tables):
+        self.dimensions = list(dimensions)
+        self.measures = list(measures)
+        self._tables = tables
+
+    @classmethod
+    def from_frame(cls, df, dimensions, measures):
+        """手元のDataFrameから作る"""
+        frame = pd.DataFrame({'n': np.ones(len(df), dtype=np.int64)}, index=df.index)
+        for m in measures:
+            frame[f'{m}_sum'] = df[m].astype('float64')
+            frame[f'{m}_n'] = df[m].notna().astype(np.int64)
+        tables = {}
+        for a, b in itertools.combinations(dimensions, 2):
+            grouped = frame.groupby([df[a].rename(a), df[b].rename(b)], observed=True, dropna=False)
+            tables[(a, b)] = grouped.sum().reset_index()
+        return cls(dimensions, measures, tables)
+
+    @classmethod
+    def from_query(cls, run_query, dimensions, measures, table='orders'):
+        """次元の2つ組ごとのGROUP BYをUNION ALLでまとめた1回の問い合わせで作る
+
+        次元の型が組ごとに異なるため、文字列にして受け取り、整数のカラムは数値に戻す。
+        """
+        _check_columns(*dimensions, *measures)
+        pairs = list(itertools.combinations(dimensions, 2))
+        aggs = ''.join(f', SUM({m}) AS {m}_SUM, COUNT({m}) AS {m}_N' for m in measures)
+        sql = ' UNION ALL '.join(
+            f'SELECT {i} AS PAIR_ID, CAST({a} AS VARCHAR) AS D0, CAST({b} AS VARCHAR) AS D1, COUNT(*) AS N{aggs} '
+            f'FROM {table} GROUP BY {a}, {b}'
+            for i, (a, b) in enumerate(pairs)
+        )
+        result = run_query(sql)
+        result.columns = ['pair_id', 'd0', 'd1', 'n'] + [f'{m}_{s}' for m in measures for s in ('sum', 'n')]
+        tables = {}
+        for i, (a, b) in enumerate(pairs):
+            part = result[result['pair_id'] == i].drop(columns='pair_id').rename(columns={'d0': a, 'd1': b})
+            for col in (a, b):
+                if col in INTEGER_COLUMNS:
+                    part[col] = pd.to_numeric(part[col]).astype('Int64')
+            part['n'] = part['n'].astype(np.int64)
+            for m in measures:
+                part[f'{m}_sum'] = part[f'{m}_sum'].astype('float64')
+                part[f'{m}_n'] = part[f'{m}_n'].astype(np.int64)
+            tables[(a, b)] = part.reset_index(drop=True)
+        return cls(dimensions, measures, tables)
+
+    def covers(self, dimensions, measures=()):
+        """指定の次元・数値カラムをキューブから集計できるか"""
+        return all(d in self.dimensions for d in dimensions) and all(m in self.measures for m in measures)
+
+    def _pair_table(self, a, b):
+        if (a, b) in self._tables:
+            return self._tables[(a, b)]
+        return self._tables[(b, a)]
+
+    def rollup(self, dimensions):
+        """次元ごと（1つまたは2つ）に集計表を合算する（NULLの次元は除く）"""
+        dimensions = list(dict.fromkeys(dimensions))
+        if len(dimensions) == 1:
+            a = dimensions[0]
+            other = next(d for d in self.dimensions if d != a)
+            table = self._pair_table(a, other)
+        else:
+            table = self._pair_table(*dimensions)
+        table = table.dropna(subset=dimensions)
+        sums = table.drop(columns=[d for d in self.dimensions if d in table and d not in dimensions])
+        return sums.groupby(dimensions, observed=True).sum().sort_index()
+
+    def pie(self, col):
+        counts = self.rollup([col])['n']
+        counts = counts[counts > 0]
+        return pd.DataFrame({'name': counts.index, 'count': counts.to_numpy()})
+
+    def bar(self, category, value, limit=None):
+        table = self.rollup([category])
+        # 値がすべてNULLのグループはSUMと同じくNULLにする
+        values = table[f'{value}_sum'].where(table[f'{value}_n'] > 0)
+        if limit is not None:
+            values = values.nlargest(limit)
+        return pd.DataFrame({'category': values.index, 'value': values.to_numpy()})
+
+    def heatmap(self, x, y):
+        if x == y:
+            counts = self.rollup([x])['n']
+            return pd.DataFrame({'x': counts.index, 'y': counts.index, 'count': counts.to_numpy()})
+        counts = self.rollup([x, y])['n']
+        counts = counts[counts > 0]
+        frame = counts.rename('count').reset_index()
+        frame.columns = ['x', 'y', 'count']
+        return frame
+
+
+def limit_groups(frame, keys, weight, top_n):
+    """キーごとに、weightの合計が大きい上位top_n個の値を残し、残りはOTHER_LABELにまとめる
+
+    まとめた場合はキーを文字列にし、元の順序のあとにOTHER_LABELを並べる。
+    top_nが0またはNoneなら何もしない。
+    """
+    if not top_n:
+        return frame
+    limited = False
+    frame = frame.copy()
+    for key in keys:
+        totals = frame.groupby(key, observed=True, sort=False)[weight].sum()
+        if len(totals) <= top_n:
+            continue
+        keep = set(totals.nlargest(top_n).index)
+        frame[key] = frame[key].astype(object).map(lambda v: v if v in keep else OTHER_LABEL)
+        limited = True
+    if not limited:
+        return frame
+    order = {}
+    for key in keys:
+        # 残した値は元の順序のまま文字列にし、OTHER_LABELを最後に並べる
+        seen = list(dict.fromkeys(v for v in frame[key] if v != OTHER_LABEL))
+        order[key] = {**{v: i for i, v in enumerate(seen)}, OTHER_LABEL: len(seen)}
+    grouped = frame.groupby(keys, observed=True, sort=False).sum(min_count=1).reset_index()
+    grouped = grouped.sort_values(keys, key=lambda s: s.map(order[s.name])).reset_index(drop=True)
+    for key in keys:
+        grouped[key] = grouped[key].astype(str)
+    return grouped
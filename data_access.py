@@ -0,0 +1,613 @@
+"""ORDERSテーブルの取得処理
+
+接続先（バックエンド）は差し替え可能で、ローカル検証時は sqlite やフェイク接続を使う。
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+from dotenv import load_dotenv
+
+from aggregation import PandasAggregationEngine, SqlAggregationEngine
+from column_store import ORDER_KEY, ColumnStore
+import compaction
+from columns import CUBE_DIMENSIONS, CUBE_MEASURES, DATE_COLUMNS, FILTER_COLUMNS, FLOAT_COLUMNS, INTEGER_COLUMNS, NUMERIC_COLUMNS, STRING_COLUMNS, column_mapping
+from connection_pool import ConnectionPool
+from cube import AggregateCube
+from query_cache import QueryCache, query_key
+import query_executor
+import snapshot
+from streaming import StreamingSummary
+import summaries
+import tracing
+
+load_dotenv()
+
+# 接続先のバックエンド名（'snowflake' / 'sqlite' / register_backendで登録した名前）
+DATA_BACKEND = os.getenv('DATA_BACKEND', 'snowflake')
+# sqliteバックエンドで使うDBファイル
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'orders.db')
+# ORDERSのキャッシュ有効期限（秒）。期限が切れると差分更新する
+ORDERS_CACHE_TTL = int(os.getenv('ORDERS_CACHE_TTL', '600'))
+# 差分取得の基準にするカラム（単調増加する注文番号やタイムスタンプ）
+ORDERS_WATERMARK_COLUMN = os.getenv('ORDERS_WATERMARK_COLUMN', 'ORDERNUMBER')
+# 差分更新のずれを解消するため、全件を取得し直す間隔（秒）
+ORDERS_FULL_RELOAD_INTERVAL = int(os.getenv('ORDERS_FULL_RELOAD_INTERVAL', '86400'))
+# ORDERSのスナップショットの保存先（空文字なら保存しない）と保持数・合計サイズの上限
+ORDERS_SNAPSHOT_DIR = os.getenv('ORDERS_SNAPSHOT_DIR', '.snapshots')
+ORDERS_SNAPSHOT_KEEP = int(os.getenv('ORDERS_SNAPSHOT_KEEP', '3'))
+ORDERS_SNAPSHOT_MAX_MB = float(os.getenv('ORDERS_SNAPSHOT_MAX_MB', '1024'))
+# カラムが増えただけの場合に、スナップショットを保存するまで待つ秒数（続けて選ばれたカラムをまとめて1回で保存する）
+ORDERS_SNAPSHOT_DEBOUNCE = float(os.getenv('ORDERS_SNAPSHOT_DEBOUNCE', '10'))
+# 取得したカラムを省メモリな型に変換するか
+ORDERS_COMPACT = os.getenv('ORDERS_COMPACT', '1') == '1'
+# グラフの集計方法（'sql': ウェアハウスで集計 / 'pandas': 取得したDataFrameで集計）
+AGGREGATION_ENGINE = os.getenv('AGGREGATION_ENGINE', 'sql')
+# ORDERSの読み込み方（'memory': 取得したカラムをメモリに保持する / 'stream': バッチごとに集計し、行データを保持しない）
+ORDERS_LOAD_MODE = os.getenv('ORDERS_LOAD_MODE', 'memory')
+# ストリーミングで1回に受け取る行数（コネクタのArrowのバッチが使えない場合）
+STREAM_BATCH_ROWS = int(os.getenv('STREAM_BATCH_ROWS', '20000'))
+# ストリーミングでは行データを保持しないため、キューブに無い集計はSQLで行う
+if ORDERS_LOAD_MODE == 'stream':
+    AGGREGATION_ENGINE = 'sql'
+# ヒストグラムのビン数の上限と、箱ひげ図で描く外れ値の数の上限
+HISTOGRAM_MAX_BINS = int(os.getenv('HISTOGRAM_MAX_BINS', '200'))
+BOX_MAX_OUTLIERS = int(os.getenv('BOX_MAX_OUTLIERS', '1000'))
+# クエリ結果をプロセス間で共有するキャッシュの保存先（空文字なら使わない）・有効期限（秒）・容量（MB）
+# 集計クエリのキーにはデータの識別子（ウォーターマークと行数）を含めるため、行が増えたあとは他のプロセスの古い結果を使わない
+QUERY_CACHE_DIR = os.getenv('QUERY_CACHE_DIR', '.query_cache')
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', '60'))
+QUERY_CACHE_SIZE_MB = float(os.getenv('QUERY_CACHE_SIZE_MB', '2048'))
+# 接続プールの設定
+POOL_SIZE = int(os.getenv('POOL_SIZE', '4'))
+POOL_TIMEOUT = float(os.getenv('POOL_TIMEOUT', '30'))
+POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('POOL_HEALTH_CHECK_INTERVAL', '60'))
+POOL_KEEPALIVE_INTERVAL = float(os.getenv('POOL_KEEPALIVE_INTERVAL', '900'))
+# 非同期で投入したクエリの状態を確認する間隔（秒）
+ASYNC_POLL_INTERVAL = float(os.getenv('ASYNC_POLL_INTERVAL', '0.1'))
+
+ORDERS_QUERY = "SELECT * FROM orders"
+
+
+def _sql_literal(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def build_projection_query(columns, since=None, watermark_column=None):
+    """必要なカラム（と行を揃えるためのキー）だけを取得するSQLを組み立てる
+
+    sinceを指定した場合は、watermark_columnがsince以上の行だけを取得する。
+    """
+    unknown = [c for c in list(columns) + [watermark_column] if c is not None and c not in column_mapping]
+    if unknown:
+        raise ValueError(f'ORDERSに存在しないカラムです: {unknown}')
+    extra = [watermark_column] if watermark_column else []
+    selected = list(dict.fromkeys(ORDER_KEY + extra + list(columns)))
+    sql_query = f"SELECT {', '.join(selected)} FROM orders"
+    if since is not None:
+        sql_query += f" WHERE {watermark_column} >= {_sql_literal(since)}"
+    return sql_query
+
+
+def snowflake_conn_info():
+    """環境変数からSnowflakeへの接続情報を組み立てる"""
+    return {
+        'user': os.getenv('SNOWFLAKE_USER'),
+        'password': os.getenv('SNOWFLAKE_PASSWORD'),
+        'account': os.getenv('SNOWFLAKE_ACCOUNT'),
+        'warehouse': os.getenv('SNOWFLAKE_WAREHOUSE'),
+        'database': os.getenv('SNOWFLAKE_DATABASE'),
+        'schema': os.getenv('SNOWFLAKE_SCHEMA'),
+        'role': os.getenv('SNOWFLAKE_ROLE'),
+    }
+
+
+def query_context(backend=None):
+    """クエリ結果が同じになる範囲（クエリキャッシュのキーに含める接続先・ロール・ウェアハウス等）"""
+    backend = backend or DATA_BACKEND
+    info = snowflake_conn_info()
+    context = {'backend': backend}
+    if backend == 'snowflake':
+        context.update({key: info[key] for key in ('account', 'role', 'warehouse', 'database', 'schema')})
+    elif backend == 'sqlite':
+        context['path'] = os.path.abspath(SQLITE_PATH)
+    return context
+
+
+def _connect_snowflake():
+    import snowflake.connector
+    # プールで長く保持するため、セッションのkeepaliveを有効にする
+    return snowflake.connector.connect(client_session_keep_alive=True, **snowflake_conn_info())
+
+
+def _connect_sqlite():
+    # Streamlitはスレッドを跨いで実行されるため、同一スレッド制約を外す
+    return sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+
+
+# バックエンド名 -> DBAPI互換の接続を返す関数
+_backends = {
+    'snowflake': _connect_snowflake,
+    'sqlite': _connect_sqlite,
+}
+# バックエンド名 -> SQLの方言
+_dialects = {
+    'snowflake': 'snowflake',
+    'sqlite': 'sqlite',
+}
+
+
+def register_backend(name, connect, dialect='snowflake'):
+    """接続関数を登録する（テスト用のフェイク接続などに差し替えるため）"""
+    _backends[name] = connect
+    _dialects[name] = dialect
+
+
+def connect(backend=None):
+    """指定されたバックエンドへの接続を開く"""
+    backend = backend or DATA_BACKEND
+    if backend not in _backends:
+        raise ValueError(f'未登録のバックエンドです: {backend}')
+    with tracing.span('connect', backend=backend):
+        return _backends[backend]()
+
+
+@st.cache_resource
+def get_pool(backend=None):
+    """バックエンドごとにプロセス全体で共有する接続プール"""
+    backend = backend or DATA_BACKEND
+    pool = ConnectionPool(
+        lambda: connect(backend),
+        max_size=POOL_SIZE,
+        timeout=POOL_TIMEOUT,
+        health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+        passthrough_errors=(query_executor.QueryCancelled,),
+    )
+    pool.start_keepalive(POOL_KEEPALIVE_INTERVAL)
+    return pool
+
+
+def apply_column_types(df):
+    """columnsの定義に従ってカラムの型を明示的に揃える"""
+    dtypes = {}
+    for col in INTEGER_COLUMNS:
+        if col in df.columns:
+            # NULLを含む整数カラムはfloat64で保持する
+            dtypes[col] = 'float64' if df[col].isna().any() else 'int64'
+    for col in FLOAT_COLUMNS:
+        if col in df.columns:
+            dtypes[col] = 'float64'
+    for col in STRING_COLUMNS:
+        if col in df.columns:
+            dtypes[col] = 'object'
+    # 型が既に一致しているカラムはコピーしない
+    dtypes = {col: dtype for col, dtype in dtypes.items() if df[col].dtype != dtype}
+    if dtypes:
+        df = df.astype(dtypes, copy=False)
+    for col in DATE_COLUMNS:
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+
+def arrow_to_pandas(table):
+    """ArrowのTableをなるべくコピーせずにDataFrameへ変換する"""
+    # split_blocks: カラムごとにブロックを分け、同じ型のカラムを連結するコピーを避ける
+    # self_destruct: 変換済みのArrowバッファを順次解放し、ピークメモリを抑える
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def fetch_orders(conn, sql_query=ORDERS_QUERY):
+    """接続を使ってORDERSを取得し、カラムの型を揃えたDataFrameにする"""
+    return apply_column_types(fetch_frame(conn, sql_query))
+
+
+def execute(conn, cur, sql_query):
+    """カーソルでSQLを実行する
+
+    グラフのクエリ（query_executorのジョブ）の中で、カーソルが execute_async を持つ場合は非同期で投入し、
+    終わるまで状態を確認する。ジョブが取り消されたら、ウェアハウス側のクエリも止めてQueryCancelledを送出する。
+    """
+    query_executor.check_cancelled()
+    cancel = query_executor.cancel_event()
+    if cancel is None or not hasattr(cur, 'execute_async'):
+        cur.execute(sql_query)
+        return
+    cur.execute_async(sql_query)
+    query_id = cur.sfqid
+    with tracing.span('query.async', query_id=query_id):
+        while conn.is_still_running(conn.get_query_status_throw_if_error(query_id)):
+            if cancel.wait(ASYNC_POLL_INTERVAL):
+                cur.abort_query(query_id)
+                raise query_executor.QueryCancelled(f'クエリを取り消しました: {query_id}')
+        cur.get_results_from_sfqid(query_id)
+
+
+def fetch_table(conn, sql_query):
+    """SQLを実行して結果をArrowのTableにする（クエリキャッシュに保存するため）
+
+    fetch_arrow_all を持たない接続（sqlite等）は pd.read_sql の結果をArrowに変換する。
+    """
+    with tracing.span('query', sql=sql_query[:200]) as span:
+        cur = conn.cursor()
+        if not hasattr(cur, 'fetch_arrow_all'):
+            cur.close()
+            query_executor.check_cancelled()
+            table = pa.Table.from_pandas(pd.read_sql(sql_query, conn), preserve_index=False)
+        else:
+            try:
+                execute(conn, cur, sql_query)
+                table = cur.fetch_arrow_all()
+                if table is None:
+                    # 結果が0行の場合はNoneが返るため、カラムだけの空のTableにする
+                    table = pa.table({d[0]: pa.array([], pa.null()) for d in cur.description})
+            finally:
+                cur.close()
+        span.set(rows=table.num_rows, bytes=table.nbytes)
+        return table
+
+
+def fetch_frame(conn, sql_query):
+    """SQLを実行して結果をDataFrameにする
+
+    Snowflakeのカーソルのように fetch_arrow_all を持つ場合はArrowの結果をそのまま使い、
+    それ以外（sqlite等）は pd.read_sql にフォールバックする。
+    """
+    with tracing.span('query', sql=sql_query[:200]) as span:
+        cur = conn.cursor()
+        if not hasattr(cur, 'fetch_arrow_all'):
+            cur.close()
+            query_executor.check_cancelled()
+            df = pd.read_sql(sql_query, conn)
+        else:
+            try:
+                execute(conn, cur, sql_query)
+                table = cur.fetch_arrow_all()
+                if table is None:
+                    # 結果が0行の場合はNoneが返るため、カラムだけの空のDataFrameにする
+                    df = pd.DataFrame(columns=[d[0] for d in cur.description])
+                else:
+                    # 変換後は解放されるため、受け取ったArrowのバイト数を先に記録する
+                    span.set(bytes=table.nbytes)
+                    df = arrow_to_pandas(table)
+            finally:
+                cur.close()
+        span.set(rows=len(df))
+        return df
+
+
+@st.cache_resource
+def _column_store(backend):
+    """バックエンドごとのカラムストア"""
+
+    def fetch(columns, since):
+        return query_orders(build_projection_query(columns, since, ORDERS_WATERMARK_COLUMN), backend)
+
+    store = ColumnStore(
+        fetch,
+        watermark_column=ORDERS_WATERMARK_COLUMN,
+        compact=compaction.compact_series if ORDERS_COMPACT else None,
+    )
+    if ORDERS_SNAPSHOT_DIR:
+        # 保存済みのスナップショットがあればすぐに描画し、最新かどうかはバックグラウンドで確認する
+        latest = snapshot.load_latest_snapshot(ORDERS_SNAPSHOT_DIR, backend)
+        if latest is not None:
+            store.restore(*latest)
+            threading.Thread(target=_refresh_and_save, args=(store, backend), daemon=True).start()
+    return store
+
+
+# スナップショットを保存するスレッドを1つにするためのロック
+_snapshot_lock = threading.Lock()
+
+
+def _save_snapshot(store, backend):
+    """保持しているデータ（データバージョン・カラムの組）が保存済みと違えばスナップショットを保存する
+
+    保存するのは1つのスレッドだけで、保存中に状態が変わった場合は、そのスレッドが最新の状態を保存し直す。
+    データバージョンが同じでカラムが増えただけの場合は、ORDERS_SNAPSHOT_DEBOUNCE秒待ってから保存し、
+    その間に増えたカラムもまとめて1回で書き出す。
+    """
+    while ORDERS_SNAPSHOT_DIR and store.state() != store.snapshot_state:
+        if not _snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            while store.state() != store.snapshot_state:
+                if store.snapshot_state is not None and store.version == store.snapshot_state[0]:
+                    time.sleep(ORDERS_SNAPSHOT_DEBOUNCE)
+                df, state = store.snapshot()
+                snapshot.save_snapshot(
+                    df, state[0], ORDERS_SNAPSHOT_DIR, backend,
+                    keep=ORDERS_SNAPSHOT_KEEP, max_bytes=ORDERS_SNAPSHOT_MAX_MB * 1024 ** 2,
+                )
+                store.snapshot_state = state
+        finally:
+            _snapshot_lock.release()
+
+
+def _refresh_and_save(store, backend):
+    store.refresh()
+    _save_snapshot(store, backend)
+
+
+def load_orders(columns=None, backend=None, filters=()):
+    """ORDERSの指定カラムを取得する（未指定なら全カラム）
+
+    戻り値は (DataFrame, データバージョン)。取得済みのカラムはキャッシュから返し、
+    新しく必要になったカラムだけをSnowflakeへ問い合わせる。
+    TTLが切れていれば増えた行だけを取得し、一定間隔で全件を取得し直す。
+    filters（filters.normalize の形）を指定した場合は、当てはまる行だけを返す
+    （絞り込んだ行はカラムストアが索引から求めて、グラフ間で共有する）。
+    """
+    # 同じカラムが複数回指定されても（X軸とY軸が同じ等）1列だけ返す
+    columns = list(column_mapping) if columns is None else list(dict.fromkeys(columns))
+    backend = backend or DATA_BACKEND
+    store = _column_store(backend)
+    # グラフのクエリのワーカースレッドからは画面に要素を出さない
+    spinner = st.spinner('Snowflakeからデータを取得しています...') if query_executor.cancel_event() is None else contextlib.nullcontext()
+    with spinner, tracing.span('load_orders', columns=len(columns)) as span:
+        store.refresh_if_stale(ORDERS_CACHE_TTL, ORDERS_FULL_RELOAD_INTERVAL)
+        df = store.get(columns, filters)
+        span.set(rows=len(df))
+    if store.state() != store.snapshot_state and not _snapshot_lock.locked():
+        # 描画を待たせないよう、スナップショットの保存はバックグラウンドで行う（保存中なら、保存中のスレッドに任せる）
+        threading.Thread(target=_save_snapshot, args=(store, backend), daemon=True).start()
+    return df, store.version
+
+
+def dataset_version(backend=None):
+    """ORDERSのデータバージョンを返す（未取得ならキーだけを取得し、期限切れなら差分更新する）
+
+    取得済みの場合はDataFrameを作らないため、グラフのキャッシュを引く前に毎回呼んでも軽い。
+    ストリーミングでは、行数とウォーターマーク（期限付きでキャッシュした集計クエリの結果）から作る。
+    """
+    if ORDERS_LOAD_MODE == 'stream':
+        total_rows, watermark, _ = stream_bounds(backend or DATA_BACKEND)
+        return f'stream-{watermark}-{total_rows}'
+    store = _column_store(backend or DATA_BACKEND)
+    if store.version is None:
+        return load_orders([], backend)[1]
+    store.refresh_if_stale(ORDERS_CACHE_TTL, ORDERS_FULL_RELOAD_INTERVAL)
+    return store.version
+
+
+def iter_batches(conn, sql_query, batch_rows=STREAM_BATCH_ROWS):
+    """SQLを実行して結果をバッチ（カラムの型を揃えたDataFrame）ごとに返す
+
+    Snowflakeのカーソルのように fetch_arrow_batches を持つ場合はコネクタのArrowのバッチをそのまま使い、
+    それ以外（sqlite等）は pd.read_sql の chunksize で batch_rows 行ずつ受け取る。
+    """
+    cur = conn.cursor()
+    if not hasattr(cur, 'fetch_arrow_batches'):
+        cur.close()
+        for df in pd.read_sql(sql_query, conn, chunksize=batch_rows):
+            yield apply_column_types(df)
+        return
+    try:
+        cur.execute(sql_query)
+        for table in cur.fetch_arrow_batches():
+            yield apply_column_types(arrow_to_pandas(table))
+    finally:
+        cur.close()
+
+
+@st.cache_data(ttl=ORDERS_CACHE_TTL, show_spinner=False)
+def stream_bounds(backend=None):
+    """ストリーミングで読み込む範囲 (行数, ウォーターマーク, 数値カラム -> (最小値, 最大値))
+
+    ヒストグラム・2次元ビンの範囲を読み込みの前に決めるため、集計クエリで求める。
+    """
+    aggs = ''.join(f', MIN({c}) AS MIN_{c}, MAX({c}) AS MAX_{c}' for c in NUMERIC_COLUMNS)
+    sql_query = f'SELECT COUNT(*) AS TOTAL_ROWS, MAX({ORDERS_WATERMARK_COLUMN}) AS WATERMARK{aggs} FROM orders'
+    # 行数とウォーターマークはデータバージョンになるため、プロセス間で共有するクエリキャッシュの古い結果は使わない。
+    # 行（iloc[0]）で取り出すと型が揃えられるため、カラムごとに取り出してウォーターマークの型を保つ
+    row = {col.upper(): values.iloc[0] for col, values in execute_query(sql_query, backend, use_cache=False).items()}
+    bounds = {}
+    for col in NUMERIC_COLUMNS:
+        lo, hi = row[f'MIN_{col}'], row[f'MAX_{col}']
+        bounds[col] = (None, None) if pd.isna(lo) else (float(lo), float(hi))
+    return int(row['TOTAL_ROWS']), None if pd.isna(row['WATERMARK']) else row['WATERMARK'], bounds
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def streaming_summary(data_version, backend=None):
+    """データバージョンごとのストリーミングの集計（バックグラウンドで読み込みを始めて、すぐに返す）
+
+    読み込み中も途中までの集計を読める（進み具合は progress()、終わったかは done）。
+    """
+    backend = backend or DATA_BACKEND
+    total_rows, watermark, bounds = stream_bounds(backend)
+    summary = StreamingSummary(bounds, total_rows, CUBE_DIMENSIONS, CUBE_MEASURES, BOX_MAX_OUTLIERS)
+    sql_query = f"SELECT {', '.join(summary.columns)} FROM orders"
+    if watermark is not None:
+        # 範囲を求めたあとに追加された行は、次のデータバージョンで読み込む
+        sql_query += f' WHERE {ORDERS_WATERMARK_COLUMN} <= {_sql_literal(watermark)}'
+    threading.Thread(target=_stream, args=(summary, get_pool(backend), sql_query), name='orders-stream', daemon=True).start()
+    return summary
+
+
+def _stream(summary, pool, sql_query):
+    try:
+        with pool.connection() as conn, contextlib.closing(iter_batches(conn, sql_query)) as batches:
+            for df in batches:
+                if summary.closed:
+                    # 新しいデータバージョンに置き換えられたため、残りの行は読み込まない（カーソルを閉じて接続を返す）
+                    break
+                summary.add(df)
+    except Exception as e:
+        summary.finish(e)
+    else:
+        summary.finish()
+
+
+def column_cardinality(data_version, backend=None):
+    """カラムごとの値の種類数（データバージョンごとにキャッシュした集計クエリで求める）"""
+    backend = backend or DATA_BACKEND
+    engine = SqlAggregationEngine(
+        lambda sql_query: run_query(sql_query, data_version, backend),
+        dialect=_dialects.get(backend, 'snowflake'),
+    )
+    with tracing.span('cardinality'):
+        return engine.cardinality(list(column_mapping))
+
+
+def memory_report(backend=None):
+    """保持しているカラムのメモリ使用量（変換前・変換後）"""
+    store = _column_store(backend or DATA_BACKEND)
+    return compaction.memory_report(store.memory_before, store.held_columns())
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+@tracing.traced('summary.histogram')
+def histogram_summary(column, data_version, bins='auto', filters=(), backend=None):
+    """数値カラムのヒストグラム（カラム・データバージョン・ビンの決め方・絞り込みごとにキャッシュする）"""
+    df, _ = load_orders([column], backend, filters)
+    return summaries.histogram(df[column], bins, HISTOGRAM_MAX_BINS, integer=column in INTEGER_COLUMNS)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+@tracing.traced('summary.box')
+def box_summary(column, data_version, filters=(), backend=None):
+    """数値カラムの箱ひげ図の統計量（カラム・データバージョン・絞り込みごとにキャッシュする）"""
+    df, _ = load_orders([column], backend, filters)
+    return summaries.box(df[column], BOX_MAX_OUTLIERS)
+
+
+@st.cache_resource
+def get_query_cache():
+    """プロセス間で共有するクエリ結果のキャッシュ（保存先が未設定ならNone）"""
+    if not QUERY_CACHE_DIR:
+        return None
+    return QueryCache(QUERY_CACHE_DIR, QUERY_CACHE_TTL, QUERY_CACHE_SIZE_MB * 1024 ** 2)
+
+
+def execute_query(sql_query, backend=None, use_cache=True, params=()):
+    """SQLを実行して結果をDataFrameにする
+
+    クエリキャッシュがあれば、他のプロセス・セッションが実行した同じクエリの結果を使い、
+    同じクエリを同時に実行しようとした場合は1つだけがウェアハウスへ問い合わせる。
+    params はキャッシュのキーに加える値（data_stamp のデータの識別子等）で、値が違えば別の結果として扱う。
+    use_cache=False の場合はクエリキャッシュを使わず、常にウェアハウスへ問い合わせる。
+    """
+    backend = backend or DATA_BACKEND
+    pool = get_pool(backend)
+    cache = get_query_cache() if use_cache else None
+    if cache is None:
+        return pool.run(lambda conn: fetch_frame(conn, sql_query))
+    with tracing.span('query_cache') as span:
+        table, status = cache.get_or_execute(
+            query_key(sql_query, params, context=query_context(backend)),
+            lambda: pool.run(lambda conn: fetch_table(conn, sql_query)),
+        )
+        span.set(status=status, rows=table.num_rows, bytes=table.nbytes)
+    return arrow_to_pandas(table)
+
+
+def query_orders(sql_query, backend=None):
+    """ORDERSの行データを取得するクエリを実行し、カラムの型を揃えたDataFrameにする
+
+    カラムストアの取得（カラムの追加・差分更新）に使うため、クエリキャッシュは使わない。
+    SQLが同じでも結果はその時点の行に依存し、キャッシュの古い結果を使うと、
+    カラムストアの行（キー）と揃わずに欠損が生じたり、差分更新で増えた行を取りこぼしたりする。
+    """
+    return apply_column_types(execute_query(sql_query, backend, use_cache=False))
+
+
+def data_stamp(data_version, backend=None):
+    """データバージョンに対応する、プロセスによらないデータの識別子
+
+    ストリーミングのデータバージョンはウォーターマークと行数から作るため、そのまま使う。
+    それ以外はカラムストアが保持している行のウォーターマークと行数を使う。
+    """
+    if ORDERS_LOAD_MODE == 'stream':
+        return (data_version,)
+    return _column_store(backend or DATA_BACKEND).stamp()
+
+
+@st.cache_data(ttl=ORDERS_CACHE_TTL, show_spinner=False)
+def run_query(sql_query, data_version, backend=None):
+    """集計クエリを実行する（データバージョンごとにキャッシュする）
+
+    プロセス間で共有するクエリキャッシュは、データの識別子を含めたキーで引く
+    （差分更新で行が増えたプロセスが、他のプロセスが増える前の行で集計した結果を使わないように）。
+    """
+    return execute_query(sql_query, backend, params=data_stamp(data_version, backend))
+
+
+def aggregation_engine(df, data_version, backend=None):
+    """設定に応じた集計エンジンを返す"""
+    if AGGREGATION_ENGINE == 'pandas':
+        return PandasAggregationEngine(df)
+    backend = backend or DATA_BACKEND
+    return SqlAggregationEngine(
+        lambda sql_query: run_query(sql_query, data_version, backend),
+        dialect=_dialects.get(backend, 'snowflake'),
+    )
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def filter_options(data_version, backend=None):
+    """絞り込みに使うカラム -> 値のリスト（昇順、NULLを除く）。集計キューブの値ごとの件数から作る"""
+    cube = aggregate_cube(data_version, backend)
+    return {col: cube.pie(col)['name'].tolist() for col in FILTER_COLUMNS}
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+@tracing.traced('cube')
+def aggregate_cube(data_version, backend=None):
+    """棒グラフ・円グラフ・ヒートマップ用の集計キューブ（データバージョンごとに1回だけ作る）
+
+    ストリーミングでは、読み込みが終わるのを待って、読み込みと同時に集計したキューブを返す。
+    """
+    if ORDERS_LOAD_MODE == 'stream':
+        summary = streaming_summary(data_version, backend)
+        summary.wait()
+        return summary.cube()
+    if AGGREGATION_ENGINE == 'pandas':
+        df, _ = load_orders(CUBE_DIMENSIONS + CUBE_MEASURES, backend)
+        return AggregateCube.from_frame(df, CUBE_DIMENSIONS, CUBE_MEASURES)
+    backend = backend or DATA_BACKEND
+    return AggregateCube.from_query(
+        lambda sql_query: run_query(sql_query, data_version, backend), CUBE_DIMENSIONS, CUBE_MEASURES,
+    )
+
+
+def refresh_orders(backend=None):
+    """増えた行だけを取得してキャッシュに追記する。増えた行数を返す
+
+    集計クエリのキャッシュはデータバージョンをキーにしているため、行が増えれば自動的に無効になる。
+    明示的な再取得のため、プロセス間で共有するクエリキャッシュの結果も使わない。
+    """
+    clear_query_cache()
+    if ORDERS_LOAD_MODE == 'stream':
+        # 行数とウォーターマークを取り直し、増えていれば新しいデータバージョンとして読み込み直す
+        before = stream_bounds(backend)[0]
+        stream_bounds.clear()
+        return max(0, stream_bounds(backend)[0] - before)
+    return _column_store(backend or DATA_BACKEND).refresh()
+
+
+def reload_orders(backend=None):
+    """キャッシュを破棄し、次回の読み込みで全件を取得し直させる"""
+    clear_query_cache()
+    _column_store.clear()
+    run_query.clear()
+    stream_bounds.clear()
+    streaming_summary.clear()
+
+
+def clear_query_cache():
+    """プロセス間で共有するクエリキャッシュの結果を消す（他のプロセスも次は問い合わせ直す）"""
+    cache = get_query_cache()
+    if cache is not None:
+        cache.clear()
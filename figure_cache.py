@@ -0,0 +1,98 @@
+"""セッション間で共有するグラフのキャッシュ
+
+plotlyのfigureをJSONにシリアライズして保持し、合計サイズの上限を超えたら
+最も長く使われていないものから削除する（LRU）。
+キーの先頭はデータバージョンで、新しいバージョンで引かれたら古いバージョンのグラフは捨てる。
+"""
+import collections
+import threading
+
+import plotly.io as pio
+
+
+class FigureCache:
+    """サイズ上限付きのLRUキャッシュ
+
+    max_bytes: シリアライズしたグラフの合計バイト数の上限
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # キー -> (figureのJSON, キャプション, バイト数)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _switch_version(self, version):
+        # データが更新されたら、古いバージョンのグラフはもう使われないため捨てる
+        if version == self._version:
+            return
+        for key in [k for k in self._entries if k[0] != version]:
+            self._remove(key)
+            self._counters['invalidations'] += 1
+        self._version = version
+
+    def get(self, key):
+        """キャッシュされたグラフを (figure, キャプション) で返す。無ければNone"""
+        with self._lock:
+            self._switch_version(key[0])
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+        spec, caption, _ = entry
+        return pio.from_json(spec), caption
+
+    def put(self, key, fig, caption=None, current=False):
+        """グラフを保存し、上限を超えた分を古い順に削除する
+
+        current=True の場合は、keyのデータバージョンを最新として扱う（getを経ずに作ったグラフを保存するため）。
+        """
+        spec = fig.to_json()
+        size = len(spec.encode()) + len((caption or '').encode())
+        with self._lock:
+            if current:
+                self._switch_version(key[0])
+            # 作っている間にデータが更新された場合は保存しない
+            if key[0] != self._version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                # 上限より大きいグラフは保存しない
+                self._counters['oversized'] += 1
+                return
+            self._entries[key] = (spec, caption, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def entry_bytes(self, key):
+        """保存されているグラフのバイト数（保存されていなければNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ヒット・ミス・削除の回数と使用量"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        if lookups:
+            stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 3)
+        return stats
@@ -0,0 +1,69 @@
+"""カテゴリのカラムの値で行を絞り込む（クロスフィルタ）ための索引
+
+カラムごとに、値ごとの行番号の一覧（転置索引）と行ごとの値のコードを、データバージョンごとに1回だけ作る。
+絞り込みは、当てはまる行が最も少ないカラムの行番号から始め、残りのカラムは行ごとのコードで確かめるため、
+全行を走査せずに、絞り込んだ行数に比例する時間で行番号が求まる。
+
+絞り込みは ((カラム, (値, ...)), ...) のタプルで表す（キャッシュのキーにそのまま使える）。
+同じカラムの値はOR、カラム間はANDで組み合わせる。
+"""
+import numpy as np
+import pandas as pd
+
+
+def normalize(selections):
+    """{カラム: 選んだ値のリスト} を絞り込みのタプルにする（値を選んでいないカラムは除く）"""
+    return tuple(
+        (col, tuple(sorted(values)))
+        for col, values in sorted(selections.items())
+        if values
+    )
+
+
+class ValueIndex:
+    """1つのカラムの、値ごとの行番号の一覧と行ごとの値のコード（NULLは-1）"""
+
+    def __init__(self, series):
+        codes, uniques = pd.factorize(series)
+        self.codes = codes.astype(np.int32)
+        self._lookup = {value: i for i, value in enumerate(uniques)}
+        # 値のコード順（同じ値の中では行番号順）に並べた行番号と、コードごとの開始位置（先頭はNULLの行）
+        self._order = np.argsort(self.codes, kind='stable').astype(np.int32)
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self.codes + 1, minlength=len(uniques) + 1))])
+
+    def lookup(self, values):
+        """値のコードのリスト（このカラムに無い値は除く）"""
+        return [self._lookup[v] for v in values if v in self._lookup]
+
+    def count(self, codes):
+        """値のどれかに当てはまる行数"""
+        return int(sum(self._offsets[c + 2] - self._offsets[c + 1] for c in codes))
+
+    def rows(self, codes):
+        """値のどれかに当てはまる行の行番号（昇順）"""
+        parts = [self._order[self._offsets[c + 1]:self._offsets[c + 2]] for c in codes]
+        if not parts:
+            return np.array([], dtype=np.int32)
+        return np.sort(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+
+    def matches(self, rows, codes):
+        """行番号ごとに、値のどれかに当てはまるか（boolの配列）"""
+        allowed = np.zeros(len(self._lookup) + 1, dtype=bool)
+        allowed[codes] = True
+        # NULL（-1）は末尾の要素（常にFalse）を指す
+        return allowed[self.codes[rows]]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self._order.nbytes + self._offsets.nbytes
+
+
+def select_rows(terms):
+    """(ValueIndex, 値のリスト) の組み合わせ（カラム間はAND）に当てはまる行の行番号（昇順）"""
+    terms = [(index, index.lookup(values)) for index, values in terms]
+    terms.sort(key=lambda term: term[0].count(term[1]))
+    index, codes = terms[0]
+    rows = index.rows(codes)
+    for index, codes in terms[1:]:
+        rows = rows[index.matches(rows, codes)]
+    return rows
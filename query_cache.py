@@ -0,0 +1,137 @@
+"""プロセス間で共有するクエリ結果のキャッシュ
+
+複数のレプリカ・セッションが同時に同じクエリ（データの期限切れ後の SELECT や集計クエリ）を
+実行しないよう、結果をArrow IPCのバイト列にしてdiskcacheでローカルディスクに保存する。
+キーは正規化したSQL・パラメーター・接続のコンテキスト（ロール・ウェアハウス等）から作る。
+同じキーのクエリが同時に来た場合は、ロックを取れた1つだけが実行し、残りは結果が保存されるのを待つ。
+"""
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+
+import diskcache
+import pyarrow as pa
+
+# 結果に付けるタグ（clearでロックを残して結果だけを消すため）
+RESULT_TAG = 'result'
+
+# 引用符で囲まれた部分（文字列リテラル・引用符付きの識別子）と、それ以外に分ける
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(sql):
+    """表記ゆれを除いたSQL（引用符の外の空白をまとめ、大文字・小文字を揃え、末尾のセミコロンを除く）"""
+    parts = []
+    for i, part in enumerate(_QUOTED.split(sql)):
+        if i % 2:
+            parts.append(part)
+        else:
+            parts.append(re.sub(r'\s+', ' ', part).casefold())
+    normalized = ''.join(parts).strip()
+    return normalized.rstrip('; ').strip()
+
+
+def query_key(sql, params=(), context=None):
+    """正規化したSQL・パラメーター・接続のコンテキストから作るキー"""
+    payload = json.dumps([normalize_sql(sql), list(params), context or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def table_to_bytes(table):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def table_from_bytes(data):
+    return pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+
+
+class QueryCache:
+    """有効期限とサイズ上限付きの、プロセス間で共有するクエリ結果のキャッシュ
+
+    directory: キャッシュの保存先（同じディレクトリを使うプロセス間で共有される）
+    ttl: 結果の有効期限（秒）
+    size_limit: 合計サイズの上限（バイト）。超えたら最も長く使われていないものから削除する
+    lock_timeout: 実行中のロックの有効期限（秒）。実行したプロセスが落ちてもこの時間で外れる
+    wait_timeout: 他のプロセスの実行を待つ上限（秒）。超えたら自分で実行する
+    """
+
+    def __init__(self, directory, ttl, size_limit, lock_timeout=600.0, wait_timeout=600.0, poll=0.05):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll = poll
+        self._cache = diskcache.Cache(
+            directory, size_limit=int(size_limit), eviction_policy='least-recently-used', tag_index=True,
+        )
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        """キャッシュされた結果（ArrowのTable）。無ければNone"""
+        data = self._cache.get(key)
+        return None if data is None else table_from_bytes(data)
+
+    def set(self, key, table):
+        self._cache.set(key, table_to_bytes(table), expire=self.ttl, tag=RESULT_TAG)
+
+    def get_or_execute(self, key, execute):
+        """キャッシュにあれば返し、無ければexecute()（ArrowのTableを返す関数）を実行して保存する
+
+        同じキーを他のスレッド・プロセスが実行中なら、その結果が保存されるのを待つ。
+        実行した側が失敗した場合は、待っていた側のうち1つが実行し直す。
+        戻り値は (Table, 'hit' / 'miss' / 'coalesced' / 'fallback')。
+        """
+        lock_key = f'lock:{key}'
+        token = uuid.uuid4().hex
+        start = time.monotonic()
+        waited = False
+        while True:
+            table = self.get(key)
+            if table is not None:
+                status = 'coalesced' if waited else 'hit'
+                self._count(status)
+                return table, status
+            if self._cache.add(lock_key, token, expire=self.lock_timeout):
+                break
+            if time.monotonic() - start >= self.wait_timeout:
+                # 実行中の側が応答しない場合は、待つのをやめて自分で実行する（保存はしない）
+                self._count('fallback')
+                return execute(), 'fallback'
+            waited = True
+            time.sleep(self.poll)
+        try:
+            # ロックを取る直前に他のプロセスが保存し終えていることがある
+            table = self.get(key)
+            if table is not None:
+                status = 'coalesced' if waited else 'hit'
+                self._count(status)
+                return table, status
+            table = execute()
+            self.set(key, table)
+            self._count('miss')
+            return table, 'miss'
+        finally:
+            if self._cache.get(lock_key) == token:
+                self._cache.delete(lock_key)
+
+    def clear(self):
+        """保存した結果を消す（実行中のロックは残す）"""
+        self._cache.evict(RESULT_TAG)
+
+    def stats(self):
+        """このプロセスでのヒット・実行・待ち合わせの回数と、保存している結果の数・バイト数"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(entries=len(self._cache), bytes=self._cache.volume())
+        return stats
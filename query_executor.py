@@ -0,0 +1,179 @@
+"""グラフごとのクエリを並行して実行する上限付きのスレッドプール
+
+散布図・ヒストグラム・箱ひげ図・棒グラフ・円グラフ・ヒートマップは互いに独立したクエリ（グラフの作成）
+のため、順番に待たずに同時に投入し、終わったものから表示する。
+各ジョブには期限（タイムアウト）があり、期限切れや選択の変更で取り消されたジョブは、
+まだ始まっていなければ実行せず、実行中なら取り消しの合図（cancel_event）を送る。
+相乗りしているジョブは、待っている全員が期限切れ等で手放したときにだけ取り消す。
+data_accessは合図を受けると、非同期で投入したクエリをウェアハウス側でも止める。
+
+同じキーのジョブが実行中なら新しく投入せずに相乗りする（セッションを跨いでも同じ作成は1回だけ）。
+"""
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+# 実行中のジョブの取り消しの合図（ワーカースレッドの中でだけ設定される）
+_cancel_event = contextvars.ContextVar('query_cancel_event', default=None)
+
+
+class QueryCancelled(Exception):
+    """クエリが取り消された（選択の変更・セクションを閉じた等）"""
+
+
+class QueryTimeout(QueryCancelled):
+    """クエリが期限までに終わらなかった"""
+
+
+def cancel_event():
+    """実行中のジョブの取り消しの合図（threading.Event）。ジョブの外ではNone"""
+    return _cancel_event.get()
+
+
+def check_cancelled():
+    """実行中のジョブが取り消されていればQueryCancelledを送出する"""
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise QueryCancelled('クエリが取り消されました')
+
+
+class QueryJob:
+    """投入したジョブ。resultで結果を受け取り、cancelで取り消す"""
+
+    def __init__(self, key, timeout):
+        self.key = key
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout if timeout else None
+        self.event = threading.Event()
+        self.future = None
+        # 取り消した理由（'cancelled' / 'timeout'）。取り消していなければNone
+        self.reason = None
+        # 相乗りしているセッションの数（全員が手放したら取り消す）
+        self.owners = 1
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self, reason='cancelled'):
+        """ジョブを取り消す。始まっていなければ実行せず、実行中なら合図を送る"""
+        if self.future.done():
+            return False
+        self.reason = reason
+        self.event.set()
+        self.future.cancel()
+        return True
+
+    def expired(self):
+        """期限を過ぎても終わっていないか"""
+        return self.deadline is not None and time.monotonic() >= self.deadline and not self.future.done()
+
+    def result(self):
+        """結果を返す（終わっていなければ待つ）。取り消された場合・期限を過ぎた場合はQueryCancelled/QueryTimeout
+
+        相乗りしている他のセッションのために実行を続けている場合も、期限を過ぎていればQueryTimeoutにする。
+        """
+        if self.reason == 'timeout' or self.reason is None and self.expired():
+            raise QueryTimeout(f'{self.deadline - self.submitted:g}秒以内にクエリが終わりませんでした')
+        if self.reason is not None:
+            raise QueryCancelled('クエリが取り消されました')
+        return self.future.result()
+
+
+class QueryExecutor:
+    """同時に実行するジョブの数を制限し、期限と取り消しを扱うスレッドプール（プロセス全体で共有する）
+
+    max_workers: 同時に実行するジョブの数の上限（ウェアハウスへ同時に投げるクエリの数の上限）
+    timeout: ジョブの期限（投入からの秒数。0なら期限なし）
+    """
+
+    def __init__(self, max_workers=4, timeout=60.0):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='chart-query')
+        # キー -> 実行中（または待っている）ジョブ
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._run_times = collections.deque(maxlen=1000)
+
+    def submit(self, key, func):
+        """func() をジョブとして投入する。同じキーのジョブが実行中なら、それを返す（相乗り）"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.reason is None:
+                job.owners += 1
+                self._counters['shared'] += 1
+                return job
+            job = QueryJob(key, self.timeout)
+            # トレースのスパンがワーカースレッドでも投入した側のスパンの下に入るよう、コンテキストを引き継ぐ
+            context = contextvars.copy_context()
+            job.future = self._pool.submit(context.run, self._run, job, func)
+            self._jobs[key] = job
+            self._counters['submitted'] += 1
+        job.future.add_done_callback(lambda _: self._finished(job))
+        return job
+
+    def _run(self, job, func):
+        if job.event.is_set():
+            raise QueryCancelled('クエリが取り消されました')
+        _cancel_event.set(job.event)
+        start = time.monotonic()
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self._run_times.append(time.monotonic() - start)
+
+    def _finished(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            if job.reason is not None:
+                self._counters[job.reason] += 1
+            elif job.future.exception() is not None:
+                self._counters['errors'] += 1
+            else:
+                self._counters['completed'] += 1
+
+    def release(self, job, reason='cancelled'):
+        """ジョブを手放す。相乗りしている他のセッションが無ければ取り消す（reasonは取り消した理由）"""
+        with self._lock:
+            job.owners -= 1
+            if job.owners > 0:
+                return False
+        return job.cancel(reason)
+
+    def as_completed(self, jobs):
+        """ジョブを終わった順に返す。期限を過ぎたジョブは手放して返す（resultでQueryTimeout）
+
+        手放したジョブは、相乗りしている他のセッションが無ければ取り消す。
+        """
+        pending = {job.future: job for job in jobs}
+        while pending:
+            for future, job in list(pending.items()):
+                if future.done():
+                    del pending[future]
+                    yield job
+                elif job.expired():
+                    # 期限を過ぎたジョブは、実行中のスレッドが止まるのを待たずに返す
+                    self.release(job, 'timeout')
+                    del pending[future]
+                    yield job
+            if not pending:
+                return
+            deadlines = [job.deadline for job in pending.values() if job.deadline is not None]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            concurrent.futures.wait(pending, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def stats(self):
+        """投入・完了・相乗り・取り消し・タイムアウトの回数と、実行時間の統計"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(running=len(self._jobs), max_workers=self.max_workers)
+            run_times = sorted(self._run_times)
+        if run_times:
+            stats['run_avg_ms'] = round(sum(run_times) / len(run_times) * 1000, 2)
+            stats['run_max_ms'] = round(run_times[-1] * 1000, 2)
+        return stats
@@ -0,0 +1,108 @@
+"""グラフのセクションごとのデータの取得・集計とグラフの作成
+
+各build_*関数は選択されたカラムからグラフを作り、(figure, キャプション) を返す。
+filters（filters.normalize の形）を指定した場合は、絞り込んだ行（カラムストアが共有するビュー）から作る。
+画面の部品（セレクトボックス・トグル等）とグラフのキャッシュはapp.py側で扱う。
+"""
+import os
+
+import numpy as np
+
+from aggregation import PandasAggregationEngine
+import charts
+import data_access
+from columns import NUMERIC_COLUMNS, column_mapping
+from cube import limit_groups
+
+# 棒グラフ・円グラフ・ヒートマップで個別に表示する値の数（超えた分は「その他」にまとめる。0なら制限なし）
+CHART_TOP_N = int(os.getenv('CHART_TOP_N', '30'))
+
+
+def streaming_summary():
+    """ストリーミングで読み込む場合は現在のデータバージョンの集計（読み込み中なら途中まで）。それ以外はNone"""
+    if data_access.ORDERS_LOAD_MODE != 'stream':
+        return None
+    return data_access.streaming_summary(data_access.dataset_version())
+
+
+def section_engine(columns, filters=()):
+    """集計するセクション用の集計エンジン（pandasで集計する場合は必要なカラムを取得する）"""
+    if filters:
+        # 絞り込んだ行は手元にあるため、SQLではなく絞り込んだ行（ビュー）を集計する
+        df, _ = data_access.load_orders(columns, filters=filters)
+        return PandasAggregationEngine(df)
+    if data_access.AGGREGATION_ENGINE != 'pandas':
+        return data_access.aggregation_engine(None, data_access.dataset_version())
+    df, version = data_access.load_orders(columns)
+    return data_access.aggregation_engine(df, version)
+
+
+def section_aggregates(dimensions, measures=(), filters=()):
+    """棒グラフ・円グラフ・ヒートマップの集計元（キューブの次元・数値カラムだけならキューブから集計する）"""
+    if filters:
+        # キューブは全行の集計のため、絞り込んだ場合は絞り込んだ行を集計する
+        return section_engine([*dimensions, *measures], filters)
+    summary = streaming_summary()
+    # ストリーミングでは読み込みと同時に集計しているキューブ（読み込み中なら途中まで）を使う
+    cube = summary.cube() if summary is not None else data_access.aggregate_cube(data_access.dataset_version())
+    if cube.covers(dimensions, measures):
+        return cube
+    return section_engine([*dimensions, *measures])
+
+
+def build_scatter(x, y, filters=()):
+    summary = streaming_summary()
+    if summary is not None:
+        # 行データを保持しないため、読み込みと同時に数えた2次元ビンの件数で描画する
+        counts, x_labels, y_labels = summary.density(x, y)
+        fig = charts.density_figure(counts, x_labels, y_labels, x, y, title=f'{column_mapping[x]} vs {column_mapping[y]}')
+        return fig, f"描画モード: {charts.SCATTER_MODE_LABELS['density']} / 描画点数: {np.count_nonzero(counts):,} / 全{summary.rows:,}行"
+    df, _ = data_access.load_orders([x, y], filters=filters)
+    # 行数に応じてWebGL・サンプリング・2次元ビン分けを切り替える
+    fig, mode, points = charts.scatter_figure(df, x, y, title=f'{column_mapping[x]} vs {column_mapping[y]}')
+    return fig, f'描画モード: {charts.SCATTER_MODE_LABELS[mode]} / 描画点数: {points:,} / 全{len(df):,}行'
+
+
+def build_histogram(col, bins, filters=()):
+    summary = streaming_summary()
+    if col in NUMERIC_COLUMNS and summary is not None:
+        histogram_df = summary.histogram(col, bins, data_access.HISTOGRAM_MAX_BINS)
+    elif col in NUMERIC_COLUMNS:
+        # 数値のカラムはサーバー側でビンの境界と件数を求める
+        histogram_df = data_access.histogram_summary(col, data_access.dataset_version(), bins, filters)
+    else:
+        # 数値以外のカラムは値ごとの件数（集計キューブまたは集計エンジン）
+        histogram_df = section_aggregates([col], filters=filters).pie(col)
+    return charts.histogram_figure(histogram_df, col, title=f'{column_mapping[col]}のヒストグラム'), None
+
+
+def build_box(col, filters=()):
+    # 四分位数・ひげ・外れ値（上限まで）をサーバー側で求め、統計量だけを描画する
+    stream = streaming_summary()
+    if stream is not None:
+        summary = stream.box(col, data_access.BOX_MAX_OUTLIERS)
+    else:
+        summary = data_access.box_summary(col, data_access.dataset_version(), filters)
+    fig = charts.box_figure(summary, col, title=f'{column_mapping[col]}の箱ひげ図')
+    if summary is None:
+        return fig, '値がありません'
+    return fig, f"全{summary['count']:,}件 / 外れ値: {summary['outlier_count']:,}件（描画: {len(summary['outliers']):,}件）"
+
+
+def build_bar(category, value, filters=()):
+    # カテゴリごとの集計は集計キューブ（または集計エンジン）で行い、上位以外は「その他」にまとめる
+    bar_df = section_aggregates([category], [value], filters).bar(category, value)
+    bar_df = limit_groups(bar_df, ['category'], 'value', CHART_TOP_N)
+    return charts.bar_figure(bar_df, category, value, title=f'{column_mapping[category]}による{column_mapping[value]}の棒グラフ'), None
+
+
+def build_pie(col, filters=()):
+    # 値ごとの件数は集計キューブ（または集計エンジン）で求め、上位以外は「その他」にまとめる
+    pie_df = limit_groups(section_aggregates([col], filters=filters).pie(col), ['name'], 'count', CHART_TOP_N)
+    return charts.pie_figure(pie_df, col, title=f'{column_mapping[col]}の円グラフ'), None
+
+
+def build_heatmap(x, y, filters=()):
+    # 集計キューブ（または集計エンジン）で組み合わせごとの件数を求め、ピボットしてヒートマップを描画
+    heatmap_df = limit_groups(section_aggregates([x, y], filters=filters).heatmap(x, y), ['x', 'y'], 'count', CHART_TOP_N)
+    return charts.heatmap_figure(heatmap_df, column_mapping[x], column_mapping[y], title=f'{column_mapping[x]}と{column_mapping[y]}のヒートマップ'), None
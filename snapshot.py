@@ -0,0 +1,74 @@
+"""ORDERSのスナップショットをローカルディスクに保存・復元する
+
+Arrow IPC（非圧縮）で保存するため、プロセスの起動直後でもSnowflakeへ問い合わせずにすぐ描画できる。
+読み込んだデータはpandasのDataFrameに変換する（変換でコピーされるため、メモリ使用量は取得した場合と変わらない）。
+"""
+import os
+import tempfile
+import time
+
+import pyarrow as pa
+
+VERSION_KEY = b'orders_version'
+
+
+def _snapshot_files(directory, name):
+    """保存済みのスナップショットを新しい順に返す"""
+    if not os.path.isdir(directory):
+        return []
+    prefix = f'orders-{name}-'
+    paths = [
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if f.startswith(prefix) and f.endswith('.arrow')
+    ]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def save_snapshot(df, version, directory, name, keep=3, max_bytes=None):
+    """DataFrameをバージョン付きのスナップショットとして保存し、古いものを削除する"""
+    os.makedirs(directory, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), VERSION_KEY: version.encode()})
+    path = os.path.join(directory, f'orders-{name}-{version}.arrow')
+    # 書き込み途中のファイルを読まれないよう、書き込みごとに別の一時ファイルに書いてから置き換える
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    prune_snapshots(directory, name, keep, max_bytes)
+    return path
+
+
+def prune_snapshots(directory, name, keep=3, max_bytes=None):
+    """新しい順にkeep個まで、合計max_bytesまで残して削除する（最新の1つは必ず残す）"""
+    paths = _snapshot_files(directory, name)
+    total = 0
+    for i, path in enumerate(paths):
+        total += os.path.getsize(path)
+        if i > 0 and (i >= keep or (max_bytes is not None and total > max_bytes)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_latest_snapshot(directory, name):
+    """最新のスナップショットを読み込む
+
+    戻り値は (DataFrame, データバージョン, 保存からの経過秒数)。無ければNone。
+    """
+    for path in _snapshot_files(directory, name):
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        except (OSError, pa.ArrowInvalid):
+            # 壊れたファイルは飛ばして次に新しいものを使う
+            continue
+        version = (table.schema.metadata or {}).get(VERSION_KEY, b'').decode()
+        age = time.time() - os.path.getmtime(path)
+        return table.to_pandas(split_blocks=True), version, age
+    return None
@@ -0,0 +1,400 @@
+"""ORDERSを一定の行数ずつ受け取りながら集計する（全件をメモリに載せない）
+
+ストリーミングの読み込みでは、結果をバッチ（コネクタのArrowのバッチ）ごとに受け取り、
+次の集計に足し込んでからバッチを捨てる。保持するのは集計結果だけなので、メモリは行数によらない。
+    件数・合計: 集計キューブの次元の2つ組ごとの件数と数値カラムの合計（棒グラフ・円グラフ・ヒートマップ）
+    ヒストグラム・分位点: 数値カラムの値ごとの件数。値の種類が上限を超えたら、範囲を細かく等分した
+        ビンの件数（分位点の近似）と、最小側・最大側の値（外れ値）に切り替える
+    2次元ビン: 数値カラムの組ごとの2次元ビンの件数（散布図の密度表示）
+
+値ごとの件数を持っている間のヒストグラム・箱ひげ図は、全件をメモリに載せた場合（summaries）と同じ結果になる。
+細かいビンに切り替えたあとは、分位点とビンの境界付近の件数がビンの幅の分だけずれる。
+ビンの範囲（最小値・最大値）は、読み込みの前に集計クエリで求めておく。
+"""
+import itertools
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from columns import INTEGER_COLUMNS
+from cube import AggregateCube
+from summaries import bin_count, bin_edges
+
+# 値ごとの件数を持つ値の種類数の上限（超えたら細かいビンに切り替える）
+STREAM_EXACT_VALUES = int(os.getenv('STREAM_EXACT_VALUES', '100000'))
+# 細かいビンの数（分位点の近似の精度。範囲 / ビン数 の幅でずれる）
+STREAM_QUANTILE_BINS = int(os.getenv('STREAM_QUANTILE_BINS', '4096'))
+# 2次元ビンの各軸のビン数（全件をメモリに載せた場合の散布図の密度表示と同じ SCATTER_BINS）
+STREAM_GRID_BINS = int(os.getenv('SCATTER_BINS', '100'))
+
+
+def _lerp(a, b, t):
+    # np.percentileの線形補間と同じ計算（結果を全件での計算と一致させるため）
+    diff = b - a
+    return b - diff * (1 - t) if t >= 0.5 else a + diff * t
+
+
+def weighted_percentile(values, counts, qs):
+    """値ごとの件数から、np.percentile（線形補間）と同じ分位点を求める
+
+    values: 昇順の値 / counts: 値ごとの件数 / qs: 分位点（0〜100）のリスト
+    """
+    cumulative = np.cumsum(counts)
+    n = int(cumulative[-1])
+    results = []
+    for q in qs:
+        position = q / 100 * (n - 1)
+        below = int(np.floor(position))
+        above = min(below + 1, n - 1)
+        a = values[np.searchsorted(cumulative, below, side='right')]
+        b = values[np.searchsorted(cumulative, above, side='right')]
+        results.append(_lerp(a, b, position - below))
+    return results
+
+
+class NumericAccumulator:
+    """数値カラムの件数・最小値・最大値・平均・分散と、値の分布を足し込む
+
+    lo, hi: 値の範囲（細かいビンの範囲。範囲外の値は端のビンに入れる）
+    exact_limit: 値ごとの件数を持つ値の種類数の上限
+    quantile_bins: 細かいビンの数
+    extremes: 細かいビンに切り替えたあとに保持する、最小側・最大側の値の数（外れ値の表示用）
+    """
+
+    def __init__(self, lo, hi, exact_limit=STREAM_EXACT_VALUES, quantile_bins=STREAM_QUANTILE_BINS, extremes=1000):
+        self.range = (float(lo), float(hi)) if lo is not None else (0.0, 0.0)
+        self.exact_limit = exact_limit
+        self.quantile_bins = quantile_bins
+        self.extremes = extremes
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        # 平均からの偏差の2乗和（バッチごとの値をChanの方法で合算する）
+        self.m2 = 0.0
+        # 値ごとの件数（昇順の値, 件数）。細かいビンに切り替えたらNone
+        self.values = np.array([], dtype=np.float64)
+        self.counts = np.array([], dtype=np.int64)
+        self.grid = None
+        self.low = self.high = None
+
+    @property
+    def exact(self):
+        return self.grid is None
+
+    def add(self, arr):
+        """NULLを除いたfloat64の値を足し込む"""
+        if arr.size == 0:
+            return
+        n = arr.size
+        mean = arr.mean()
+        m2 = float(((arr - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, arr.min())
+        self.max = max(self.max, arr.max())
+        if self.exact:
+            values, counts = np.unique(arr, return_counts=True)
+            merged, inverse = np.unique(np.concatenate([self.values, values]), return_inverse=True)
+            self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]), minlength=len(merged)).astype(np.int64)
+            self.values = merged
+            if len(self.values) > self.exact_limit:
+                self._to_grid()
+        else:
+            self._add_grid(arr, np.ones(arr.size, dtype=np.int64))
+            self._add_extremes(arr)
+
+    def _bin_index(self, arr):
+        lo, hi = self.range
+        if hi <= lo:
+            return np.zeros(arr.size, dtype=np.int64)
+        index = np.floor((arr - lo) * self.quantile_bins / (hi - lo)).astype(np.int64)
+        return np.clip(index, 0, self.quantile_bins - 1)
+
+    def _add_grid(self, arr, weights):
+        self.grid += np.bincount(self._bin_index(arr), weights=weights, minlength=self.quantile_bins).astype(np.int64)
+
+    def _add_extremes(self, arr):
+        k = self.extremes
+        low = np.concatenate([self.low, arr])
+        high = np.concatenate([self.high, arr])
+        self.low = np.sort(np.partition(low, k - 1)[:k]) if low.size > k else np.sort(low)
+        self.high = np.sort(np.partition(high, high.size - k)[-k:]) if high.size > k else np.sort(high)
+
+    def _to_grid(self):
+        # 値ごとの件数を細かいビンへ移し、両端の値（件数分）を外れ値用に残す
+        self.grid = np.zeros(self.quantile_bins, dtype=np.int64)
+        self._add_grid(self.values, self.counts)
+        k = self.extremes
+        self.low = np.repeat(self.values[:k], self.counts[:k])[:k]
+        self.high = np.repeat(self.values[-k:], self.counts[-k:])[-k:]
+        self.values = self.counts = None
+
+    def _grid_values(self):
+        """細かいビンの中央の値と件数（分布の近似）"""
+        lo, hi = self.range
+        centers = lo + (np.arange(self.quantile_bins) + 0.5) * (hi - lo) / self.quantile_bins
+        nonzero = self.grid > 0
+        return np.clip(centers[nonzero], self.min, self.max), self.grid[nonzero]
+
+    def _distribution(self):
+        return (self.values, self.counts) if self.exact else self._grid_values()
+
+    def _std(self):
+        if self.exact:
+            # 全件での np.std と同じく、平均からの偏差で求める
+            mean = (self.values * self.counts).sum() / self.count
+            return float(np.sqrt((self.counts * (self.values - mean) ** 2).sum() / self.count))
+        return float(np.sqrt(self.m2 / self.count))
+
+    def histogram(self, bins='auto', max_bins=200, integer=False):
+        """summaries.histogram と同じ形のビンの境界と件数"""
+        if self.count == 0:
+            return pd.DataFrame({'bin_start': [], 'bin_end': [], 'count': []})
+        lo, hi = self.min, self.max
+        if lo == hi:
+            return pd.DataFrame({'bin_start': [lo], 'bin_end': [hi], 'count': [self.count]})
+        values, counts = self._distribution()
+        q3, q1 = weighted_percentile(values, counts, [75, 25])
+        n_bins = min(bin_count(bins, self.count, lo, hi, self._std(), q3 - q1), max_bins)
+        edges = bin_edges(lo, hi, n_bins, integer)
+        binned, _ = np.histogram(values, bins=edges, weights=counts)
+        return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': binned.astype(np.int64)})
+
+    def box(self, max_outliers=1000, seed=0):
+        """summaries.box と同じ形の箱ひげ図の統計量（外れ値は値の小さい順）"""
+        if self.count == 0:
+            return None
+        values, counts = self._distribution()
+        q1, median, q3 = weighted_percentile(values, counts, [25, 50, 75])
+        iqr = q3 - q1
+        lower, upper = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+        inside = values[(values >= lower) & (values <= upper)]
+        if self.exact:
+            outside = (values < lower) | (values > upper)
+            outliers = np.repeat(values[outside], counts[outside])
+            outlier_count = int(outliers.size)
+            lowerfence, upperfence = inside.min(), inside.max()
+        else:
+            # 外れ値は保持している両端の値から取り出し、件数は細かいビンで数える
+            outliers = np.concatenate([self.low[self.low < lower], self.high[self.high > upper]])
+            outlier_count = max(int(counts[(values < lower) | (values > upper)].sum()), int(outliers.size))
+            below, above = self.low[self.low >= lower], self.high[self.high <= upper]
+            lowerfence = below.min() if below.size else inside.min()
+            upperfence = above.max() if above.size else inside.max()
+        if outliers.size > max_outliers:
+            rng = np.random.default_rng(seed)
+            picked = rng.choice(np.arange(1, outliers.size - 1), size=max(0, max_outliers - 2), replace=False)
+            outliers = outliers[np.sort(np.concatenate([[0, outliers.size - 1], picked]))]
+        return {
+            'count': int(self.count),
+            'mean': float(self.mean),
+            'q1': float(q1),
+            'median': float(median),
+            'q3': float(q3),
+            'lowerfence': float(lowerfence),
+            'upperfence': float(upperfence),
+            'outliers': outliers.tolist(),
+            'outlier_count': outlier_count,
+        }
+
+
+class GridAccumulator:
+    """2つの数値カラムの2次元ビンの件数（charts.density_grid と同じビン分け）"""
+
+    def __init__(self, x_range, y_range, bins=STREAM_GRID_BINS):
+        self.axes = [self._axis(x_range, bins), self._axis(y_range, bins)]
+        self.counts = np.zeros(len(self.axes[0][1]) * len(self.axes[1][1]), dtype=np.int64)
+
+    @staticmethod
+    def _axis(value_range, bins):
+        lo, hi = value_range
+        if lo is None or lo == hi:
+            return (lo, hi, 1), np.array([lo])
+        edges = np.linspace(lo, hi, bins + 1)
+        return (lo, hi, bins), (edges[:-1] + edges[1:]) / 2
+
+    def _index(self, arr, axis):
+        (lo, hi, bins), _ = self.axes[axis]
+        if bins == 1:
+            return np.zeros(arr.size, dtype=np.int64)
+        return np.clip(((arr - lo) * bins / (hi - lo)).astype(np.int64), 0, bins - 1)
+
+    def add(self, x, y):
+        """x, yともにNULLでない行の値を足し込む"""
+        n_y = len(self.axes[1][1])
+        self.counts += np.bincount(self._index(x, 0) * n_y + self._index(y, 1), minlength=self.counts.size)
+
+    def grid(self):
+        """(件数, xのラベル, yのラベル)。件数はyが行・xが列"""
+        x_labels, y_labels = self.axes[0][1], self.axes[1][1]
+        return self.counts.reshape(len(x_labels), len(y_labels)).T.copy(), x_labels, y_labels
+
+
+class CubeAccumulator:
+    """集計キューブの集計表（次元の2つ組ごとの件数・合計）を、バッチごとに足し込む
+
+    バッチごとに文字列の2つ組でまとめ直すと遅いため、次元の値はバッチを跨いで変わらない整数のコードにし、
+    2つ組のコードを1つの整数にしたキーで足し込む。値に戻すのはcube()のときだけ。
+    """
+
+    def __init__(self, dimensions, measures):
+        self.dimensions = list(dimensions)
+        self.measures = list(measures)
+        # 次元 -> 値 -> コード / コード順の値（NULLも1つの値）
+        self._codes = {d: {} for d in self.dimensions}
+        self._values = {d: [] for d in self.dimensions}
+        # (次元a, 次元b) -> 2つ組のキーを索引にした件数・合計のDataFrame
+        self._sums = {}
+
+    def _encode(self, dimension, series):
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        mapping, values = self._codes[dimension], self._values[dimension]
+        lookup = np.empty(len(uniques), dtype=np.int64)
+        for i, value in enumerate(uniques):
+            # NULL（None / NaN / NA）は互いに等しくないため、1つのキーにまとめる
+            key = None if pd.isna(value) else value
+            code = mapping.get(key)
+            if code is None:
+                code = mapping[key] = len(values)
+                values.append(key)
+            lookup[i] = code
+        return lookup[codes]
+
+    def add(self, df):
+        frame = pd.DataFrame({'n': np.ones(len(df), dtype=np.int64)})
+        for m in self.measures:
+            values = df[m].to_numpy(dtype=np.float64, na_value=np.nan)
+            frame[f'{m}_sum'] = values
+            frame[f'{m}_n'] = (~np.isnan(values)).astype(np.int64)
+        codes = {d: self._encode(d, df[d]) for d in self.dimensions}
+        for a, b in itertools.combinations(self.dimensions, 2):
+            part = frame.groupby((codes[a] << 32) | codes[b]).sum()
+            current = self._sums.get((a, b))
+            self._sums[(a, b)] = part if current is None else pd.concat([current, part]).groupby(level=0).sum()
+
+    def _decode(self, dimension, codes):
+        values = pd.Series(self._values[dimension], dtype=object).take(codes).reset_index(drop=True)
+        if dimension in INTEGER_COLUMNS:
+            # 整数の次元はキューブの型（Int64）に揃える
+            return values.astype('Int64')
+        return values
+
+    def cube(self):
+        """ここまでに足し込んだ行の集計キューブ（AggregateCube.from_frameと同じ形）"""
+        tables = {}
+        for (a, b), sums in self._sums.items():
+            keys = sums.index.to_numpy()
+            table = sums.reset_index(drop=True)
+            table.insert(0, b, self._decode(b, keys & 0xFFFFFFFF))
+            table.insert(0, a, self._decode(a, keys >> 32))
+            tables[(a, b)] = table.sort_values([a, b]).reset_index(drop=True)
+        return AggregateCube(self.dimensions, self.measures, tables)
+
+
+class StreamingSummary:
+    """ストリーミングで読み込んだORDERSの集計（バッチを足し込むたびに更新され、途中の結果も読める）
+
+    bounds: 数値カラム -> (最小値, 最大値)。細かいビンと2次元ビンの範囲に使う
+    total_rows: 読み込む行数（進捗の表示用）
+    """
+
+    def __init__(self, bounds, total_rows, dimensions, measures, max_outliers=1000):
+        self.bounds = dict(bounds)
+        self.total_rows = total_rows
+        self.rows = 0
+        self.batches = 0
+        self.done = False
+        self.error = None
+        self._numeric = {col: NumericAccumulator(lo, hi, extremes=max_outliers) for col, (lo, hi) in self.bounds.items()}
+        self._grids = {
+            (x, y): GridAccumulator(self.bounds[x], self.bounds[y])
+            for x, y in itertools.combinations_with_replacement(self.bounds, 2)
+        }
+        self._cube = CubeAccumulator(dimensions, measures)
+        # (足し込んだバッチの数, キューブ)。途中の描き直しのたびにキューブを作り直さないよう覚えておく
+        self._cube_cache = (-1, None)
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._closed = threading.Event()
+
+    @property
+    def columns(self):
+        """読み込む必要のあるカラム"""
+        return list(dict.fromkeys([*self.bounds, *self._cube.dimensions, *self._cube.measures]))
+
+    def add(self, df):
+        """1バッチ分の行を足し込む"""
+        arrays = {col: df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in self.bounds}
+        valid = {col: ~np.isnan(arr) for col, arr in arrays.items()}
+        with self._lock:
+            for col, acc in self._numeric.items():
+                acc.add(arrays[col][valid[col]])
+            for (x, y), grid in self._grids.items():
+                both = valid[x] & valid[y]
+                grid.add(arrays[x][both], arrays[y][both])
+            self._cube.add(df)
+            self.rows += len(df)
+            self.batches += 1
+
+    def finish(self, error=None):
+        self.error = error
+        self.done = True
+        self._finished.set()
+
+    def close(self):
+        """読み込みを打ち切る（新しいデータバージョンに置き換えられたとき）。読み込むスレッドは次のバッチで止まる"""
+        self._closed.set()
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def wait(self, timeout=None):
+        """読み込みが終わるまで待つ。終わっていればTrue"""
+        return self._finished.wait(timeout)
+
+    def progress(self):
+        """読み込んだ割合（0〜1）"""
+        if self.done:
+            return 1.0
+        return min(1.0, self.rows / self.total_rows) if self.total_rows else 0.0
+
+    def histogram(self, col, bins='auto', max_bins=200, integer=None):
+        with self._lock:
+            return self._numeric[col].histogram(bins, max_bins, col in INTEGER_COLUMNS if integer is None else integer)
+
+    def box(self, col, max_outliers=1000):
+        with self._lock:
+            return self._numeric[col].box(max_outliers)
+
+    def density(self, x, y):
+        """charts.density_grid と同じ形の (件数, xのラベル, yのラベル)"""
+        with self._lock:
+            if (x, y) in self._grids:
+                return self._grids[(x, y)].grid()
+            counts, y_labels, x_labels = self._grids[(y, x)].grid()
+        return counts.T, x_labels, y_labels
+
+    def count(self, x, y=None):
+        """x（とy）がNULLでない行数"""
+        key = (x, y or x)
+        with self._lock:
+            grid = self._grids[key] if key in self._grids else self._grids[key[::-1]]
+            return int(grid.counts.sum())
+
+    def cube(self):
+        with self._lock:
+            if self._cube_cache[0] != self.batches:
+                self._cube_cache = (self.batches, self._cube.cube())
+            return self._cube_cache[1]
+
+    def exact(self, col):
+        """カラムの分布を値ごとの件数で持っているか（Falseなら分位点は近似）"""
+        with self._lock:
+            return self._numeric[col].exact
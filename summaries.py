@@ -0,0 +1,111 @@
+"""数値カラムの要約（ヒストグラム・箱ひげ図）
+
+全件をブラウザへ送ってplotly.js側でビン分けや四分位数を計算させないよう、
+サーバー側でNumPyを使って集計し、グラフは集計結果だけから描く。
+"""
+import numpy as np
+import pandas as pd
+
+# ビン数の決め方（NumPyのnp.histogram_bin_edgesのルール名。数値ならビン数）
+BIN_RULES = {
+    'auto': '自動（FDとSturgesの小さい方の幅）',
+    'fd': 'Freedman–Diaconis',
+    'sturges': 'Sturges',
+    'sqrt': '平方根',
+    'scott': 'Scott',
+    'rice': 'Rice',
+    30: '30（固定）',
+}
+
+
+def _values(series):
+    # 幅の狭い整数型・float32でも誤差やオーバーフローが出ないようfloat64で計算する
+    return series.dropna().to_numpy(dtype=np.float64)
+
+
+def bin_count(rule, n, lo, hi, std, iqr):
+    """np.histogram_bin_edges のルールと同じ方法でビン数を求める（全件の値の代わりに統計量を使う）"""
+    if not isinstance(rule, str):
+        return int(rule)
+    ptp = hi - lo
+    sturges = ptp / (np.log2(n) + 1.0)
+    fd = 2.0 * iqr * n ** (-1.0 / 3.0)
+    width = {
+        'sqrt': lambda: ptp / np.sqrt(n),
+        'sturges': lambda: sturges,
+        'rice': lambda: ptp / (2.0 * n ** (1.0 / 3)),
+        'scott': lambda: (24.0 * np.pi ** 0.5 / n) ** (1.0 / 3.0) * std,
+        'fd': lambda: fd,
+        'auto': lambda: min(fd, sturges) if fd else sturges,
+    }[rule]()
+    return int(np.ceil(ptp / width)) if width else 1
+
+
+def bin_edges(lo, hi, n_bins, integer=False):
+    """lo〜hiをn_bins個以下のビンに分ける境界
+
+    整数のカラムは、各ビンに同じ数の整数が入るよう、整数の幅で lo - 0.5 から区切る
+    （幅を揃えるため、ビン数はn_binsより少なくなることがある）。
+    """
+    if not integer:
+        return np.linspace(lo, hi, n_bins + 1)
+    n_values = int(hi - lo) + 1
+    width = -(-n_values // min(n_bins, n_values))
+    return lo - 0.5 + width * np.arange(-(-n_values // width) + 1)
+
+
+def histogram(series, bins='auto', max_bins=200, integer=None):
+    """ビンの境界と件数を求める (bin_start, bin_end, count)
+
+    bins: ビン数、またはBIN_RULESのルール名
+    max_bins: ルールで求めたビン数の上限（外れ値でビンが細かくなりすぎるのを防ぐ）
+    integer: 整数のカラムか（Noneなら型から判断）。整数ならビンを整数の幅で区切る
+    """
+    arr = _values(series)
+    if arr.size == 0:
+        return pd.DataFrame({'bin_start': [], 'bin_end': [], 'count': []})
+    lo, hi = arr.min(), arr.max()
+    if lo == hi:
+        return pd.DataFrame({'bin_start': [lo], 'bin_end': [hi], 'count': [arr.size]})
+    if integer is None:
+        integer = pd.api.types.is_integer_dtype(series.dtype)
+    # ルールのビン数は統計量から求め、境界を作る前に上限をかける（外れ値で膨大な境界の配列を作らない）
+    q3, q1 = np.percentile(arr, [75, 25]) if bins in ('auto', 'fd') else (0.0, 0.0)
+    n_bins = min(bin_count(bins, arr.size, lo, hi, np.std(arr), q3 - q1), max_bins)
+    edges = bin_edges(lo, hi, n_bins, integer)
+    counts, _ = np.histogram(arr, bins=edges)
+    return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': counts})
+
+
+def box(series, max_outliers=1000, seed=0):
+    """箱ひげ図の統計量を求める
+
+    ひげは四分位範囲の1.5倍以内にある最小値・最大値。外れ値は最大max_outliers個まで
+    （乱数シード固定で抽出し、最小値・最大値は必ず含める）。
+    値が無ければNone。
+    """
+    arr = _values(series)
+    if arr.size == 0:
+        return None
+    q1, median, q3 = np.percentile(arr, [25, 50, 75])
+    iqr = q3 - q1
+    inside = arr[(arr >= q1 - 1.5 * iqr) & (arr <= q3 + 1.5 * iqr)]
+    outliers = arr[(arr < q1 - 1.5 * iqr) | (arr > q3 + 1.5 * iqr)]
+    outlier_count = int(outliers.size)
+    if outliers.size > max_outliers:
+        rng = np.random.default_rng(seed)
+        extremes = [outliers.argmin(), outliers.argmax()]
+        rest = np.setdiff1d(np.arange(outliers.size), extremes)
+        picked = rng.choice(rest, size=max(0, max_outliers - 2), replace=False)
+        outliers = outliers[np.sort(np.concatenate([extremes, picked]))]
+    return {
+        'count': int(arr.size),
+        'mean': float(arr.mean()),
+        'q1': float(q1),
+        'median': float(median),
+        'q3': float(q3),
+        'lowerfence': float(inside.min()),
+        'upperfence': float(inside.max()),
+        'outliers': outliers.tolist(),
+        'outlier_count': outlier_count,
+    }
@@ -0,0 +1,46 @@
+"""tiktokenによるトークン数の計算
+
+エンコーディングは初回に取得してキャッシュする。取得できない環境（オフライン等）では
+UTF-8のバイト数の1/3で概算する（日本語はおよそ1文字で1トークンになる）。
+"""
+import functools
+
+import tiktoken
+
+# メッセージ1件ごと・応答の開始に加わるトークン数（gpt-3.5-turbo / gpt-4系の形式）
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # 未知のモデル名はgpt-4系と同じエンコーディングとみなす
+        return _encoding_by_name('cl100k_base')
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding_by_name(name):
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+def count_tokens(text, model):
+    """テキストのトークン数"""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return max(1, len(text.encode()) // 3)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model):
+    """ChatCompletionに送るメッセージ全体のトークン数（プロンプト側）"""
+    return sum(TOKENS_PER_MESSAGE + count_tokens(m['content'], model) for m in messages) + TOKENS_PER_REPLY
@@ -0,0 +1,212 @@
+"""再実行ごとの処理時間の内訳（トレース）
+
+app.pyの1回の実行をトレースとし、接続・クエリ・集計・各グラフのセクション・ChatGPTへの問い合わせを
+名前付きのスパンで囲んで経過時間を計る。スパンにはデータ量（bytes・rows等）を属性として付けられる。
+トレース中でないスレッド（バックグラウンドの差分更新等）では、spanは何もしない。
+
+終わったトレースはJSON Linesのファイルへ追記でき、スパン名ごとの合計はPrometheusのテキスト形式
+（node_exporterのtextfile collector向け）のファイルへ書き出せる。
+"""
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+# 終わったトレースを追記するJSON Linesのファイル（空文字なら書き出さない）
+TRACE_JSONL_PATH = os.getenv('TRACE_JSONL_PATH', '')
+# スパン名ごとの合計を書き出すPrometheusのテキスト形式のファイル（空文字なら書き出さない）
+TRACE_PROMETHEUS_PATH = os.getenv('TRACE_PROMETHEUS_PATH', '')
+
+# 実行中のトレースと、いちばん内側のスパン
+_trace = contextvars.ContextVar('trace', default=None)
+_span = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    """名前付きの区間。durationは終わるまでNone"""
+
+    __slots__ = ('name', 'parent', 'start', 'duration', 'attrs')
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attrs = dict(attrs or {})
+
+    def set(self, **attrs):
+        """属性（bytes・rows等）を追加する"""
+        self.attrs.update(attrs)
+        return self
+
+    def depth(self):
+        depth, parent = 0, self.parent
+        while parent is not None:
+            depth, parent = depth + 1, parent.parent
+        return depth
+
+
+class _NullSpan:
+    """トレース中でないときに返す、何もしないスパン"""
+
+    def set(self, **attrs):
+        return self
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """1回の実行のスパンの記録。全体を表すスパン（root）の中に各スパンが入る"""
+
+    def __init__(self, name='rerun'):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.root = Span(name)
+        self.spans = [self.root]
+
+    def records(self):
+        """スパンを開始順の辞書のリストで返す（終わっていないスパンは含めない）
+
+        start_ms はトレースの開始からの経過ミリ秒、depth はrootからの深さ。
+        """
+        spans = sorted((s for s in self.spans if s.duration is not None), key=lambda s: s.start)
+        return [
+            {
+                'trace_id': self.trace_id,
+                'span': s.name,
+                'parent': s.parent.name if s.parent is not None else None,
+                'depth': s.depth(),
+                'start_ms': round((s.start - self.root.start) * 1000, 3),
+                'duration_ms': round(s.duration * 1000, 3),
+                **s.attrs,
+            }
+            for s in spans
+        ]
+
+    def finish(self):
+        """全体のスパンを終え、このスレッドでのトレースを終える"""
+        if self.root.duration is None:
+            self.root.duration = time.perf_counter() - self.root.start
+        if _trace.get() is self:
+            _trace.set(None)
+            _span.set(None)
+        return self
+
+
+def start_trace(name='rerun'):
+    """このスレッド（Streamlitのスクリプトの実行）でトレースを始める"""
+    trace = Trace(name)
+    _trace.set(trace)
+    _span.set(trace.root)
+    return trace
+
+
+def current_span():
+    """いちばん内側のスパン（トレース中でなければ何もしないスパン）"""
+    return _span.get() or NULL_SPAN
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """withで囲んだ区間をスパンとして記録する。例外で抜けた場合は属性errorに例外の型名を残す"""
+    trace = _trace.get()
+    if trace is None:
+        yield NULL_SPAN
+        return
+    s = Span(name, _span.get(), attrs)
+    trace.spans.append(s)
+    token = _span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        s.duration = time.perf_counter() - s.start
+        _span.reset(token)
+
+
+def traced(name):
+    """関数の呼び出しをスパンとして記録するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def to_jsonl(records):
+    return ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in records)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class TraceLog:
+    """終わったトレースを保持し、スパン名ごとの回数・合計時間・合計バイト数を集計する（プロセス全体で共有する）"""
+
+    def __init__(self, maxlen=50, jsonl_path=TRACE_JSONL_PATH, prometheus_path=TRACE_PROMETHEUS_PATH):
+        self._traces = collections.deque(maxlen=maxlen)
+        self._totals = collections.defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+        self._lock = threading.Lock()
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+
+    def record(self, trace):
+        records = trace.records()
+        with self._lock:
+            self._traces.append(records)
+            for r in records:
+                totals = self._totals[r['span']]
+                totals['count'] += 1
+                totals['seconds'] += r['duration_ms'] / 1000
+                totals['bytes'] += r.get('bytes') or 0
+                totals['errors'] += 'error' in r
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    f.write(to_jsonl(records))
+            if self.prometheus_path:
+                # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+                tmp_path = f'{self.prometheus_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(self._prometheus())
+                os.replace(tmp_path, self.prometheus_path)
+        return records
+
+    def traces(self):
+        with self._lock:
+            return list(self._traces)
+
+    def _prometheus(self):
+        lines = []
+        metrics = [
+            ('app_span_duration_seconds', 'summary', 'Time spent in each traced stage of app.py'),
+            ('app_span_payload_bytes_total', 'counter', 'Bytes recorded on each traced stage (query results, figures, chat answers)'),
+            ('app_span_errors_total', 'counter', 'Traced stages that exited with an exception'),
+        ]
+        for metric, kind, help_text in metrics:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+            for name, totals in sorted(self._totals.items()):
+                label = f'{{span="{_label(name)}"}}'
+                if kind == 'summary':
+                    lines.append(f"{metric}_sum{label} {totals['seconds']:.6f}")
+                    lines.append(f"{metric}_count{label} {totals['count']}")
+                elif metric == 'app_span_payload_bytes_total':
+                    lines.append(f"{metric}{label} {totals['bytes']}")
+                else:
+                    lines.append(f"{metric}{label} {totals['errors']}")
+        return '\n'.join(lines) + '\n'
+
+    def prometheus(self):
+        """スパン名ごとの合計をPrometheusのテキスト形式で返す"""
+        with self._lock:
+            return self._prometheus()